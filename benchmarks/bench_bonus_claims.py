@@ -0,0 +1,100 @@
+"""Hammers claim_bonus for a single user from many threads at once.
+
+Checks that exactly one claim is credited per cooldown window and reports latency.
+Requires DATABASE_URL to point at a disposable database.
+
+    python benchmarks/bench_bonus_claims.py --workers 64 --rounds 5
+"""
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import claim_bonus, get_db_connection  # noqa: E402
+
+BENCH_USER_ID = -26026 # Negative ids are never issued by Telegram
+
+
+def reset_user():
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute('DELETE FROM users WHERE user_id = %s', (BENCH_USER_ID,))
+        cur.execute('INSERT INTO users (user_id, username, balance, xp, level) VALUES (%s, %s, 0, 0, 1)', (BENCH_USER_ID, 'bench'))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def read_balance() -> int:
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT balance FROM users WHERE user_id = %s', (BENCH_USER_ID,))
+        return cur.fetchone()[0]
+    finally:
+        conn.close()
+
+
+def run_round(bonus_type: str, workers: int) -> tuple[int, list[float], int]:
+    reset_user()
+    barrier = threading.Barrier(workers)
+    latencies: list[float] = []
+    claimed: list[int] = []
+    amounts: list[int] = []
+    lock = threading.Lock()
+
+    def worker():
+        barrier.wait()
+        started = time.perf_counter()
+        result = claim_bonus(BENCH_USER_ID, bonus_type)
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            if result and result['claimed']:
+                claimed.append(1)
+                amounts.append(result['amount'])
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return len(claimed), latencies, read_balance() - sum(amounts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--bonus-type', default='quick', choices=['daily', 'quick'])
+    parser.add_argument('--workers', type=int, default=32)
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    all_latencies: list[float] = []
+    failures = 0
+    for round_no in range(1, args.rounds + 1):
+        claims, latencies, balance_drift = run_round(args.bonus_type, args.workers)
+        all_latencies.extend(latencies)
+        ok = claims == 1 and balance_drift == 0
+        failures += not ok
+        print(f"round {round_no}: {args.workers} concurrent claims -> {claims} credited, balance drift {balance_drift} [{'OK' if ok else 'FAIL'}]")
+
+    all_latencies.sort()
+    p99 = all_latencies[max(0, int(len(all_latencies) * 0.99) - 1)]
+    print(f"latency p50={statistics.median(all_latencies) * 1000:.1f}ms p99={p99 * 1000:.1f}ms over {len(all_latencies)} claims")
+
+    conn = get_db_connection()
+    try:
+        conn.cursor().execute('DELETE FROM users WHERE user_id = %s', (BENCH_USER_ID,))
+        conn.commit()
+    finally:
+        conn.close()
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Per-request cost of session checks.
+
+Times a one-off Telegram initData sign-in, a token check that needs an HMAC (first
+request with a token, or a cache miss), and a token check served from the LRU
+cache, which is what nearly every request pays.
+
+    python benchmarks/bench_session_auth.py --users 20000
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import statistics
+import sys
+import time
+import urllib.parse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import session_auth  # noqa: E402
+
+BOT_TOKEN = "123456:bench-token"
+SESSION_SECRET = hashlib.sha256(b"bench-session").digest()
+
+
+def signed_init_data(user_id: int, now: int) -> str:
+    fields = {
+        "query_id": f"AAH{user_id}",
+        "user": json.dumps({"id": user_id, "first_name": "Гравець", "username": f"player{user_id}"}, ensure_ascii=False),
+        "auth_date": str(now),
+    }
+    check_string = "\n".join(f"{key}={fields[key]}" for key in sorted(fields))
+    fields["hash"] = hmac.new(session_auth.init_data_secret(BOT_TOKEN), check_string.encode(), hashlib.sha256).hexdigest()
+    return urllib.parse.urlencode(fields)
+
+
+def time_calls(call, items) -> list[float]:
+    timings = []
+    for item in items:
+        started = time.perf_counter()
+        call(item)
+        timings.append(time.perf_counter() - started)
+    return sorted(timings)
+
+
+def report(name: str, timings: list[float]):
+    p99 = timings[int(len(timings) * 0.99) - 1]
+    print(f"{name:<22} p50={statistics.median(timings) * 1e6:6.1f}us p99={p99 * 1e6:6.1f}us")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=100000, help='Cached checks to time')
+    args = parser.parse_args()
+
+    now = int(time.time())
+    secret = session_auth.init_data_secret(BOT_TOKEN)
+    init_data = [signed_init_data(500000000 + i, now) for i in range(args.users)]
+    report("initData sign-in", time_calls(lambda data: session_auth.validate_init_data(data, secret, 86400), init_data))
+
+    tokens = [session_auth.issue_token(SESSION_SECRET, 500000000 + i, 86400)[0] for i in range(args.users)]
+    verifier = session_auth.SessionVerifier(SESSION_SECRET, max_entries=args.users)
+    report("token, HMAC check", time_calls(verifier.verify, tokens))
+    hot = [tokens[i % len(tokens)] for i in range(args.requests)]
+    report("token, cached", time_calls(verifier.verify, hot))
+
+
+if __name__ == '__main__':
+    main()
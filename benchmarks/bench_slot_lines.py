@@ -0,0 +1,54 @@
+"""Spin latency and return to player of the 5-reel line slot.
+
+Times slot_machine.spin for 1, 10 and 25 lines, and estimates the return to player
+over many 25-line spins.
+
+    python benchmarks/bench_slot_lines.py --spins 200000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import slot_machine  # noqa: E402
+
+
+def time_spins(lines: int, spins: int) -> list[float]:
+    rng = random.Random(lines)
+    timings = []
+    for _ in range(spins):
+        started = time.perf_counter()
+        slot_machine.spin(rng, lines, 1)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--spins', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    for lines in (1, 10, slot_machine.MAX_LINES):
+        timings = sorted(time_spins(lines, min(args.spins, 20000)))
+        p99 = timings[int(len(timings) * 0.99) - 1]
+        print(f"{lines:>2} lines: p50={statistics.median(timings) * 1e6:.0f}us p99={p99 * 1e6:.0f}us")
+
+    rng = random.Random(args.seed)
+    bet = line_win = scatter_win = hits = 0
+    for _ in range(args.spins):
+        result = slot_machine.spin(rng, slot_machine.MAX_LINES, 1)
+        bet += result.total_bet
+        line_win += result.total_win - result.scatter_win
+        scatter_win += result.scatter_win
+        hits += result.total_win > 0
+    print(f"RTP over {args.spins} spins: {(line_win + scatter_win) / bet:.2%} "
+          f"(lines {line_win / bet:.2%}, scatters {scatter_win / bet:.2%}), hit rate {hits / args.spins:.1%}")
+
+
+if __name__ == '__main__':
+    main()
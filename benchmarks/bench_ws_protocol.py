@@ -0,0 +1,88 @@
+"""Bytes per room-minute for each WebSocket wire format.
+
+Replays one minute of a busy 4-player room (start countdown, betting countdown,
+turns with per-second timer frames, dealer play) through every codec, raw and with
+permessage-deflate (raw DEFLATE with context takeover, as browsers negotiate it).
+
+    python benchmarks/bench_ws_protocol.py
+"""
+import os
+import random
+import sys
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wire_protocol  # noqa: E402
+from wire_protocol import CARD_RANKS, CARD_SUITS  # noqa: E402
+
+PLAYERS = 4
+
+
+def room_minute_frames(seed: int = 7) -> list[dict]:
+    rng = random.Random(seed)
+    deck = [f"{rank}{suit}" for rank in CARD_RANKS for suit in CARD_SUITS]
+    rng.shuffle(deck)
+    players = [
+        {"user_id": 500000000 + i, "username": f"Гравець {1000 + i}", "hand": [], "score": 0,
+         "bet": 0, "is_playing": True, "has_bet": False}
+        for i in range(PLAYERS)
+    ]
+    frames = []
+
+    def frame(status, timer, dealer_hand=(), turn=None):
+        frames.append({
+            "room_id": "3f9a1c2b", "status": status, "dealer_hand": list(dealer_hand),
+            "dealer_score": 10 if dealer_hand else 0,
+            "players": [dict(p, hand=list(p["hand"])) for p in players],
+            "current_player_turn": turn, "player_count": PLAYERS, "min_players": 2,
+            "max_players": PLAYERS, "timer": timer
+        })
+
+    for timer in range(20, 0, -1):
+        frame("starting_timer", timer)
+    for timer in range(20, 0, -1):
+        if timer % 5 == 0:
+            bettor = players[timer // 5 - 1]
+            bettor["bet"], bettor["has_bet"] = 100, True
+        frame("betting", timer)
+    for p in players:
+        p["hand"] = [deck.pop(), deck.pop()]
+    dealer = [deck.pop(), "Hidden"]
+    for p in players:
+        for timer in range(15, 10, -1):
+            frame("playing", timer, dealer, p["user_id"])
+        p["hand"].append(deck.pop())
+        frame("playing", 10, dealer, p["user_id"])
+    for _ in range(3):
+        dealer = [card for card in dealer if card != "Hidden"] + [deck.pop()]
+        frame("round_end", 0, dealer)
+    return frames
+
+
+def deflated_size(payloads: list) -> int:
+    compressor = zlib.compressobj(wbits=-15)
+    total = 0
+    for payload in payloads:
+        data = payload if isinstance(payload, bytes) else payload.encode("utf-8")
+        total += len(compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)) - 4 # Trailing 00 00 ff ff is stripped on the wire
+    return total
+
+
+def main():
+    frames = room_minute_frames()
+    print(f"{len(frames)} state frames per room-minute, per connected player\n")
+    print(f"{'protocol':<20}{'raw bytes':>12}{'% of json':>11}{'deflate bytes':>16}{'% of json':>11}")
+    baseline = None
+    for name, codec in wire_protocol.CODECS.items():
+        payloads = [codec.encode(f) for f in frames]
+        raw = sum(len(p if isinstance(p, bytes) else p.encode("utf-8")) for p in payloads)
+        deflated = deflated_size(payloads)
+        baseline = baseline or raw
+        print(f"{name:<20}{raw:>12}{raw / baseline:>11.0%}{deflated:>16}{deflated / baseline:>11.1%}")
+    if wire_protocol.msgpack is None:
+        print("\nmsgpack is not installed; casino.msgpack.v1 was skipped.")
+
+
+if __name__ == "__main__":
+    main()
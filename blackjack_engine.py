@@ -0,0 +1,301 @@
+"""Blackjack table rules as a pure, synchronous state machine.
+
+No sockets, no clocks, no database: the engine only changes state and reports
+outcomes. `main.BlackjackRoom` adapts it to WebSockets and timers, and
+`blackjack_sim.py` drives it headlessly with bots.
+
+Phases (`status`): waiting -> starting_timer -> betting -> playing -> round_end -> waiting.
+"""
+import random
+import secrets
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+CARD_RANKS = ['2', '3', '4', '5', '6', '7', '8', '9', '10', 'J', 'Q', 'K', 'A']
+CARD_SUITS = ['♠', '♦', '♥', '♣']
+UP_CARD_INDEX = 0 # The dealer's first card is dealt face up...
+HOLE_CARD_INDEX = 1 # ...and the second face down until the dealer plays
+
+
+class Card:
+    def __init__(self, rank, suit):
+        self.rank = rank
+        self.suit = suit
+        self.value = self._get_value()
+
+    def _get_value(self):
+        if self.rank in ['J', 'Q', 'K']:
+            return 10
+        elif self.rank == 'A':
+            return 11 # Ace can be 1 or 11, handle in hand logic
+        else:
+            return int(self.rank)
+
+    def __str__(self):
+        return f"{self.rank}{self.suit}"
+
+    def __repr__(self):
+        return self.__str__()
+
+# Cards never change, so every deck is built from the same 52 instances
+FULL_DECK = tuple(Card(rank, suit) for rank in CARD_RANKS for suit in CARD_SUITS)
+
+ShoeSource = Callable[[], tuple[int, List[int]]]
+
+def shuffle_shoe(seed: int) -> List[int]:
+    """Card order (indexes into FULL_DECK) for a shoe; the same seed always gives the same order."""
+    order = list(range(len(FULL_DECK)))
+    random.Random(seed).shuffle(order)
+    return order
+
+def fresh_shoe() -> tuple[int, List[int]]:
+    seed = secrets.randbits(64)
+    return seed, shuffle_shoe(seed)
+
+class Deck:
+    def __init__(self, shoe_source: ShoeSource = fresh_shoe):
+        self.cards = [] # Filled lazily, so creating a deck never shuffles
+        self.seed: Optional[int] = None
+        self.shoe_source = shoe_source
+        self.reshuffles = 0
+
+    def reset(self):
+        self.seed, order = self.shoe_source()
+        self.cards = [FULL_DECK[i] for i in order]
+
+    def deal_card(self):
+        if not self.cards:
+            self.reset() # Reshuffle if deck is empty
+            self.reshuffles += 1
+        return self.cards.pop()
+
+
+class BlackjackPlayer:
+    def __init__(self, user_id: int, username: str):
+        self.user_id = user_id
+        self.username = username
+        self.hand: List[Card] = []
+        self.score = 0
+        self.bet = 0
+        self.is_playing = True # True if player takes part in the current round
+        self.has_bet = False # True if player has placed a bet for the current round
+        self.is_finished = False # Stood or went bust; no more actions this round
+
+    def add_card(self, card: Card):
+        self.hand.append(card)
+        self._calculate_score()
+
+    def _calculate_score(self):
+        self.score = sum(card.value for card in self.hand)
+        num_aces = sum(1 for card in self.hand if card.rank == 'A')
+        while self.score > 21 and num_aces > 0:
+            self.score -= 10 # Change Ace from 11 to 1
+            num_aces -= 1
+
+    def clear_hand(self):
+        self.hand = []
+        self.score = 0
+        self.bet = 0
+        self.is_playing = True # Reset for next round
+        self.has_bet = False # Reset for next round
+        self.is_finished = False
+
+    def to_dict(self, hide_dealer_card=False):
+        hand_display = [str(card) for card in self.hand]
+        if hide_dealer_card and self.username == "Dealer" and len(hand_display) > 1:
+            hand_display[HOLE_CARD_INDEX] = "Hidden"
+        return {
+            "user_id": self.user_id,
+            "username": self.username,
+            "hand": hand_display,
+            "score": self.score,
+            "bet": self.bet,
+            "is_playing": self.is_playing,
+            "has_bet": self.has_bet
+        }
+
+
+class InvalidAction(Exception):
+    """An action that is not allowed in the current state; the message is shown to the player."""
+
+
+@dataclass
+class RoundOutcome:
+    user_id: int
+    message: str
+    winnings: int # Amount credited back (the bet was taken when it was placed)
+    xp_gain: int
+    final_score: int
+    participated: bool
+
+
+class BlackjackEngine:
+    def __init__(self, min_players: int = 2, max_players: int = 4, shoe_source: ShoeSource = fresh_shoe):
+        self.min_players = min_players
+        self.max_players = max_players
+        self.players: Dict[int, BlackjackPlayer] = {} # user_id -> BlackjackPlayer, in seat order
+        self.dealer = BlackjackPlayer(user_id=0, username="Dealer") # Dealer is a special player
+        self.deck = Deck(shoe_source)
+        self.status = "waiting"
+        self.current_player_turn: Optional[int] = None
+        self.round_in_progress = False
+        self.dealer_revealed = False # Show the dealer's hole card
+        self.round_number = 0
+
+    # --- Seats ---
+    def add_player(self, user_id: int, username: str) -> bool:
+        player = self.players.get(user_id)
+        if player:
+            player.username = username # Rejoining keeps the seat and any bet in play
+            return True
+        if len(self.players) >= self.max_players:
+            return False
+        player = BlackjackPlayer(user_id, username)
+        if self.round_in_progress:
+            player.is_playing = False # Joins at the next round
+        self.players[user_id] = player
+        return True
+
+    def remove_player(self, user_id: int):
+        if self.players.pop(user_id, None) is None:
+            return
+        if self.status == "playing" and self.current_player_turn == user_id:
+            self._advance_turn(user_id)
+
+    # --- Phases ---
+    def can_start_countdown(self) -> bool:
+        return self.status == "waiting" and len(self.players) >= self.min_players
+
+    def start_countdown(self):
+        self.status = "starting_timer"
+
+    def open_betting(self):
+        self.status = "betting"
+
+    def check_bet(self, user_id: int, amount: int) -> BlackjackPlayer:
+        """Raises InvalidAction if the bet can't be placed; callers check the wallet in between."""
+        player = self.players.get(user_id)
+        if not player or self.status != "betting" or player.has_bet:
+            raise InvalidAction("Неправильний стан для ставки або ставка вже зроблена.")
+        if amount <= 0:
+            raise InvalidAction("Ставка має бути більшою за нуль.")
+        return player
+
+    def place_bet(self, user_id: int, amount: int):
+        player = self.check_bet(user_id, amount)
+        player.bet = amount
+        player.has_bet = True
+
+    def all_bets_in(self) -> bool:
+        """Betting can close early: at least min_players are playing and all of them have bet."""
+        active_players = [p for p in self.players.values() if p.is_playing]
+        return len(active_players) >= self.min_players and all(p.has_bet for p in active_players)
+
+    def close_betting(self) -> bool:
+        """Benches everyone who didn't bet. Returns False if fewer than min_players bet, in which
+        case the round doesn't start (the same rule as all_bets_in)."""
+        for player in self.players.values():
+            if not player.has_bet:
+                player.is_playing = False
+        return sum(p.is_playing for p in self.players.values()) >= self.min_players
+
+    def start_round(self):
+        self.status = "playing"
+        self.round_in_progress = True
+        self.round_number += 1
+        self.dealer.clear_hand()
+        self.dealer_revealed = False
+        self.deck.reset()
+
+        # Initial deal
+        for _ in range(2):
+            for player in self.players.values():
+                if player.is_playing: # Only deal to active players
+                    player.add_card(self.deck.deal_card())
+            self.dealer.add_card(self.deck.deal_card())
+
+        self.current_player_turn = None
+        self._advance_turn(None)
+
+    def hit(self, user_id: int) -> BlackjackPlayer:
+        player = self._player_on_turn(user_id)
+        player.add_card(self.deck.deal_card())
+        if player.score > 21:
+            player.is_finished = True
+            self._advance_turn(user_id)
+        return player
+
+    def stand(self, user_id: int) -> BlackjackPlayer:
+        player = self._player_on_turn(user_id)
+        player.is_finished = True
+        self._advance_turn(user_id)
+        return player
+
+    def dealer_step(self) -> bool:
+        """Deals the dealer one card if the dealer must hit. Returns False once the dealer stands."""
+        if self.dealer.score < 17:
+            self.dealer.add_card(self.deck.deal_card())
+            return True
+        return False
+
+    def dealer_up_card(self) -> Card:
+        return self.dealer.hand[UP_CARD_INDEX]
+
+    def dealer_view(self) -> tuple[List[str], int]:
+        """The dealer's hand and score as players may see them: the hole card stays hidden
+        (and out of the score) until the dealer plays."""
+        if self.dealer_revealed or len(self.dealer.hand) < 2:
+            return [str(card) for card in self.dealer.hand], self.dealer.score
+        return self.dealer.to_dict(hide_dealer_card=True)["hand"], self.dealer_up_card().value
+
+    def play_dealer(self):
+        while self.dealer_step():
+            pass
+
+    def settle(self) -> List[RoundOutcome]:
+        outcomes = []
+        dealer_score = self.dealer.score
+        for user_id, player in self.players.items():
+            if not player.is_playing:
+                # Didn't bet this round: nothing to pay out
+                outcomes.append(RoundOutcome(user_id, "Ви не брали участь у раунді.", 0, 0, player.score, False))
+            elif player.score > 21:
+                outcomes.append(RoundOutcome(user_id, "Перебір! Ви програли.", 0, 0, player.score, True))
+            elif dealer_score > 21:
+                outcomes.append(RoundOutcome(user_id, "Дилер перебрав! Ви виграли!", player.bet * 2, 10, player.score, True))
+            elif player.score > dealer_score:
+                outcomes.append(RoundOutcome(user_id, "Ви виграли у дилера!", player.bet * 2, 10, player.score, True))
+            elif player.score < dealer_score:
+                outcomes.append(RoundOutcome(user_id, "Ви програли дилеру.", 0, 2, player.score, True)) # Small XP for participation
+            else:
+                outcomes.append(RoundOutcome(user_id, "Нічия! Ваша ставка повернена.", player.bet, 5, player.score, True))
+        return outcomes
+
+    def finish_round(self):
+        for player in self.players.values():
+            player.clear_hand()
+        self.dealer.clear_hand()
+        self.dealer_revealed = False
+        self.round_in_progress = False
+        self.current_player_turn = None
+        self.status = "waiting"
+
+    # --- Internals ---
+    def _player_on_turn(self, user_id: int) -> BlackjackPlayer:
+        player = self.players.get(user_id)
+        if not player or self.status != "playing" or self.current_player_turn != user_id:
+            raise InvalidAction("Зараз не ваш хід або гра не в стані 'playing'.")
+        return player
+
+    def _advance_turn(self, after_user_id: Optional[int]):
+        """Passes the turn to the next seat still to act, or hands over to the dealer."""
+        seats = list(self.players)
+        start = seats.index(after_user_id) + 1 if after_user_id in self.players else 0
+        for user_id in seats[start:] + seats[:start]:
+            player = self.players[user_id]
+            if player.is_playing and not player.is_finished:
+                self.current_player_turn = user_id
+                return
+        self.current_player_turn = None
+        self.status = "round_end"
+        self.dealer_revealed = True
@@ -0,0 +1,112 @@
+"""Plays Blackjack rounds headlessly with bots, straight against BlackjackEngine.
+
+No server, no sockets, no timers, no database: useful for checking the rules and
+payouts, and for measuring how many rounds per second the engine can settle.
+
+    python blackjack_sim.py --rounds 100000 --players 4 --strategy basic --seed 1
+"""
+import argparse
+import random
+import time
+from typing import Callable, Dict
+
+from blackjack_engine import BlackjackEngine, BlackjackPlayer, shuffle_shoe
+
+BET = 100
+
+# A strategy looks at the bot's hand and the dealer's up card value and returns True to hit
+Strategy = Callable[[BlackjackPlayer, int, random.Random], bool]
+
+
+def stand_strategy(player: BlackjackPlayer, dealer_up: int, rng: random.Random) -> bool:
+    return False
+
+
+def random_strategy(player: BlackjackPlayer, dealer_up: int, rng: random.Random) -> bool:
+    return rng.random() < 0.5
+
+
+def basic_strategy(player: BlackjackPlayer, dealer_up: int, rng: random.Random) -> bool:
+    """Hard-total basic strategy without doubles or splits (the table doesn't offer them)."""
+    if player.score <= 11:
+        return True
+    if player.score == 12:
+        return dealer_up not in (4, 5, 6)
+    if player.score <= 16:
+        return dealer_up >= 7
+    return False
+
+
+STRATEGIES: Dict[str, Strategy] = {
+    "random": random_strategy,
+    "basic": basic_strategy,
+    "stand": stand_strategy,
+}
+
+
+def run(rounds: int, players: int, strategy: Strategy, seed: int) -> dict:
+    rng = random.Random(seed)
+
+    def shoe_source():
+        shoe_seed = rng.getrandbits(64)
+        return shoe_seed, shuffle_shoe(shoe_seed)
+
+    engine = BlackjackEngine(min_players=1, max_players=players, shoe_source=shoe_source)
+    for user_id in range(1, players + 1):
+        engine.add_player(user_id, f"bot{user_id}")
+
+    totals = {"hands": 0, "wagered": 0, "returned": 0, "wins": 0, "pushes": 0, "losses": 0, "busts": 0}
+    started = time.perf_counter()
+    for _ in range(rounds):
+        engine.start_countdown()
+        engine.open_betting()
+        for user_id in engine.players:
+            engine.place_bet(user_id, BET)
+        engine.close_betting()
+        engine.start_round()
+
+        dealer_up = engine.dealer_up_card().value # Bots see only what players see
+        while engine.status == "playing":
+            user_id = engine.current_player_turn
+            if strategy(engine.players[user_id], dealer_up, rng):
+                engine.hit(user_id)
+            else:
+                engine.stand(user_id)
+        engine.play_dealer()
+
+        for outcome in engine.settle():
+            totals["hands"] += 1
+            totals["wagered"] += BET
+            totals["returned"] += outcome.winnings
+            if outcome.final_score > 21:
+                totals["busts"] += 1
+            if outcome.winnings > BET:
+                totals["wins"] += 1
+            elif outcome.winnings == BET:
+                totals["pushes"] += 1
+            else:
+                totals["losses"] += 1
+        engine.finish_round()
+    totals["elapsed"] = time.perf_counter() - started
+    totals["reshuffles"] = engine.deck.reshuffles
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=10000)
+    parser.add_argument("--players", type=int, default=4)
+    parser.add_argument("--strategy", default="basic", choices=sorted(STRATEGIES))
+    parser.add_argument("--seed", type=int, default=0, help="Same seed, same cards, same result")
+    args = parser.parse_args()
+
+    t = run(args.rounds, args.players, STRATEGIES[args.strategy], args.seed)
+    hands = t["hands"] or 1
+    print(f"{args.rounds} rounds x {args.players} bots ({args.strategy}) in {t['elapsed']:.2f}s "
+          f"-> {args.rounds / t['elapsed']:.0f} rounds/sec")
+    print(f"win {t['wins'] / hands:.1%}  push {t['pushes'] / hands:.1%}  lose {t['losses'] / hands:.1%}  bust {t['busts'] / hands:.1%}")
+    print(f"return to player {t['returned'] / t['wagered']:.2%}, mid-round reshuffles {t['reshuffles']}")
+
+
+if __name__ == "__main__":
+    main()
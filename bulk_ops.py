@@ -0,0 +1,255 @@
+"""Bulk wallet operations: promotional grants, season resets and re-levelling.
+
+Streams a set of users from a SQL query or a CSV file and applies the operation in
+batches. Each batch is one transaction: the batch is COPYed into a temp table and
+applied with a single set-based UPDATE. Progress is stored in the bulk_op_progress
+table in that same transaction, so an interrupted run resumes exactly where it
+stopped (re-run with the same --op-id) without applying any batch twice.
+
+    python bulk_ops.py grant --amount 500 --xp 10 --query "SELECT user_id FROM users WHERE level >= 5" --op-id spring-promo
+    python bulk_ops.py grant --csv winners.csv --op-id tournament-7    # CSV: user_id[,amount[,xp]]
+    python bulk_ops.py reset --balance 10000 --query "SELECT user_id FROM users" --op-id season-3
+    python bulk_ops.py relevel --query "SELECT user_id FROM users" --op-id thresholds-2024
+
+Use --batch-size, --sleep-ms and --max-rows-per-sec to keep the live API responsive.
+"""
+import argparse
+import csv
+import hashlib
+import io
+import sys
+import time
+from typing import Iterator, List, Optional, Tuple
+
+from psycopg2 import errors, sql
+
+from main import LEVEL_THRESHOLDS, get_db_connection
+
+Row = Tuple[int, int, int] # (user_id, amount, xp)
+
+APPLY_SQL = {
+    'grant': """
+        UPDATE users AS u
+        SET balance = u.balance + b.amount,
+            xp = u.xp + b.xp,
+            level = GREATEST(u.level, (
+                SELECT COUNT(*) FROM unnest({thresholds}::int[]) AS t(min_xp) WHERE t.min_xp <= u.xp + b.xp
+            ))
+        FROM bulk_batch AS b
+        WHERE u.user_id = b.user_id
+    """,
+    'reset': """
+        UPDATE users AS u
+        SET balance = b.amount, xp = b.xp, level = 1,
+            last_daily_bonus_claim = NULL, last_quick_bonus_claim = NULL
+        FROM bulk_batch AS b
+        WHERE u.user_id = b.user_id
+    """,
+    # Exact level for the current thresholds; may lower levels if thresholds went up
+    'relevel': """
+        UPDATE users AS u
+        SET level = GREATEST(1, (
+            SELECT COUNT(*) FROM unnest({thresholds}::int[]) AS t(min_xp) WHERE t.min_xp <= u.xp
+        ))
+        FROM bulk_batch AS b
+        WHERE u.user_id = b.user_id
+    """,
+}
+
+
+def ensure_progress_table():
+    conn = get_db_connection()
+    try:
+        conn.cursor().execute("""
+            CREATE TABLE IF NOT EXISTS bulk_op_progress (
+                op_id TEXT PRIMARY KEY,
+                operation TEXT NOT NULL,
+                rows_done BIGINT NOT NULL DEFAULT 0,
+                last_user_id BIGINT,
+                finished BOOLEAN NOT NULL DEFAULT FALSE,
+                updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+            );
+        """)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def load_progress(op_id: str, operation: str) -> Tuple[int, Optional[int], bool]:
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT operation, rows_done, last_user_id, finished FROM bulk_op_progress WHERE op_id = %s', (op_id,))
+        row = cur.fetchone()
+    finally:
+        conn.close()
+    if not row:
+        return 0, None, False
+    if row[0] != operation:
+        raise SystemExit(f"op-id {op_id!r} belongs to a '{row[0]}' run, not '{operation}'.")
+    return row[1], row[2], row[3]
+
+
+def query_source(query: str, args, after_user_id: Optional[int]) -> Iterator[Row]:
+    """Streams (user_id, ...) rows through a server-side cursor, ordered by user_id so runs can resume."""
+    conn = get_db_connection(read_only=True)
+    try:
+        cur = conn.cursor(name='bulk_ops_source')
+        cur.itersize = args.batch_size
+        cur.execute(
+            sql.SQL('SELECT * FROM ({query}) AS src WHERE src.user_id > %s ORDER BY src.user_id').format(query=sql.SQL(query)),
+            (after_user_id if after_user_id is not None else -2**63,)
+        )
+        for record in cur:
+            yield row_from(record, args)
+    finally:
+        conn.close()
+
+
+def csv_source(path: str, args, skip_rows: int) -> Iterator[Row]:
+    with open(path, newline='', encoding='utf-8') as f:
+        data_rows = 0
+        for record in csv.reader(f):
+            if not record or not record[0].strip().lstrip('-').isdigit():
+                continue # Blank line or header
+            data_rows += 1
+            if data_rows > skip_rows:
+                yield row_from(record, args)
+
+
+def row_from(record, args) -> Row:
+    user_id = int(record[0])
+    amount = int(record[1]) if len(record) > 1 and record[1] not in (None, '') else args.amount
+    xp = int(record[2]) if len(record) > 2 and record[2] not in (None, '') else args.xp
+    return user_id, amount, xp
+
+
+def batches(rows: Iterator[Row], size: int) -> Iterator[List[Row]]:
+    batch: List[Row] = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def apply_batch(conn, args, batch: List[Row], rows_done: int) -> int:
+    """Applies one batch and records progress in the same transaction. Returns users updated."""
+    cur = conn.cursor()
+    cur.execute("SET LOCAL lock_timeout = %s", (f"{args.lock_timeout_ms}ms",)) # Back off rather than queue behind live writes
+    cur.execute("CREATE TEMP TABLE bulk_batch (user_id BIGINT PRIMARY KEY, amount INTEGER, xp INTEGER) ON COMMIT DROP")
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    seen = set()
+    for user_id, amount, xp in batch:
+        if user_id not in seen: # First occurrence wins; a CSV listing a user twice shouldn't abort the batch
+            seen.add(user_id)
+            writer.writerow((user_id, amount, xp))
+    buffer.seek(0)
+    cur.copy_expert("COPY bulk_batch (user_id, amount, xp) FROM STDIN WITH (FORMAT csv)", buffer)
+    cur.execute(sql.SQL(APPLY_SQL[args.operation]).format(thresholds=sql.Literal(sorted(LEVEL_THRESHOLDS.values()))))
+    updated = cur.rowcount
+    cur.execute("""
+        INSERT INTO bulk_op_progress (op_id, operation, rows_done, last_user_id, updated_at)
+        VALUES (%s, %s, %s, %s, NOW())
+        ON CONFLICT (op_id) DO UPDATE SET rows_done = EXCLUDED.rows_done, last_user_id = EXCLUDED.last_user_id, updated_at = NOW()
+    """, (args.op_id, args.operation, rows_done + len(batch), batch[-1][0]))
+    if args.dry_run:
+        conn.rollback()
+    else:
+        conn.commit()
+    return updated
+
+
+def mark_finished(op_id: str):
+    conn = get_db_connection()
+    try:
+        conn.cursor().execute('UPDATE bulk_op_progress SET finished = TRUE, updated_at = NOW() WHERE op_id = %s', (op_id,))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def run(args) -> int:
+    ensure_progress_table()
+    rows_done, last_user_id, finished = load_progress(args.op_id, args.operation)
+    if finished:
+        print(f"{args.op_id}: already finished ({rows_done} rows). Use a new --op-id to run again.")
+        return 0
+    if rows_done:
+        print(f"{args.op_id}: resuming after {rows_done} rows (last user_id {last_user_id}).")
+
+    if args.query:
+        rows = query_source(args.query, args, last_user_id)
+    else:
+        rows = csv_source(args.csv, args, rows_done)
+
+    conn = get_db_connection()
+    started = time.monotonic()
+    processed = updated = 0
+    try:
+        for batch in batches(rows, args.batch_size):
+            for attempt in range(1, args.retries + 1):
+                try:
+                    updated += apply_batch(conn, args, batch, rows_done + processed)
+                    break
+                except errors.LockNotAvailable:
+                    conn.rollback()
+                    print(f"  batch at row {rows_done + processed}: lock timeout, retry {attempt}/{args.retries}", file=sys.stderr)
+                    time.sleep(args.sleep_ms / 1000 * attempt)
+            else:
+                print(f"Giving up after {args.retries} lock timeouts; re-run with --op-id {args.op_id} to resume.", file=sys.stderr)
+                return 1
+            processed += len(batch)
+
+            elapsed = time.monotonic() - started
+            rate = processed / elapsed if elapsed else 0
+            print(f"{args.op_id}: {rows_done + processed} rows ({updated} users updated), {rate:.0f} rows/s")
+
+            # Throttle: a fixed pause between batches, and a ceiling on the overall rate
+            pause = args.sleep_ms / 1000
+            if args.max_rows_per_sec:
+                pause = max(pause, processed / args.max_rows_per_sec - elapsed)
+            if pause > 0:
+                time.sleep(pause)
+    finally:
+        conn.close()
+
+    if args.dry_run:
+        print(f"Dry run: {processed} rows checked, nothing committed.")
+    else:
+        mark_finished(args.op_id)
+        print(f"{args.op_id}: done, {rows_done + processed} rows in {time.monotonic() - started:.1f}s.")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('operation', choices=sorted(APPLY_SQL))
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--query', help='SQL returning user_id (optionally amount, xp) per row')
+    source.add_argument('--csv', help='CSV file of user_id[,amount[,xp]]')
+    parser.add_argument('--amount', type=int, default=0, help='grant: coins added; reset: new balance')
+    parser.add_argument('--xp', type=int, default=0, help='grant: XP added; reset: new XP')
+    parser.add_argument('--balance', type=int, help='reset: alias for --amount')
+    parser.add_argument('--op-id', help='Names the run for resuming; defaults to a hash of the arguments')
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--sleep-ms', type=int, default=100, help='Pause between batches')
+    parser.add_argument('--max-rows-per-sec', type=int, default=0, help='0 = unlimited')
+    parser.add_argument('--lock-timeout-ms', type=int, default=2000)
+    parser.add_argument('--retries', type=int, default=5)
+    parser.add_argument('--dry-run', action='store_true', help='Apply every batch, then roll it back')
+    args = parser.parse_args()
+
+    if args.balance is not None:
+        args.amount = args.balance
+    if not args.op_id:
+        fingerprint = repr((args.operation, args.query, args.csv, args.amount, args.xp))
+        args.op_id = f"{args.operation}-{hashlib.sha1(fingerprint.encode()).hexdigest()[:10]}"
+    sys.exit(run(args))
+
+
+if __name__ == '__main__':
+    main()
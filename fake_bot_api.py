@@ -0,0 +1,105 @@
+"""Local stand-in for the Telegram Bot API, for exercising notifications offline.
+
+Accepts any token, records every sendMessage, and enforces Telegram-like limits:
+more than --global-rate messages per second overall, or more than one per second to
+a single chat, gets a 429 with parameters.retry_after. Chats listed with --blocked
+answer 403 as if the user had blocked the bot.
+
+    python fake_bot_api.py --port 8081
+    TELEGRAM_API_SERVER=http://localhost:8081 BOT_TOKEN=123:fake python main.py
+
+GET /stats returns what was delivered and rejected so far.
+"""
+import argparse
+import time
+from collections import defaultdict, deque
+
+from aiohttp import web
+
+
+class FakeBotApi:
+    def __init__(self, global_rate: int, retry_after: int, blocked: set):
+        self.global_rate = global_rate
+        self.retry_after = retry_after
+        self.blocked = blocked
+        self.recent = deque() # Timestamps of accepted messages, last second only
+        self.last_to_chat = {}
+        self.message_id = 0
+        self.delivered = defaultdict(list) # chat_id -> texts
+        self.rejected = defaultdict(int) # reason -> count
+
+    def _too_fast(self, chat_id: int, now: float) -> bool:
+        while self.recent and now - self.recent[0] >= 1:
+            self.recent.popleft()
+        if len(self.recent) >= self.global_rate:
+            self.rejected["global_rate"] += 1
+            return True
+        if now - self.last_to_chat.get(chat_id, 0) < 1:
+            self.rejected["chat_rate"] += 1
+            return True
+        return False
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post()) if request.can_read_body else {}
+        if method == "sendMessage":
+            return self.send_message(params)
+        if method == "getMe":
+            return self.ok({"id": 1, "is_bot": True, "first_name": "Fake Casino Bot", "username": "fake_casino_bot"})
+        if method == "getWebhookInfo":
+            return self.ok({"url": "", "has_custom_certificate": False, "pending_update_count": 0})
+        if method in ("setWebhook", "deleteWebhook"):
+            return self.ok(True)
+        return web.json_response({"ok": False, "error_code": 404, "description": f"Not Found: method {method}"}, status=404)
+
+    def send_message(self, params: dict) -> web.Response:
+        chat_id = int(params["chat_id"])
+        if chat_id in self.blocked:
+            self.rejected["blocked"] += 1
+            return web.json_response({"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}, status=403)
+        now = time.monotonic()
+        if self._too_fast(chat_id, now):
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after}
+            }, status=429)
+        self.recent.append(now)
+        self.last_to_chat[chat_id] = now
+        self.message_id += 1
+        self.delivered[chat_id].append(params.get("text", ""))
+        return self.ok({
+            "message_id": self.message_id, "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", "")
+        })
+
+    @staticmethod
+    def ok(result) -> web.Response:
+        return web.json_response({"ok": True, "result": result})
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "messages": self.message_id,
+            "chats": len(self.delivered),
+            "rejected": dict(self.rejected),
+            "delivered": {str(chat_id): texts for chat_id, texts in self.delivered.items()},
+        })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--global-rate", type=int, default=30, help="Messages per second before 429s")
+    parser.add_argument("--retry-after", type=int, default=2, help="retry_after returned with 429s")
+    parser.add_argument("--blocked", type=int, nargs="*", default=[], help="chat ids that answer 403")
+    args = parser.parse_args()
+
+    api = FakeBotApi(args.global_rate, args.retry_after, set(args.blocked))
+    app = web.Application()
+    app.router.add_get("/stats", api.stats)
+    app.router.add_route("*", "/bot{token}/{method}", api.handle)
+    web.run_app(app, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
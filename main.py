@@ -5,13 +5,27 @@ import random
 import urllib.parse
 import asyncio
 import uuid
-from datetime import datetime, timedelta, timezone
-from typing import Dict, List, Optional, Any
+import time
+import secrets
+import hashlib
+import hmac
+import base64
+import gzip
+import math
+import fcntl
+import socket
+import sys
+import threading
+import traceback
+from collections import OrderedDict, defaultdict, deque
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Any, Callable, Awaitable
 
 import psycopg2
 from psycopg2 import sql
+from psycopg2.extras import execute_values
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Request
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Request, Header
 from fastapi.responses import HTMLResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel, Field
@@ -21,18 +35,375 @@ from aiogram.enums import ParseMode
 from aiogram.types import WebAppInfo, InlineKeyboardMarkup, InlineKeyboardButton, Message
 from aiogram.filters import CommandStart, Command
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
 
 from fastapi.middleware.cors import CORSMiddleware
 
+import session_auth
+import slot_machine
+import wire_protocol
+from blackjack_engine import BlackjackEngine, InvalidAction, shuffle_shoe
+
 # --- Налаштування логування ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# --- Metrics ---
+class Metrics:
+    """Minimal in-process counters, gauges and latency summaries, served at /api/metrics."""
+
+    def __init__(self, reservoir_size: int = 1024):
+        self.reservoir_size = reservoir_size
+        self.counters: Dict[tuple, float] = defaultdict(float)
+        self.gauges: Dict[tuple, float] = {}
+        self.samples: Dict[tuple, deque] = {}
+        self.sample_counts: Dict[tuple, int] = defaultdict(int)
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        self.counters[self._key(name, labels)] += value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = self._key(name, labels)
+        if key not in self.samples:
+            self.samples[key] = deque(maxlen=self.reservoir_size)
+        self.samples[key].append(value)
+        self.sample_counts[key] += 1
+
+    def forget(self, **labels):
+        """Drops gauges and summaries carrying the given labels (e.g. for a closed room)."""
+        wanted = set(labels.items())
+        for store in (self.gauges, self.samples, self.sample_counts):
+            for key in [k for k in store if wanted <= set(k[1])]:
+                del store[key]
+
+    @staticmethod
+    def percentile(sorted_values: list, q: float) -> float:
+        if not sorted_values:
+            return 0.0
+        index = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+        return sorted_values[index]
+
+    def snapshot(self) -> dict:
+        summaries = []
+        for (name, labels), values in self.samples.items():
+            ordered = sorted(values)
+            summaries.append({
+                "name": name, "labels": dict(labels), "count": self.sample_counts[(name, labels)],
+                "p50": self.percentile(ordered, 0.5), "p90": self.percentile(ordered, 0.9),
+                "p99": self.percentile(ordered, 0.99), "max": ordered[-1] if ordered else 0.0
+            })
+        return {
+            "counters": [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in self.counters.items()],
+            "gauges": [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in self.gauges.items()],
+            "summaries": summaries
+        }
+
+metrics = Metrics()
+
+# --- Rate Limiting ---
+class TokenBucket:
+    """`rate` tokens per second, bursts of up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def acquire_delay(self, tokens: float = 1) -> float:
+        """Takes `tokens` and returns 0 if they are available, else the seconds to wait before retrying."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return 0.0
+        return (tokens - self.tokens) / self.rate
+
+    async def acquire(self, tokens: float = 1):
+        while (delay := self.acquire_delay(tokens)) > 0:
+            await asyncio.sleep(delay)
+
+def _rate_limit_setting(name: str, default: str) -> tuple[float, float]:
+    """Reads RATE_LIMIT_<NAME> as "rate/burst", e.g. "5/10" for 5 per second with bursts of 10."""
+    rate, _, burst = os.getenv(f"RATE_LIMIT_{name.upper()}", default).partition("/")
+    return float(rate), float(burst or rate)
+
+# Per user and scope (HTTP endpoint or WebSocket action), then one ceiling for the whole worker
+USER_RATE_LIMITS: Dict[str, tuple[float, float]] = {
+    scope: _rate_limit_setting(scope, default) for scope, default in {
+        "spin": "5/10",
+        "spin_lines": "5/10",
+        "coin_flip": "5/10",
+        "claim_daily_bonus": "1/3",
+        "claim_quick_bonus": "1/3",
+        "ws_bet": "2/5",
+        "ws_hit": "5/10",
+        "ws_stand": "5/10",
+    }.items()
+}
+GLOBAL_RATE_LIMIT = _rate_limit_setting("global", "500/1000")
+RATE_LIMIT_MAX_BUCKETS = 100_000
+
+class RateLimiter:
+    """Token buckets keyed by (scope, user_id), evicted least recently used first.
+
+    A bucket that is evicted comes back full, which is what an idle user's bucket would
+    hold anyway. Rejections happen before any DB work.
+    """
+
+    def __init__(self, limits: Dict[str, tuple[float, float]], global_limit: tuple[float, float], max_buckets: int):
+        self.limits = limits
+        self.global_bucket = TokenBucket(*global_limit)
+        self.max_buckets = max_buckets
+        self.buckets: OrderedDict = OrderedDict()
+
+    def check(self, scope: str, user_id: int) -> tuple[float, Optional[str]]:
+        """Takes a token for `user_id` in `scope`. Returns (0, None) if allowed, else (retry_after, limit)."""
+        limit = self.limits.get(scope)
+        if limit:
+            key = (scope, user_id)
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(*limit)
+                if len(self.buckets) > self.max_buckets:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+            delay = bucket.acquire_delay()
+            if delay > 0:
+                metrics.inc("rate_limited", scope=scope, limit="user")
+                return delay, "user"
+        delay = self.global_bucket.acquire_delay()
+        if delay > 0:
+            metrics.inc("rate_limited", scope=scope, limit="global")
+            return delay, "global"
+        return 0.0, None
+
+rate_limiter = RateLimiter(USER_RATE_LIMITS, GLOBAL_RATE_LIMIT, RATE_LIMIT_MAX_BUCKETS)
+
+def rate_limit_message(retry_after: float) -> str:
+    return f"Забагато запитів. Спробуйте через {max(1, math.ceil(retry_after))} сек."
+
+def enforce_rate_limit(scope: str, user_id: int):
+    retry_after, _ = rate_limiter.check(scope, user_id)
+    if retry_after > 0:
+        raise HTTPException(
+            status_code=429,
+            detail={"error": "Too many requests", "message": rate_limit_message(retry_after), "retry_after": round(retry_after, 2)},
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+        )
+
+# --- Event Loop Watchdog ---
+# The psycopg2 calls are synchronous, so one slow query freezes every room in the worker.
+# A sampler task measures how late the loop wakes up; a thread watches the sampler's
+# heartbeat and, when it goes quiet for longer than the threshold, grabs the loop thread's
+# stack and the name of the task that is running (the endpoint or room command).
+LOOP_LAG_INTERVAL_SECONDS = int(os.getenv('LOOP_LAG_INTERVAL_MS', '100')) / 1000
+LOOP_STALL_THRESHOLD_SECONDS = int(os.getenv('LOOP_STALL_THRESHOLD_MS', '250')) / 1000
+
+class LoopWatchdog:
+    def __init__(self, interval: float, threshold: float, history: int = 20):
+        self.interval = interval
+        self.threshold = threshold
+        self.heartbeat = time.monotonic() # Written by the sampler, read by the watchdog thread
+        self.pending: deque = deque() # Stalls captured by the thread, not yet counted on the loop
+        self.recent: deque = deque(maxlen=history) # Latest stall reports, for /api/metrics/stalls
+        self.stopped = threading.Event()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.loop_thread_id: Optional[int] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.task = asyncio.create_task(self._sample(), name="loop-lag-sampler")
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.task:
+            self.task.cancel()
+
+    async def _sample(self):
+        while True:
+            started = time.monotonic()
+            self.heartbeat = started
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.monotonic() - started - self.interval)
+            metrics.observe("event_loop_lag_seconds", lag)
+            while self.pending: # The loop is back: the stall lasted about `lag`
+                stall = self.pending.popleft()
+                stall["blocked_seconds"] = round(lag, 3)
+                metrics.inc("event_loop_stalls", task=stall["task"])
+                logger.warning(f"Event loop was blocked for {lag * 1000:.0f}ms by {stall['task']}")
+
+    def _watch(self):
+        reported = None
+        while not self.stopped.wait(self.interval):
+            beat = self.heartbeat
+            if beat != reported and time.monotonic() - beat > self.interval + self.threshold:
+                reported = beat # One report per stall, however long it lasts
+                self._capture()
+
+    def _capture(self):
+        frame = sys._current_frames().get(self.loop_thread_id)
+        stack = "".join(traceback.format_stack(frame)) if frame else ""
+        task = asyncio.current_task(self.loop)
+        stall = {
+            "task": task.get_name() if task else "loop callback",
+            "at": datetime.now(timezone.utc).isoformat(),
+            "blocked_seconds": None, # Filled in once the loop resumes
+            "stack": stack,
+        }
+        self.pending.append(stall)
+        self.recent.append(stall)
+        logger.warning(f"Event loop stalled for over {self.threshold * 1000:.0f}ms in {stall['task']}:\n{stack}")
+
+class TaskNamingMiddleware:
+    """Names each request's task after its method and path, so stalls can be attributed."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] in ("http", "websocket"):
+            task = asyncio.current_task()
+            if task:
+                task.set_name(f"{scope.get('method', 'WS')} {scope['path']}")
+        await self.app(scope, receive, send)
+
+loop_watchdog = LoopWatchdog(LOOP_LAG_INTERVAL_SECONDS, LOOP_STALL_THRESHOLD_SECONDS)
+
+# --- Traffic Recording ---
+# Opt-in: with TRAFFIC_RECORD_PATH set, every /api/ request body and every message received on
+# /ws/ sockets is appended, with its time offset, to a gzipped JSON Lines file that replay.py
+# can play back against a local instance. Only inbound traffic is kept; run the replay with
+# the same RNG_SEED against a fresh database to get the same outcomes.
+TRAFFIC_RECORD_PATH = os.getenv('TRAFFIC_RECORD_PATH')
+TRAFFIC_RECORD_FLUSH_SECONDS = 1.0
+RECORDED_HEADERS = ("content-type", "idempotency-key") # Never credentials: replay.py signs its own session tokens
+UNRECORDED_QUERY_PARAMS = {"token"} # WebSocket session tokens
+
+class TrafficRecorder:
+    def __init__(self, path: str):
+        self.path = path
+        self.started = time.monotonic()
+        self.events: List[dict] = []
+        self.connections = 0
+        self.task: Optional[asyncio.Task] = None
+
+    def offset(self) -> float:
+        return round(time.monotonic() - self.started, 4)
+
+    def record(self, kind: str, t: Optional[float] = None, **fields):
+        self.events.append({"t": self.offset() if t is None else t, "k": kind, **fields})
+
+    def new_connection(self) -> int:
+        self.connections += 1
+        return self.connections
+
+    def start(self):
+        self.started = time.monotonic()
+        self.record("meta", version=1, started_at=datetime.now(timezone.utc).isoformat(), rng_seed=RNG_SEED)
+        self.task = asyncio.create_task(self._run(), name="traffic-recorder")
+        logger.info(f"Recording traffic to {self.path}")
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(TRAFFIC_RECORD_FLUSH_SECONDS)
+            await self.flush()
+
+    async def flush(self):
+        events, self.events = self.events, []
+        if events:
+            await asyncio.to_thread(self._write, events)
+            metrics.inc("traffic_events_recorded", len(events))
+
+    def _write(self, events: List[dict]):
+        # Each flush appends a gzip member; gzip readers see one continuous stream
+        with gzip.open(self.path, "at", encoding="utf-8") as f:
+            f.writelines(json.dumps(event, ensure_ascii=False, separators=(",", ":")) + "\n" for event in events)
+
+class TrafficRecordingMiddleware:
+    """Taps the ASGI receive channel; requests and sockets are otherwise untouched."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        recorder = traffic_recorder
+        path = scope.get("path", "")
+        if recorder is None or scope["type"] not in ("http", "websocket"):
+            return await self.app(scope, receive, send)
+
+        if scope["type"] == "http" and path.startswith("/api/"):
+            arrived = recorder.offset()
+            headers = {}
+            for name, value in scope["headers"]:
+                name = name.decode("latin-1")
+                if name in RECORDED_HEADERS:
+                    headers[name] = value.decode("latin-1")
+            chunks = []
+
+            async def recording_receive():
+                message = await receive()
+                if message["type"] == "http.request":
+                    chunks.append(message.get("body", b""))
+                    if not message.get("more_body"): # Recorded once the body is complete; bodiless GETs are skipped
+                        recorder.record("http", t=arrived, m=scope["method"], p=path, q=scope["query_string"].decode("latin-1"),
+                                        h=headers, b=b"".join(chunks).decode("utf-8", "replace"))
+                return message
+            return await self.app(scope, recording_receive, send)
+
+        if scope["type"] == "websocket" and path.startswith("/ws/"):
+            conn = recorder.new_connection()
+            query = urllib.parse.urlencode([
+                (name, value) for name, value in urllib.parse.parse_qsl(scope["query_string"].decode("latin-1"), keep_blank_values=True)
+                if name not in UNRECORDED_QUERY_PARAMS
+            ]) # Resume (room_id, last_seq) and buy_in parameters shape what the server does
+
+            async def recording_receive():
+                message = await receive()
+                if message["type"] == "websocket.connect":
+                    recorder.record("ws_open", c=conn, p=path, q=query, sp=scope.get("subprotocols", []))
+                elif message["type"] == "websocket.receive":
+                    if message.get("text") is not None:
+                        recorder.record("ws_in", c=conn, d=message["text"])
+                    elif message.get("bytes") is not None:
+                        recorder.record("ws_in", c=conn, b64=base64.b64encode(message["bytes"]).decode("ascii"))
+                return message
+            try:
+                return await self.app(scope, recording_receive, send)
+            finally:
+                recorder.record("ws_close", c=conn)
+
+        return await self.app(scope, receive, send)
+
+traffic_recorder = TrafficRecorder(TRAFFIC_RECORD_PATH) if TRAFFIC_RECORD_PATH else None
+
 # --- Змінні середовища ---
 API_TOKEN = os.getenv('BOT_TOKEN')
 WEB_APP_FRONTEND_URL = os.getenv('WEB_APP_FRONTEND_URL')
 WEBHOOK_HOST = os.getenv('RENDER_EXTERNAL_HOSTNAME')
 DATABASE_URL = os.getenv('DATABASE_URL')
+DATABASE_READ_URL = os.getenv('DATABASE_READ_URL') # Optional read replica for pure lookups
+TELEGRAM_API_SERVER = os.getenv('TELEGRAM_API_SERVER') # Defaults to https://api.telegram.org
 
 WEBAPP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "webapp")
 
@@ -52,6 +423,8 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(TaskNamingMiddleware)
+app.add_middleware(TrafficRecordingMiddleware)
 
 # Serve static files from the 'webapp' directory
 app.mount("/static", StaticFiles(directory=WEBAPP_DIR), name="static")
@@ -61,19 +434,22 @@ bot = None
 dp = None
 
 if API_TOKEN and API_TOKEN != "DUMMY_TOKEN":
-    bot = Bot(token=API_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    # TELEGRAM_API_SERVER points the bot at another Bot API server, e.g. fake_bot_api.py for offline tests
+    session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_SERVER)) if TELEGRAM_API_SERVER else None
+    bot = Bot(token=API_TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
     dp = Dispatcher()
 else:
     logger.warning("BOT_TOKEN is not set or is a dummy value. Telegram bot features will be disabled.")
 
 # --- Database Connection ---
-def get_db_connection():
+def get_db_connection(read_only: bool = False):
+    """Connection to the primary, or to DATABASE_READ_URL (if set) for read_only callers."""
     conn = None
     if not DATABASE_URL:
         logger.error("Attempted to connect to DB, but DATABASE_URL is not set.")
         raise ValueError("DATABASE_URL is not configured.")
     try:
-        url = urllib.parse.urlparse(DATABASE_URL)
+        url = urllib.parse.urlparse(DATABASE_READ_URL if read_only and DATABASE_READ_URL else DATABASE_URL)
         conn = psycopg2.connect(
             database=url.path[1:], user=url.username, password=url.password,
             host=url.hostname, port=url.port, sslmode='require', 
@@ -88,6 +464,23 @@ def get_db_connection():
         logger.error(f"Unexpected error during DB connection: {e}")
         raise
 
+# Defaults seeded into bonus_config on first start; the table is the source of truth afterwards
+DEFAULT_BONUS_CONFIG = {
+    'daily': {'amount': 500, 'xp_gain': 10, 'cooldown_seconds': 24 * 3600},
+    'quick': {'amount': 50, 'xp_gain': 2, 'cooldown_seconds': 15 * 60},
+}
+
+BONUS_READY_TEXT = {
+    'daily': "🎁 Щоденна винагорода знову доступна! Заходьте в казино, щоб її забрати.",
+    'quick': "⚡ Швидкий бонус знову доступний!",
+}
+
+# bonus_type -> column holding the timestamp of the last claim
+BONUS_CLAIM_COLUMNS = {
+    'daily': 'last_daily_bonus_claim',
+    'quick': 'last_quick_bonus_claim',
+}
+
 def init_db():
     conn = None
     try:
@@ -122,6 +515,102 @@ def init_db():
                 logger.info(f"Migration applied: {migration}")
             except Exception as e:
                 logger.warning(f"Migration failed (possibly already applied): {migration} - {e}")
+
+        # Bonus amounts and cooldowns live in the DB so they can be tuned without a deploy
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS bonus_config (
+                bonus_type TEXT PRIMARY KEY,
+                amount INTEGER NOT NULL,
+                xp_gain INTEGER NOT NULL DEFAULT 0,
+                cooldown_seconds INTEGER NOT NULL
+            );
+        """)
+        for bonus_type, defaults in DEFAULT_BONUS_CONFIG.items():
+            cur.execute(
+                'INSERT INTO bonus_config (bonus_type, amount, xp_gain, cooldown_seconds) VALUES (%s, %s, %s, %s) ON CONFLICT (bonus_type) DO NOTHING',
+                (bonus_type, defaults['amount'], defaults['xp_gain'], defaults['cooldown_seconds'])
+            )
+        logger.info("Table 'bonus_config' initialized or already exists.")
+
+        # Outgoing Telegram messages, drained by NotificationSender
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS notification_outbox (
+                id BIGSERIAL PRIMARY KEY,
+                chat_id BIGINT NOT NULL,
+                kind TEXT NOT NULL,
+                text TEXT NOT NULL,
+                dedupe_key TEXT,
+                status TEXT NOT NULL DEFAULT 'pending', -- pending, sent, failed
+                attempts INTEGER NOT NULL DEFAULT 0,
+                send_after TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+                created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+                sent_at TIMESTAMP WITH TIME ZONE,
+                last_error TEXT
+            );
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS notification_outbox_due_idx ON notification_outbox (send_after) WHERE status = 'pending';")
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS notification_outbox_dedupe_idx ON notification_outbox (dedupe_key) WHERE status = 'pending';")
+        logger.info("Table 'notification_outbox' initialized or already exists.")
+
+        # Responses to money-moving requests, by Idempotency-Key (used when IDEMPOTENCY_DB is set)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                key TEXT PRIMARY KEY,
+                status_code INTEGER, -- NULL while the first request is in flight
+                response JSONB,
+                created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+                reserved_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW() -- When the running attempt claimed it
+            );
+        """)
+        cur.execute("ALTER TABLE idempotency_keys ADD COLUMN IF NOT EXISTS reserved_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW();")
+
+        # Leaderboard order; user_id breaks ties so keyset pages are stable
+        cur.execute("CREATE INDEX IF NOT EXISTS users_leaderboard_idx ON users (level DESC, xp DESC, user_id DESC);")
+
+        # Hourly analytics rollups, upserted by every worker's GameStats flush
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS game_stats_hourly (
+                hour TIMESTAMP WITH TIME ZONE NOT NULL,
+                game TEXT NOT NULL, -- slots, line_slots, coin_flip, blackjack, daily_bonus, quick_bonus
+                plays BIGINT NOT NULL DEFAULT 0, -- Spins, flips, Blackjack hands or bonus claims
+                wagered BIGINT NOT NULL DEFAULT 0,
+                paid_out BIGINT NOT NULL DEFAULT 0,
+                rounds BIGINT NOT NULL DEFAULT 0, -- Blackjack only
+                round_seconds DOUBLE PRECISION NOT NULL DEFAULT 0,
+                PRIMARY KEY (hour, game)
+            );
+        """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS room_stats_hourly (
+                hour TIMESTAMP WITH TIME ZONE NOT NULL,
+                room_id TEXT NOT NULL,
+                rounds BIGINT NOT NULL DEFAULT 0,
+                hands BIGINT NOT NULL DEFAULT 0,
+                wagered BIGINT NOT NULL DEFAULT 0,
+                paid_out BIGINT NOT NULL DEFAULT 0,
+                round_seconds DOUBLE PRECISION NOT NULL DEFAULT 0,
+                PRIMARY KEY (hour, room_id)
+            );
+        """)
+
+        # Blackjack buy-ins held at a table; the live stack is in the room's memory and the WAL
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS table_escrow (
+                user_id BIGINT PRIMARY KEY REFERENCES users(user_id),
+                room_id TEXT NOT NULL,
+                worker_id TEXT NOT NULL,
+                stack BIGINT NOT NULL,
+                wal_seq BIGINT NOT NULL DEFAULT 0, -- Last WAL record this stack includes
+                updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+            );
+        """)
+        # One row per live process holding table stacks, renewed by its heartbeat
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS escrow_workers (
+                worker_id TEXT PRIMARY KEY,
+                lease_until TIMESTAMP WITH TIME ZONE NOT NULL
+            );
+        """)
         
         conn.commit()
         logger.info("DB schema migration checked.")
@@ -135,58 +624,80 @@ def init_db():
 init_db()
 
 # --- User Data Operations ---
-def get_user_data(user_id: int | str) -> dict:
-    user_id_int = int(user_id) 
+NEW_USER_BALANCE = 10000
+KNOWN_USERS_MAX = int(os.getenv('KNOWN_USERS_MAX', '100000'))
+
+known_users: set = set() # user_ids this process has already ensured exist
+
+class UserNotFound(LookupError):
+    pass
+
+def ensure_user(user_id: int | str, username: Optional[str] = None) -> bool:
+    """Creates the user on first contact. Returns True if the row was created by this call.
+
+    Users already seen by this process skip the database entirely. The set is bounded
+    by simply starting over when it fills up; a forgotten user costs one no-op INSERT.
+    """
+    user_id_int = int(user_id)
+    if user_id_int in known_users:
+        return False
     conn = None
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
+        cursor.execute(
+            'INSERT INTO users (user_id, username, balance, xp, level) VALUES (%s, %s, %s, 0, 1) ON CONFLICT (user_id) DO NOTHING RETURNING user_id',
+            (user_id_int, username or 'Unnamed Player', NEW_USER_BALANCE)
+        )
+        created = cursor.fetchone() is not None
+        conn.commit()
+    finally:
+        if conn:
+            conn.close()
+    if len(known_users) >= KNOWN_USERS_MAX:
+        known_users.clear()
+    known_users.add(user_id_int)
+    if created:
+        logger.info(f"Created new user {user_id_int} with initial balance {NEW_USER_BALANCE}.")
+        metrics.inc("users_created")
+    return created
+
+def get_user_data(user_id: int | str, read_only: bool = False) -> dict:
+    """Pure lookup; never writes. Raises UserNotFound for unknown users and lets DB errors through.
+
+    read_only lookups may go to the replica; a user the replica hasn't caught up with yet
+    is looked up again on the primary.
+    """
+    user_id_int = int(user_id)
+    conn = None
+    try:
+        conn = get_db_connection(read_only=read_only)
+        cursor = conn.cursor()
         cursor.execute(
             'SELECT username, balance, xp, level, last_free_coins_claim, last_daily_bonus_claim, last_quick_bonus_claim FROM users WHERE user_id = %s', 
             (user_id_int,)
         )
         result = cursor.fetchone()
-        if result:
-            logger.info(f"Retrieved user {user_id_int} data: balance={result[1]}, xp={result[2]}, level={result[3]}")
-            last_free_coins_claim_db = result[4]
-            if last_free_coins_claim_db and last_free_coins_claim_db.tzinfo is None:
-                last_free_coins_claim_db = last_free_coins_claim_db.replace(tzinfo=timezone.utc)
-            
-            last_daily_bonus_claim_db = result[5]
-            if last_daily_bonus_claim_db and last_daily_bonus_claim_db.tzinfo is None:
-                last_daily_bonus_claim_db = last_daily_bonus_claim_db.replace(tzinfo=timezone.utc)
-
-            last_quick_bonus_claim_db = result[6]
-            if last_quick_bonus_claim_db and last_quick_bonus_claim_db.tzinfo is None:
-                last_quick_bonus_claim_db = last_quick_bonus_claim_db.replace(tzinfo=timezone.utc)
-
-            return {
-                'username': result[0], 'balance': result[1], 'xp': result[2], 'level': result[3],
-                'last_free_coins_claim': last_free_coins_claim_db,
-                'last_daily_bonus_claim': last_daily_bonus_claim_db,
-                'last_quick_bonus_claim': last_quick_bonus_claim_db
-            }
-        else:
-            initial_balance = 10000
-            cursor.execute(
-                'INSERT INTO users (user_id, username, balance, xp, level, last_free_coins_claim, last_daily_bonus_claim, last_quick_bonus_claim) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)', 
-                (user_id_int, 'Unnamed Player', initial_balance, 0, 1, None, None, None)
-            )
-            conn.commit()
-            logger.info(f"Created new user {user_id_int} with initial balance {initial_balance}.")
-            return {
-                'username': 'Unnamed Player', 'balance': initial_balance, 'xp': 0, 'level': 1, 
-                'last_free_coins_claim': None, 'last_daily_bonus_claim': None, 'last_quick_bonus_claim': None
-            }
-    except Exception as e:
-        logger.error(f"Error getting user data from PostgreSQL for {user_id_int}: {e}", exc_info=True)
-        return {
-            'username': 'Error Player', 'balance': 0, 'xp': 0, 'level': 1, 
-            'last_free_coins_claim': None, 'last_daily_bonus_claim': None, 'last_quick_bonus_claim': None
-        }
     finally:
         if conn:
             conn.close()
+    if not result:
+        if read_only and DATABASE_READ_URL:
+            return get_user_data(user_id_int)
+        raise UserNotFound(f"User {user_id_int} does not exist.")
+
+    logger.info(f"Retrieved user {user_id_int} data: balance={result[1]}, xp={result[2]}, level={result[3]}")
+    claims = []
+    for claimed_at in result[4:7]:
+        if claimed_at and claimed_at.tzinfo is None:
+            claimed_at = claimed_at.replace(tzinfo=timezone.utc)
+        claims.append(claimed_at)
+    return {
+        'username': result[0], 'balance': result[1], 'xp': result[2], 'level': result[3],
+        'last_free_coins_claim': claims[0],
+        'last_daily_bonus_claim': claims[1],
+        'last_quick_bonus_claim': claims[2]
+    }
 
 def update_user_data(user_id: int | str, **kwargs):
     user_id_int = int(user_id)
@@ -231,6 +742,8 @@ def update_user_data(user_id: int | str, **kwargs):
 
         cursor.execute(update_query, update_values)
         conn.commit()
+        if 'xp' in kwargs or 'level' in kwargs:
+            invalidate_leaderboard()
         logger.info(f"User {user_id_int} data updated. New balance: {fields_to_update.get('balance')}, XP: {fields_to_update.get('xp')}, Level: {fields_to_update.get('level')}.")
     except Exception as e:
         logger.error(f"Error updating user data in PostgreSQL for {user_id_int}: {e}", exc_info=True)
@@ -272,6 +785,467 @@ def calculate_level_and_xp(current_xp: int, current_level: int) -> tuple[int, in
         new_level += 1
     return new_level, current_xp
 
+# --- Bonus Claims ---
+def claim_bonus(user_id: int | str, bonus_type: str) -> Optional[dict]:
+    """Atomically checks the cooldown and credits a bonus in a single statement.
+
+    The cooldown condition lives in the UPDATE's WHERE clause, so concurrent claims
+    for the same user serialize on the row lock and only one of them can pass it.
+    Returns None if the user (or the bonus config) does not exist. remaining_seconds is
+    the time until the next claim is possible (the full cooldown after a successful claim).
+    """
+    user_id_int = int(user_id)
+    claim_column = sql.Identifier(BONUS_CLAIM_COLUMNS[bonus_type])
+    query = sql.SQL("""
+        WITH cfg AS (
+            SELECT amount, xp_gain, make_interval(secs => cooldown_seconds) AS cooldown
+            FROM bonus_config WHERE bonus_type = %(bonus_type)s
+        ),
+        claimed AS (
+            UPDATE users AS u
+            SET balance = u.balance + cfg.amount,
+                xp = u.xp + cfg.xp_gain,
+                level = GREATEST(u.level, (
+                    SELECT COUNT(*) FROM unnest(%(thresholds)s::int[]) AS t(min_xp) WHERE t.min_xp <= u.xp + cfg.xp_gain
+                )),
+                {claim_column} = NOW()
+            FROM cfg
+            WHERE u.user_id = %(user_id)s
+              AND (u.{claim_column} IS NULL OR u.{claim_column} <= NOW() - cfg.cooldown)
+            RETURNING u.balance, u.xp, u.level, cfg.amount, EXTRACT(EPOCH FROM cfg.cooldown)::float AS next_claim_in
+        ),
+        current_state AS (
+            SELECT u.balance, u.xp, u.level, u.{claim_column} AS last_claim
+            FROM users AS u WHERE u.user_id = %(user_id)s FOR UPDATE
+        )
+        SELECT TRUE, c.balance, c.xp, c.level, c.amount, c.next_claim_in FROM claimed AS c
+        UNION ALL
+        SELECT FALSE, s.balance, s.xp, s.level, cfg.amount,
+               GREATEST(EXTRACT(EPOCH FROM (s.last_claim + cfg.cooldown - NOW())), 0)::float
+        FROM current_state AS s, cfg
+        WHERE NOT EXISTS (SELECT 1 FROM claimed)
+    """).format(claim_column=claim_column)
+
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(query, {
+            'bonus_type': bonus_type,
+            'user_id': user_id_int,
+            'thresholds': sorted(LEVEL_THRESHOLDS.values()),
+        })
+        row = cursor.fetchone()
+        conn.commit()
+        if not row:
+            return None
+        claimed, balance, xp, level, amount, remaining_seconds = row
+        if claimed:
+            invalidate_leaderboard()
+        logger.info(f"Bonus '{bonus_type}' claim for user {user_id_int}: claimed={claimed}, balance={balance}, remaining={remaining_seconds:.0f}s")
+        return {
+            'claimed': claimed, 'balance': balance, 'xp': xp, 'level': level,
+            'amount': amount, 'remaining_seconds': remaining_seconds
+        }
+    finally:
+        if conn:
+            conn.close()
+
+def claim_bonus_for_request(user_id: int | str, bonus_type: str) -> dict:
+    result = claim_bonus(user_id, bonus_type)
+    if result is None and ensure_user(user_id): # First contact: create the user row, then retry once
+        result = claim_bonus(user_id, bonus_type)
+    if result is None:
+        raise ValueError(f"Bonus '{bonus_type}' is not configured or user {user_id} is missing.")
+    if result['claimed']:
+        game_stats.record(f"{bonus_type}_bonus", paid_out=result['amount'])
+    if result['claimed'] and bonus_type in NOTIFY_BONUS_TYPES:
+        enqueue_notification(
+            user_id, "bonus_ready", BONUS_READY_TEXT[bonus_type],
+            dedupe_key=f"bonus_ready:{bonus_type}:{user_id}", delay_seconds=result['remaining_seconds']
+        )
+    return result
+
+# --- Bulk Wallet Settlement ---
+def settle_wallets(entries: List[tuple[int, int, int]], escrow_checkpoint: Optional[List[tuple[int, str, int, int]]] = None) -> Dict[int, dict]:
+    """Credits (user_id, winnings, xp_gain) for many users in one multi-row UPDATE.
+
+    Runs as a single transaction on a single connection. Returns the post-commit
+    balance, xp and level per user, plus whether the user leveled up. `escrow_checkpoint`
+    rows (user_id, room_id, stack, wal_seq) update table stacks in the same transaction.
+    """
+    if not entries:
+        return {}
+    query = sql.SQL("""
+        UPDATE users AS u
+        SET balance = u.balance + v.winnings,
+            xp = u.xp + v.xp_gain,
+            level = GREATEST(u.level, (
+                SELECT COUNT(*) FROM unnest({thresholds}::int[]) AS t(min_xp) WHERE t.min_xp <= u.xp + v.xp_gain
+            ))
+        FROM (VALUES %s) AS v(user_id, winnings, xp_gain)
+        JOIN users AS prev ON prev.user_id = v.user_id
+        WHERE u.user_id = v.user_id
+        RETURNING u.user_id, u.balance, u.xp, u.level, prev.level
+    """).format(thresholds=sql.Literal(sorted(LEVEL_THRESHOLDS.values())))
+
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        rows = execute_values(cursor, query, [(int(u), w, x) for u, w, x in entries], template="(%s::bigint, %s::int, %s::int)", fetch=True)
+        if escrow_checkpoint:
+            execute_values(cursor, """
+                UPDATE table_escrow AS e SET stack = v.stack, wal_seq = v.wal_seq, updated_at = NOW()
+                FROM (VALUES %s) AS v(user_id, room_id, stack, wal_seq)
+                WHERE e.user_id = v.user_id AND e.room_id = v.room_id
+            """, escrow_checkpoint, template="(%s::bigint, %s, %s::bigint, %s::bigint)")
+        conn.commit()
+    except Exception:
+        if conn:
+            conn.rollback()
+        raise
+    finally:
+        if conn:
+            conn.close()
+    logger.info(f"Settled {len(rows)} wallets in one transaction.")
+    if any(xp_gain for _, _, xp_gain in entries):
+        invalidate_leaderboard()
+    return {
+        user_id: {'balance': balance, 'xp': xp, 'level': level, 'leveled_up': level > previous_level}
+        for user_id, balance, xp, level, previous_level in rows
+    }
+
+# --- Wagers ---
+def apply_wager(user_id: int | str, cost: int, winnings: int, xp_gain: int) -> Optional[dict]:
+    """Debits `cost` and credits `winnings` and `xp_gain` in one conditional UPDATE.
+
+    The change is relative and the funds check is in the WHERE clause, so it can't undo a
+    wallet write that lands in between (a table cash-out, a bonus). Returns the new balance,
+    xp and level and whether the user leveled up, or None if the balance is below `cost`.
+    """
+    user_id_int = int(user_id)
+    query = sql.SQL("""
+        UPDATE users AS u
+        SET balance = u.balance - %(cost)s + %(winnings)s,
+            xp = u.xp + %(xp_gain)s,
+            level = GREATEST(u.level, (
+                SELECT COUNT(*) FROM unnest({thresholds}::int[]) AS t(min_xp) WHERE t.min_xp <= u.xp + %(xp_gain)s
+            ))
+        FROM users AS prev
+        WHERE u.user_id = %(user_id)s AND prev.user_id = u.user_id AND u.balance >= %(cost)s
+        RETURNING u.balance, u.xp, u.level, prev.level
+    """).format(thresholds=sql.Literal(sorted(LEVEL_THRESHOLDS.values())))
+
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(query, {'user_id': user_id_int, 'cost': cost, 'winnings': winnings, 'xp_gain': xp_gain})
+        row = cursor.fetchone()
+        conn.commit()
+    finally:
+        if conn:
+            conn.close()
+    if not row:
+        return None
+    if xp_gain:
+        invalidate_leaderboard()
+    balance, xp, level, previous_level = row
+    logger.info(f"Wager for user {user_id_int}: cost={cost}, winnings={winnings}, balance={balance}")
+    return {'balance': balance, 'xp': xp, 'level': level, 'leveled_up': level > previous_level}
+
+# --- Table Escrow ---
+# Joining a Blackjack table moves a buy-in from users.balance into table_escrow in one
+# transaction. From then on bets and payouts only change the player's stack in the room's
+# memory; each change is first appended to a local write-ahead log. Stacks are checkpointed
+# to table_escrow with each round's XP write, and the stack goes back to the wallet when the
+# player leaves or times out, or at shutdown. Each process holds its own worker id and WAL
+# under a file lock, and a lease in escrow_workers that its heartbeat renews. At startup, rows
+# an earlier run under this worker id left behind are paid out using the newest stack from the
+# WAL (refunding a bet whose round never settled). Rows of a worker whose lease has run out (a
+# crash, or a container replaced by a redeploy, which takes its hostname and disk with it) are
+# paid out by whichever worker notices first: from that worker's WAL if it is on this disk,
+# otherwise at their last DB checkpoint. No process reconciles stacks a live process holds.
+TABLE_BUY_IN = int(os.getenv('TABLE_BUY_IN', '1000'))
+TABLE_MIN_BUY_IN = 100
+TABLE_MAX_BUY_IN = 100_000
+ESCROW_WAL_DIR = os.getenv('ESCROW_WAL_DIR', os.path.dirname(os.path.abspath(__file__)))
+ESCROW_WAL_FSYNC = os.getenv('ESCROW_WAL_FSYNC', '').lower() in ('1', 'true', 'yes') # Survive power loss, not just a crash
+ESCROW_WORKER_ID = os.getenv('ESCROW_WORKER_ID') # Pins the id; by default each process takes the first free "<hostname>-<n>"
+ESCROW_MAX_WORKERS = 64
+ESCROW_LEASE_SECONDS = float(os.getenv('ESCROW_LEASE_SECONDS', '120')) # A worker that hasn't renewed its lease this long is presumed dead
+
+class EscrowWal:
+    """Append-only JSON Lines log of stack changes: the stack after each change, numbered.
+
+    A process must claim() a worker id first. The id is held with an exclusive lock on
+    escrow-<id>.lock for the life of the process, and names the log, escrow-<id>.wal.
+    """
+
+    def __init__(self, directory: str, fsync: bool):
+        self.directory = directory
+        self.fsync = fsync
+        self.worker_id: Optional[str] = None
+        self.path: Optional[str] = None
+        self.lock = None
+        self.file = None
+        self.seq = 0
+
+    def claim(self, candidates: List[str]) -> bool:
+        """Takes the first worker id in `candidates` that no live process holds."""
+        for worker_id in candidates:
+            lock = open(os.path.join(self.directory, f"escrow-{worker_id}.lock"), "a")
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB) # Released by the OS if the process dies
+            except BlockingIOError:
+                lock.close()
+                continue
+            self.worker_id, self.lock = worker_id, lock
+            self.path = os.path.join(self.directory, f"escrow-{worker_id}.wal")
+            return True
+        return False
+
+    def release(self):
+        for f in (self.file, self.lock):
+            if f:
+                f.close()
+        self.file = self.lock = None
+
+    def append(self, user_id: int, room_id: str, stack: int, reason: str, bet: int = 0) -> int:
+        if self.file is None:
+            self.file = open(self.path, "a", encoding="utf-8")
+        self.seq += 1
+        record = {"n": self.seq, "u": user_id, "r": room_id, "s": stack, "why": reason}
+        if bet:
+            record["b"] = bet # Refunded by reconciliation if the round never settled
+        self.file.write(json.dumps(record, separators=(",", ":")) + "\n")
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+        return self.seq
+
+    def read_latest(self) -> Dict[tuple, dict]:
+        """Newest record per (user_id, room_id); a torn last line from a crash is ignored."""
+        latest: Dict[tuple, dict] = {}
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    latest[(record["u"], record["r"])] = record
+                    self.seq = max(self.seq, record["n"])
+        except FileNotFoundError:
+            pass
+        return latest
+
+    def reset(self):
+        """Starts a fresh log once everything in the old one has been reconciled."""
+        if self.file:
+            self.file.close()
+        self.file = open(self.path, "w", encoding="utf-8")
+        self.seq = 0
+
+escrow_wal = EscrowWal(ESCROW_WAL_DIR, ESCROW_WAL_FSYNC)
+pending_cash_outs: Dict[tuple[int, str], int] = {} # (user_id, room_id) -> stack whose cash-out failed; retried by the heartbeat
+escrow_last_sweep = 0.0 # monotonic time dead workers' rows were last looked for
+
+class EscrowBusy(Exception):
+    """The user still has a stack at a table (e.g. a cash-out that hasn't gone through yet)."""
+
+def escrow_buy_in(user_id: int, room_id: str, amount: int) -> Optional[int]:
+    """Moves up to `amount` (at least TABLE_MIN_BUY_IN) from the wallet to a table stack.
+    Returns the stack, or None if the balance is too low."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1 FROM table_escrow WHERE user_id = %s", (user_id,))
+        if cursor.fetchone():
+            raise EscrowBusy(f"User {user_id} already has a table stack.")
+        cursor.execute("""
+            WITH cur AS (
+                SELECT user_id, LEAST(balance, %(amount)s) AS stack FROM users
+                WHERE user_id = %(user_id)s AND balance >= %(min)s FOR UPDATE
+            ),
+            taken AS (
+                UPDATE users AS u SET balance = u.balance - cur.stack FROM cur
+                WHERE u.user_id = cur.user_id RETURNING cur.stack
+            )
+            INSERT INTO table_escrow (user_id, room_id, worker_id, stack, wal_seq)
+            SELECT %(user_id)s, %(room_id)s, %(worker_id)s, stack, %(wal_seq)s FROM taken
+            RETURNING stack
+        """, {'user_id': user_id, 'room_id': room_id, 'worker_id': escrow_wal.worker_id, 'amount': amount,
+              'min': TABLE_MIN_BUY_IN, 'wal_seq': escrow_wal.seq})
+        row = cursor.fetchone()
+        conn.commit()
+        return row[0] if row else None
+    except psycopg2.errors.UniqueViolation as e: # A concurrent buy-in won the race
+        conn.rollback()
+        raise EscrowBusy(str(e))
+    finally:
+        if conn:
+            conn.close()
+
+def escrow_cash_out(user_id: int, room_id: str, stack: int) -> Optional[int]:
+    """Closes the table stack and credits it to the wallet. Returns the new balance, or None
+    if there was no open stack (already paid out)."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            WITH closed AS (DELETE FROM table_escrow WHERE user_id = %s AND room_id = %s RETURNING user_id)
+            UPDATE users AS u SET balance = u.balance + %s FROM closed
+            WHERE u.user_id = closed.user_id RETURNING u.balance
+        """, (user_id, room_id, stack))
+        row = cursor.fetchone()
+        conn.commit()
+        return row[0] if row else None
+    finally:
+        if conn:
+            conn.close()
+
+def claim_escrow_worker():
+    """Takes this process's worker id; refuses to start if a pinned ESCROW_WORKER_ID is in use."""
+    candidates = [ESCROW_WORKER_ID] if ESCROW_WORKER_ID else [f"{socket.gethostname()}-{n}" for n in range(ESCROW_MAX_WORKERS)]
+    if not escrow_wal.claim(candidates):
+        raise RuntimeError(f"Escrow worker id {ESCROW_WORKER_ID or 'slot'} is held by another process; set a distinct ESCROW_WORKER_ID per worker.")
+    logger.info(f"Escrow: this process is worker {escrow_wal.worker_id} ({escrow_wal.path}).")
+
+def renew_escrow_lease():
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO escrow_workers (worker_id, lease_until) VALUES (%s, NOW() + make_interval(secs => %s))
+            ON CONFLICT (worker_id) DO UPDATE SET lease_until = EXCLUDED.lease_until
+        """, (escrow_wal.worker_id, ESCROW_LEASE_SECONDS))
+        conn.commit()
+    finally:
+        if conn:
+            conn.close()
+
+def release_escrow_lease():
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM escrow_workers WHERE worker_id = %s", (escrow_wal.worker_id,))
+        conn.commit()
+    finally:
+        if conn:
+            conn.close()
+
+def take_dead_escrow_workers() -> List[str]:
+    """Drops the leases that have run out and returns those workers, plus any worker that still
+    has table_escrow rows but no lease at all (e.g. rows from before leases existed)."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        # Deleting the lease is the claim: of two workers sweeping at once, only one gets it back
+        cursor.execute("""
+            WITH expired AS (DELETE FROM escrow_workers WHERE lease_until < NOW() RETURNING worker_id)
+            SELECT worker_id FROM expired
+            UNION
+            SELECT DISTINCT e.worker_id FROM table_escrow AS e
+            WHERE NOT EXISTS (SELECT 1 FROM escrow_workers AS w WHERE w.worker_id = e.worker_id)
+        """)
+        worker_ids = [row[0] for row in cursor.fetchall()]
+        conn.commit()
+        return worker_ids
+    finally:
+        if conn:
+            conn.close()
+
+def reconcile_escrow() -> int:
+    """Pays out stacks left in table_escrow by an earlier run of this worker, and by every worker
+    whose lease has run out. Returns stacks paid out."""
+    return reconcile_escrow_worker(escrow_wal.worker_id, escrow_wal) + reconcile_dead_escrow_workers()
+
+def reconcile_dead_escrow_workers() -> int:
+    paid = 0
+    for worker_id in take_dead_escrow_workers():
+        if worker_id == escrow_wal.worker_id:
+            continue
+        orphan = EscrowWal(escrow_wal.directory, escrow_wal.fsync)
+        if os.path.exists(os.path.join(escrow_wal.directory, f"escrow-{worker_id}.lock")) and not orphan.claim([worker_id]):
+            continue # Alive on this host and only late renewing; its heartbeat puts the lease back
+        try:
+            paid += reconcile_escrow_worker(worker_id, orphan if orphan.worker_id else None)
+        finally:
+            orphan.release()
+    return paid
+
+def reconcile_escrow_worker(worker_id: str, wal: Optional[EscrowWal]) -> int:
+    """Pays out one worker's table_escrow rows, using the newest WAL record when it is newer
+    than the DB checkpoint, then starts that worker's WAL afresh. Without a WAL (the worker
+    ran on another host) the checkpoint is paid, so a bet placed after it is refunded."""
+    latest = wal.read_latest() if wal else {}
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT user_id, room_id, stack, wal_seq FROM table_escrow WHERE worker_id = %s FOR UPDATE",
+            (worker_id,)
+        )
+        payouts = []
+        for user_id, room_id, stack, wal_seq in cursor.fetchall():
+            record = latest.get((user_id, room_id))
+            if record and record["n"] > wal_seq:
+                stack = record["s"] + (record.get("b", 0) if record["why"] == "bet" else 0)
+            payouts.append((user_id, room_id, stack))
+        if payouts:
+            # A user may have stacks in several rooms; UPDATE applies one joined row per user, so sum first
+            execute_values(cursor, """
+                WITH v(user_id, room_id, stack) AS (VALUES %s),
+                closed AS (
+                    DELETE FROM table_escrow AS e USING v WHERE e.user_id = v.user_id AND e.room_id = v.room_id
+                    RETURNING e.user_id, e.room_id
+                ),
+                owed AS (
+                    SELECT v.user_id, SUM(v.stack) AS amount FROM v
+                    JOIN closed ON closed.user_id = v.user_id AND closed.room_id = v.room_id
+                    GROUP BY v.user_id
+                )
+                UPDATE users AS u SET balance = u.balance + owed.amount FROM owed
+                WHERE u.user_id = owed.user_id
+            """, payouts, template="(%s::bigint, %s, %s::bigint)")
+        conn.commit()
+    finally:
+        if conn:
+            conn.close()
+    if wal:
+        wal.reset()
+    for user_id, room_id, stack in payouts:
+        logger.warning(f"Escrow: returned stack {stack} of user {user_id} from room {room_id} left by worker {worker_id}.")
+    return len(payouts)
+
+async def retry_pending_cash_outs():
+    for (user_id, room_id), stack in list(pending_cash_outs.items()):
+        try:
+            await asyncio.to_thread(escrow_cash_out, user_id, room_id, stack)
+        except Exception as e:
+            logger.error(f"Escrow: cash-out of {stack} for user {user_id} still failing: {e}")
+            return # Database still down; try again on the next sweep
+        del pending_cash_outs[(user_id, room_id)]
+        escrow_wal.append(user_id, room_id, stack, "cash_out")
+
+async def maintain_escrow_lease():
+    """Renews this worker's lease and, every ESCROW_LEASE_SECONDS, pays out what dead workers left."""
+    global escrow_last_sweep
+    await asyncio.to_thread(renew_escrow_lease)
+    if time.monotonic() - escrow_last_sweep >= ESCROW_LEASE_SECONDS:
+        escrow_last_sweep = time.monotonic()
+        paid = await asyncio.to_thread(reconcile_dead_escrow_workers)
+        if paid:
+            metrics.inc("escrow_orphaned_stacks_returned", paid)
+
 # --- Telegram Bot Handlers ---
 @dp.message(CommandStart())
 async def command_start_handler(message: Message) -> None:
@@ -279,7 +1253,8 @@ async def command_start_handler(message: Message) -> None:
     username = message.from_user.username or message.from_user.first_name or f"Гравець {str(user_id)[-4:]}"
     
     try:
-        user_data = get_user_data(user_id) # Use the single get_user_data
+        ensure_user(user_id, username) # First contact
+        user_data = get_user_data(user_id)
         logger.info(f"CommandStart: User {user_id} fetched data: {user_data}")
         
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -298,19 +1273,707 @@ async def command_start_handler(message: Message) -> None:
         logger.error(f"Error in command_start_handler for user {user_id}: {e}")
         await message.answer("Вибачте, виникла помилка при запуску гри. Будь ласка, спробуйте пізніше.")
 
-@dp.message(Command("balance"))
-async def command_balance_handler(message: Message) -> None:
-    user_id = message.from_user.id
-    username = message.from_user.username or message.from_user.first_name or f"Гравець {str(user_id)[-4:]}"
+@dp.message(Command("balance"))
+async def command_balance_handler(message: Message) -> None:
+    user_id = message.from_user.id
+    username = message.from_user.username or message.from_user.first_name or f"Гравець {str(user_id)[-4:]}"
+    try:
+        ensure_user(user_id, username)
+        user_data = get_user_data(user_id, read_only=True)
+        await message.answer(
+            f"Ваш баланс: {user_data['balance']} фантиків.\n"
+            f"Ваш рівень: {user_data['level']} (XP: {user_data['xp']}/{get_next_level_xp(user_data['level'])})"
+        )
+    except Exception as e:
+        logger.error(f"Error in command_balance_handler for user {user_id}: {e}")
+        await message.answer("Вибачте, не вдалося отримати ваш баланс.")
+
+# --- Notifications ---
+# Telegram messages are written to notification_outbox and delivered by one NotificationSender
+# per worker. Rows are claimed with FOR UPDATE SKIP LOCKED plus a lease, so several workers can
+# drain the same outbox. Sending stays under Telegram's limits: a global token bucket, one
+# message per second per chat, and a full pause whenever Telegram answers with retry_after.
+NOTIFY_GLOBAL_RATE = float(os.getenv('NOTIFY_GLOBAL_RATE', '25')) # Telegram allows about 30 messages/s per bot
+NOTIFY_CHAT_RATE = 1.0 # Messages per second to a single chat
+NOTIFY_CONCURRENCY = int(os.getenv('NOTIFY_CONCURRENCY', '8'))
+NOTIFY_BATCH_SIZE = 100
+NOTIFY_MAX_ATTEMPTS = 5
+NOTIFY_POLL_SECONDS = 5
+NOTIFY_LEASE_SECONDS = 60 # A claimed row becomes claimable again if its worker dies
+NOTIFY_BONUS_TYPES = {'daily'} # Bonuses that announce when they can be claimed again
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+def enqueue_notifications(entries: List[tuple]):
+    """Writes (chat_id, kind, text, dedupe_key, delay_seconds) rows to the outbox.
+
+    A pending row with the same dedupe_key wins; the new one is dropped.
+    """
+    if not entries:
+        return
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        execute_values(cursor, """
+            INSERT INTO notification_outbox (chat_id, kind, text, dedupe_key, send_after)
+            SELECT v.chat_id, v.kind, v.text, v.dedupe_key, NOW() + make_interval(secs => v.delay_seconds)
+            FROM (VALUES %s) AS v(chat_id, kind, text, dedupe_key, delay_seconds)
+            ON CONFLICT (dedupe_key) WHERE status = 'pending' DO NOTHING
+        """, [(int(c), k, t, d, float(s)) for c, k, t, d, s in entries], template="(%s::bigint, %s, %s, %s, %s::float)")
+        conn.commit()
+    finally:
+        if conn:
+            conn.close()
+    metrics.inc("notifications_enqueued", len(entries))
+    if notification_sender:
+        notification_sender.wake()
+
+def enqueue_notification(chat_id: int, kind: str, text: str, dedupe_key: Optional[str] = None, delay_seconds: float = 0):
+    try:
+        enqueue_notifications([(chat_id, kind, text, dedupe_key, delay_seconds)])
+    except Exception as e:
+        # Notifications are best effort; never fail the game action that triggered one
+        logger.error(f"Could not enqueue '{kind}' notification for {chat_id}: {e}")
+
+def level_up_text(level: int) -> str:
+    return f"🎉 Вітаємо! Ви досягли {level} рівня!"
+
+def claim_notifications(limit: int) -> List[tuple]:
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE notification_outbox AS o
+            SET send_after = NOW() + make_interval(secs => %s)
+            WHERE o.id IN (
+                SELECT id FROM notification_outbox
+                WHERE status = 'pending' AND send_after <= NOW()
+                ORDER BY send_after, id LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING o.id, o.chat_id, o.text, o.attempts
+        """, (NOTIFY_LEASE_SECONDS, limit))
+        rows = cursor.fetchall()
+        conn.commit()
+        return sorted(rows)
+    finally:
+        if conn:
+            conn.close()
+
+def finish_notifications(ids: List[int], status: str, error: Optional[str] = None):
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE notification_outbox SET status = %s, sent_at = CASE WHEN %s = 'sent' THEN NOW() END, last_error = %s WHERE id = ANY(%s)",
+            (status, status, error, ids)
+        )
+        conn.commit()
+    finally:
+        if conn:
+            conn.close()
+
+def retry_notifications(ids: List[int], delay_seconds: float, error: str, count_attempt: bool = True):
+    """Pushes rows back by `delay_seconds`; rows out of attempts are marked failed."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE notification_outbox
+            SET attempts = attempts + %s,
+                status = CASE WHEN attempts + %s >= %s THEN 'failed' ELSE 'pending' END,
+                send_after = NOW() + make_interval(secs => %s),
+                last_error = %s
+            WHERE id = ANY(%s)
+        """, (int(count_attempt), int(count_attempt), NOTIFY_MAX_ATTEMPTS, delay_seconds, error, ids))
+        conn.commit()
+    finally:
+        if conn:
+            conn.close()
+
+class NotificationSender:
+    def __init__(self, bot: Bot):
+        self.bot = bot
+        self.global_bucket = TokenBucket(NOTIFY_GLOBAL_RATE)
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        self.semaphore = asyncio.Semaphore(NOTIFY_CONCURRENCY)
+        self.paused_until = 0.0 # Set from retry_after; applies to every chat
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self._run(), name="notification-sender")
+
+    def wake(self):
+        self.wakeup.set()
+
+    def close(self):
+        self.task.cancel()
+
+    async def _run(self):
+        while True:
+            try:
+                rows = await asyncio.to_thread(claim_notifications, NOTIFY_BATCH_SIZE)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Notification outbox poll failed: {e}")
+                rows = []
+            if not rows:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=NOTIFY_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            # Batching: everything due for one chat goes out as one message where it fits
+            by_chat: Dict[int, List[tuple]] = defaultdict(list)
+            for row in rows:
+                by_chat[row[1]].append(row)
+            await asyncio.gather(*(self._deliver(chat_id, chat_rows) for chat_id, chat_rows in by_chat.items()))
+            if len(self.chat_buckets) > 10000:
+                self.chat_buckets.clear()
+
+    @staticmethod
+    def _pack(rows: List[tuple]) -> List[tuple[List[int], str]]:
+        messages: List[tuple[List[int], str]] = []
+        for row_id, _, text, _ in rows:
+            if messages and len(messages[-1][1]) + 2 + len(text) <= TELEGRAM_MESSAGE_LIMIT:
+                messages[-1][0].append(row_id)
+                messages[-1] = (messages[-1][0], messages[-1][1] + "\n\n" + text)
+            else:
+                messages.append(([row_id], text))
+        return messages
+
+    async def _deliver(self, chat_id: int, rows: List[tuple]):
+        chat_bucket = self.chat_buckets.setdefault(chat_id, TokenBucket(NOTIFY_CHAT_RATE, 1))
+        async with self.semaphore:
+            for ids, text in self._pack(rows):
+                await chat_bucket.acquire()
+                await self.global_bucket.acquire()
+                pause = self.paused_until - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                try:
+                    await self.bot.send_message(chat_id, text)
+                except TelegramRetryAfter as e:
+                    logger.warning(f"Telegram asked to retry after {e.retry_after}s; pausing notifications.")
+                    metrics.inc("notifications_retry_after")
+                    self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+                    await asyncio.to_thread(retry_notifications, ids, e.retry_after, "retry_after", False)
+                    continue
+                except (TelegramForbiddenError, TelegramBadRequest) as e:
+                    # Bot blocked, chat gone or bad text: retrying won't help
+                    metrics.inc("notifications_failed", len(ids))
+                    await asyncio.to_thread(finish_notifications, ids, "failed", str(e))
+                    continue
+                except Exception as e:
+                    logger.warning(f"Notification to {chat_id} failed: {e}")
+                    attempt = max(r[3] for r in rows if r[0] in ids) + 1
+                    await asyncio.to_thread(retry_notifications, ids, min(300, 5 * 2 ** attempt), str(e))
+                    continue
+                metrics.inc("notifications_sent", len(ids))
+                await asyncio.to_thread(finish_notifications, ids, "sent")
+
+notification_sender: Optional[NotificationSender] = None
+
+# --- Randomness ---
+# Every game outcome comes from a SeededRng whose seed is logged, so any spin, flip or
+# Blackjack shoe can be replayed exactly. Setting RNG_SEED makes the whole process
+# deterministic (benchmarks, traffic replays); otherwise seeds come from the OS.
+RNG_SEED = os.getenv('RNG_SEED')
+
+class SeededRng(random.Random):
+    """random.Random that remembers the seed it was created with."""
+
+    def __init__(self, seed: Optional[int] = None):
+        self.seed_value = seed if seed is not None else secrets.randbits(64)
+        super().__init__(self.seed_value)
+
+def derive_seed(*parts) -> int:
+    """Stable 64-bit seed from RNG_SEED and a label (e.g. a room id)."""
+    digest = hashlib.blake2b(":".join(str(p) for p in (RNG_SEED, *parts)).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+# One seed stream per user, so a user's outcomes don't depend on how their requests
+# interleave with everybody else's (a replay can't reproduce that order exactly)
+_request_seed_streams: Dict[int, SeededRng] = {}
+_room_id_stream = SeededRng(derive_seed("room_ids")) if RNG_SEED is not None else None
+
+def request_rng(user_id: int) -> SeededRng:
+    """Fresh RNG stream for one API request."""
+    if RNG_SEED is not None:
+        stream = _request_seed_streams.get(user_id)
+        if stream is None:
+            stream = _request_seed_streams[user_id] = SeededRng(derive_seed("requests", user_id))
+        return SeededRng(stream.getrandbits(64))
+    return SeededRng()
+
+def generate_room_id() -> str:
+    if _room_id_stream is not None:
+        return f"{_room_id_stream.getrandbits(32):08x}"
+    return uuid.uuid4().hex[:8]
+
+# --- Leaderboard ---
+# Ordered by (level, xp, user_id) descending, matching users_leaderboard_idx. Pages use keyset
+# cursors, so page N costs the same as page 1, and the cursor carries the rank of its last row
+# (signed, so clients can't choose their ranks) so ranks need no COUNT. Results are cached per
+# page; wallet writes that change xp or level bump the generation, and the TTL covers writes
+# made by other workers. A user's rank is the number of players in higher levels, from a
+# per-level head count refreshed every LEADERBOARD_LEVEL_COUNTS_SECONDS, plus a count within
+# their own level only.
+LEADERBOARD_PAGE_MAX = 100
+LEADERBOARD_CACHE_SECONDS = float(os.getenv('LEADERBOARD_CACHE_SECONDS', '10'))
+LEADERBOARD_CACHE_MAX = 256
+LEADERBOARD_LEVEL_COUNTS_SECONDS = float(os.getenv('LEADERBOARD_LEVEL_COUNTS_SECONDS', '60'))
+
+leaderboard_generation = 0
+leaderboard_cache: Dict[tuple, tuple[int, float, dict]] = {} # key -> (generation, expires_at, result)
+level_counts_cache: tuple[float, Dict[int, int]] = (0.0, {}) # (expires_at, level -> players)
+
+def invalidate_leaderboard():
+    global leaderboard_generation
+    leaderboard_generation += 1
+
+def cached_leaderboard(key: tuple, load: Callable[[], dict]) -> dict:
+    now = time.monotonic()
+    entry = leaderboard_cache.get(key)
+    if entry and entry[0] == leaderboard_generation and entry[1] > now:
+        metrics.inc("leaderboard_cache_hits")
+        return entry[2]
+    metrics.inc("leaderboard_cache_misses")
+    result = load()
+    if len(leaderboard_cache) >= LEADERBOARD_CACHE_MAX:
+        leaderboard_cache.clear()
+    leaderboard_cache[key] = (leaderboard_generation, now + LEADERBOARD_CACHE_SECONDS, result)
+    return result
+
+def _cursor_signature(payload: str) -> str:
+    return hashlib.blake2b(payload.encode(), key=SESSION_SECRET[:64], digest_size=8).hexdigest()
+
+def encode_leaderboard_cursor(level: int, xp: int, user_id: int, rank: int) -> str:
+    payload = f"{level}.{xp}.{user_id}.{rank}"
+    return f"{payload}.{_cursor_signature(payload)}"
+
+def decode_leaderboard_cursor(cursor: str) -> tuple[int, int, int, int]:
+    """Raises ValueError for a malformed or tampered cursor."""
+    payload, _, signature = cursor.rpartition(".")
+    if not hmac.compare_digest(_cursor_signature(payload), signature):
+        raise ValueError("Bad leaderboard cursor signature")
+    level, xp, user_id, rank = (int(part) for part in payload.split("."))
+    return level, xp, user_id, rank
+
+def level_counts(cur) -> Dict[int, int]:
+    """Players per level; a full index scan, so shared and refreshed on a timer rather than per write."""
+    global level_counts_cache
+    expires_at, counts = level_counts_cache
+    if expires_at > time.monotonic():
+        return counts
+    cur.execute("SELECT level, COUNT(*) FROM users GROUP BY level")
+    counts = dict(cur.fetchall())
+    level_counts_cache = (time.monotonic() + LEADERBOARD_LEVEL_COUNTS_SECONDS, counts)
+    return counts
+
+def _leaderboard_row(row, rank: int) -> dict:
+    return {"rank": rank, "username": row[1], "balance": row[2], "xp": row[3], "level": row[4]}
+
+def leaderboard_page(after: Optional[tuple[int, int, int, int]], limit: int) -> dict:
+    conn = None
+    try:
+        conn = get_db_connection(read_only=True)
+        cur = conn.cursor()
+        if after:
+            level, xp, user_id, rank = after
+            cur.execute(
+                "SELECT user_id, username, balance, xp, level FROM users WHERE (level, xp, user_id) < (%s, %s, %s) "
+                "ORDER BY level DESC, xp DESC, user_id DESC LIMIT %s",
+                (level, xp, user_id, limit)
+            )
+        else:
+            rank = 0
+            cur.execute("SELECT user_id, username, balance, xp, level FROM users ORDER BY level DESC, xp DESC, user_id DESC LIMIT %s", (limit,))
+        rows = cur.fetchall()
+    finally:
+        if conn:
+            conn.close()
+    page = [_leaderboard_row(row, rank + i + 1) for i, row in enumerate(rows)]
+    next_cursor = None
+    if len(rows) == limit:
+        last = rows[-1]
+        next_cursor = encode_leaderboard_cursor(last[4], last[3], last[0], rank + len(rows))
+    return {"leaderboard": page, "next_cursor": next_cursor}
+
+def leaderboard_around(user_id: int, radius: int) -> dict:
+    """The user's rank plus `radius` neighbours on each side."""
+    conn = None
+    try:
+        conn = get_db_connection(read_only=True)
+        cur = conn.cursor()
+        cur.execute("SELECT user_id, username, balance, xp, level FROM users WHERE user_id = %s", (user_id,))
+        me = cur.fetchone()
+        if not me:
+            raise UserNotFound(f"User {user_id} does not exist.")
+        key = (me[4], me[3], me[0])
+        # Higher levels from the shared head count; the index range scan covers only the user's own level
+        higher = sum(count for level, count in level_counts(cur).items() if level > me[4])
+        cur.execute("SELECT COUNT(*) FROM users WHERE level = %s AND (xp, user_id) > (%s, %s)", key)
+        rank = higher + cur.fetchone()[0] + 1
+        cur.execute(
+            "SELECT user_id, username, balance, xp, level FROM users WHERE (level, xp, user_id) > (%s, %s, %s) "
+            "ORDER BY level, xp, user_id LIMIT %s",
+            (*key, radius)
+        )
+        above = cur.fetchall()[::-1]
+        cur.execute(
+            "SELECT user_id, username, balance, xp, level FROM users WHERE (level, xp, user_id) < (%s, %s, %s) "
+            "ORDER BY level DESC, xp DESC, user_id DESC LIMIT %s",
+            (*key, radius)
+        )
+        below = cur.fetchall()
+    finally:
+        if conn:
+            conn.close()
+    rows = above + [me] + below
+    first_rank = rank - len(above)
+    players = [_leaderboard_row(row, first_rank + i) for i, row in enumerate(rows)]
+    for player, row in zip(players, rows):
+        player["is_me"] = row[0] == user_id
+    return {"rank": rank, "players": players}
+
+# --- Game Analytics ---
+# Games add to in-memory counters keyed by (hour, game) and (hour, room); a background task
+# upserts the deltas into the hourly rollup tables every few seconds. Dashboards read the
+# rollups only. A failed flush keeps its deltas for the next attempt.
+ANALYTICS_FLUSH_SECONDS = float(os.getenv('ANALYTICS_FLUSH_SECONDS', '5'))
+STATS_MAX_HOURS = 24 * 31
+
+GAME_STAT_FIELDS = ("plays", "wagered", "paid_out", "rounds", "round_seconds")
+ROOM_STAT_FIELDS = ("rounds", "hands", "wagered", "paid_out", "round_seconds")
+
+def _current_hour() -> datetime:
+    return datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+def _add_stats(store: dict, key: tuple, fields: tuple, values: dict):
+    row = store.get(key)
+    if row is None:
+        row = store[key] = dict.fromkeys(fields, 0)
+    for field, value in values.items():
+        row[field] += value
+
+class GameStats:
+    def __init__(self):
+        self.games: Dict[tuple, dict] = {} # (hour, game) -> field -> delta
+        self.rooms: Dict[tuple, dict] = {} # (hour, room_id) -> field -> delta
+        self.task: Optional[asyncio.Task] = None
+
+    def record(self, game: str, plays: int = 1, wagered: int = 0, paid_out: int = 0):
+        _add_stats(self.games, (_current_hour(), game), GAME_STAT_FIELDS, {"plays": plays, "wagered": wagered, "paid_out": paid_out})
+
+    def record_round(self, room_id: str, hands: int, wagered: int, paid_out: int, seconds: float):
+        hour = _current_hour()
+        _add_stats(self.games, (hour, "blackjack"), GAME_STAT_FIELDS, {
+            "plays": hands, "wagered": wagered, "paid_out": paid_out, "rounds": 1, "round_seconds": seconds
+        })
+        _add_stats(self.rooms, (hour, room_id), ROOM_STAT_FIELDS, {
+            "rounds": 1, "hands": hands, "wagered": wagered, "paid_out": paid_out, "round_seconds": seconds
+        })
+
+    def start(self):
+        self.task = asyncio.create_task(self._run(), name="analytics-flush")
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+        await self.flush() # Don't lose the last few seconds on a clean shutdown
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(ANALYTICS_FLUSH_SECONDS)
+            await self.flush()
+
+    async def flush(self):
+        games, rooms = self.games, self.rooms
+        if not games and not rooms:
+            return
+        self.games, self.rooms = {}, {}
+        try:
+            await asyncio.to_thread(write_stats, games, rooms)
+            metrics.inc("analytics_rows_flushed", len(games) + len(rooms))
+        except Exception as e:
+            logger.error(f"Analytics flush failed, keeping {len(games) + len(rooms)} rows for the next attempt: {e}")
+            metrics.inc("analytics_flush_errors")
+            for key, values in games.items():
+                _add_stats(self.games, key, GAME_STAT_FIELDS, values)
+            for key, values in rooms.items():
+                _add_stats(self.rooms, key, ROOM_STAT_FIELDS, values)
+
+def write_stats(games: Dict[tuple, dict], rooms: Dict[tuple, dict]):
+    """Adds the deltas to the hourly rollups: one multi-row upsert per table, one transaction."""
+    def upsert(cursor, table: str, key_column: str, fields: tuple, deltas: Dict[tuple, dict]):
+        if not deltas:
+            return
+        query = sql.SQL("INSERT INTO {table} (hour, {key_column}, {columns}) VALUES %s ON CONFLICT (hour, {key_column}) DO UPDATE SET {updates}").format(
+            table=sql.Identifier(table),
+            key_column=sql.Identifier(key_column),
+            columns=sql.SQL(", ").join(map(sql.Identifier, fields)),
+            updates=sql.SQL(", ").join(
+                sql.SQL("{f} = {table}.{f} + EXCLUDED.{f}").format(f=sql.Identifier(f), table=sql.Identifier(table)) for f in fields
+            ),
+        )
+        execute_values(cursor, query, [(hour, key, *(row[f] for f in fields)) for (hour, key), row in deltas.items()])
+
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        upsert(cursor, "game_stats_hourly", "game", GAME_STAT_FIELDS, games)
+        upsert(cursor, "room_stats_hourly", "room_id", ROOM_STAT_FIELDS, rooms)
+        conn.commit()
+    except Exception:
+        if conn:
+            conn.rollback()
+        raise
+    finally:
+        if conn:
+            conn.close()
+
+def query_game_stats(hours: int, game: Optional[str] = None) -> List[dict]:
+    conn = None
+    try:
+        conn = get_db_connection(read_only=True)
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT hour, game, plays, wagered, paid_out, rounds, round_seconds FROM game_stats_hourly
+            WHERE hour >= date_trunc('hour', NOW()) - make_interval(hours => %s) AND (%s::text IS NULL OR game = %s)
+            ORDER BY hour, game
+        """, (hours - 1, game, game))
+        rows = cur.fetchall()
+    finally:
+        if conn:
+            conn.close()
+    return [{
+        "hour": hour.isoformat(), "game": game, "plays": plays, "wagered": wagered, "paid_out": paid_out,
+        "rtp": paid_out / wagered if wagered else None,
+        "rounds": rounds, "avg_round_seconds": round_seconds / rounds if rounds else None,
+    } for hour, game, plays, wagered, paid_out, rounds, round_seconds in rows]
+
+def query_room_stats(hours: int) -> List[dict]:
+    conn = None
+    try:
+        conn = get_db_connection(read_only=True)
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT room_id, SUM(rounds), SUM(hands), SUM(wagered), SUM(paid_out), SUM(round_seconds) FROM room_stats_hourly
+            WHERE hour >= date_trunc('hour', NOW()) - make_interval(hours => %s)
+            GROUP BY room_id ORDER BY SUM(rounds) DESC
+        """, (hours - 1,))
+        rows = cur.fetchall()
+    finally:
+        if conn:
+            conn.close()
+    return [{
+        "room_id": room_id, "rounds": int(rounds), "hands": int(hands), "wagered": int(wagered), "paid_out": int(paid_out),
+        "avg_round_seconds": round_seconds / rounds if rounds else None,
+    } for room_id, rounds, hands, wagered, paid_out, round_seconds in rows]
+
+game_stats = GameStats()
+
+# --- Idempotency ---
+# Money-moving requests may carry an Idempotency-Key. The first response for a key (success
+# or a 4xx) is stored and replayed for any retry, which never touches the wallet again. Keys
+# are scoped per endpoint and user. With IDEMPOTENCY_DB set, keys are also recorded in the
+# idempotency_keys table so retries that land on another worker are caught too.
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv('IDEMPOTENCY_TTL_SECONDS', str(24 * 3600)))
+IDEMPOTENCY_CACHE_MAX = int(os.getenv('IDEMPOTENCY_CACHE_MAX', '50000'))
+IDEMPOTENCY_DB = os.getenv('IDEMPOTENCY_DB', '').lower() in ('1', 'true', 'yes')
+IDEMPOTENCY_KEY_MAX_LENGTH = 128
+IDEMPOTENCY_LEASE_SECONDS = 30 # An unanswered key older than this belongs to a worker that died mid-request
+
+class IdempotencyCache:
+    """Bounded TTL map of key -> (status_code, body); oldest entries go first."""
+
+    def __init__(self, ttl_seconds: float, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.entries: OrderedDict = OrderedDict() # key -> (expires_at, status_code, body)
+
+    def get(self, key: str) -> Optional[tuple[int, Any]]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self.entries[key]
+            return None
+        return entry[1], entry[2]
+
+    def put(self, key: str, status_code: int, body: Any):
+        self.entries[key] = (time.monotonic() + self.ttl_seconds, status_code, body)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+idempotency_cache = IdempotencyCache(IDEMPOTENCY_TTL_SECONDS, IDEMPOTENCY_CACHE_MAX)
+idempotency_in_flight: Dict[str, asyncio.Future] = {}
+_idempotency_last_purge = 0.0
+
+def reserve_idempotency_key(key: str) -> Optional[tuple[Optional[int], Any]]:
+    """Claims `key` in the DB. Returns None if it is new (or its lease ran out unanswered), else
+    the stored (status_code, body); status_code is None while another worker is running it."""
+    global _idempotency_last_purge
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        if time.monotonic() - _idempotency_last_purge > 3600:
+            cursor.execute("DELETE FROM idempotency_keys WHERE created_at < NOW() - make_interval(secs => %s)", (IDEMPOTENCY_TTL_SECONDS,))
+            _idempotency_last_purge = time.monotonic()
+        cursor.execute("""
+            INSERT INTO idempotency_keys (key) VALUES (%s)
+            ON CONFLICT (key) DO UPDATE SET reserved_at = NOW()
+            WHERE idempotency_keys.status_code IS NULL
+              AND idempotency_keys.reserved_at < NOW() - make_interval(secs => %s)
+            RETURNING key
+        """, (key, IDEMPOTENCY_LEASE_SECONDS))
+        if cursor.fetchone():
+            conn.commit()
+            return None
+        cursor.execute("SELECT status_code, response FROM idempotency_keys WHERE key = %s", (key,))
+        row = cursor.fetchone()
+        conn.commit()
+        return (row[0], row[1]) if row else None
+    finally:
+        if conn:
+            conn.close()
+
+def store_idempotent_response(key: str, status_code: Optional[int], body: Any):
+    """Records the response for `key`; status_code None releases the key (e.g. after a 5xx)."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        if status_code is None:
+            cursor.execute("DELETE FROM idempotency_keys WHERE key = %s", (key,))
+        else:
+            cursor.execute(
+                "UPDATE idempotency_keys SET status_code = %s, response = %s::jsonb WHERE key = %s",
+                (status_code, json.dumps(body), key)
+            )
+        conn.commit()
+    finally:
+        if conn:
+            conn.close()
+
+def _replay(scope: str, status_code: int, body: Any):
+    metrics.inc("idempotent_replays", scope=scope)
+    if status_code >= 400:
+        raise HTTPException(status_code=status_code, detail=body)
+    return body
+
+async def run_idempotent(scope: str, user_id: int, idempotency_key: Optional[str], handler: Callable[[], Awaitable[Any]]):
+    """Runs `handler` once per key, behind the `scope` rate limit. Retries of a request that was
+    already answered get the stored answer and are never rate limited."""
+    if not idempotency_key:
+        enforce_rate_limit(scope, user_id)
+        return await handler()
+    if len(idempotency_key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise HTTPException(status_code=400, detail={"error": "Idempotency-Key is too long"})
+    key = f"{scope}:{user_id}:{idempotency_key}"
+
+    cached = idempotency_cache.get(key)
+    if cached:
+        return _replay(scope, *cached)
+    in_flight = idempotency_in_flight.get(key)
+    if in_flight:
+        # Same key retried while the first request is still running here: share its outcome
+        metrics.inc("idempotent_waits", scope=scope)
+        await asyncio.shield(in_flight)
+        cached = idempotency_cache.get(key)
+        if cached:
+            return _replay(scope, *cached)
+        return await run_idempotent(scope, user_id, idempotency_key, handler) # First attempt failed with a 5xx
+
+    if IDEMPOTENCY_DB:
+        stored = reserve_idempotency_key(key)
+        if stored:
+            if stored[0] is None:
+                raise HTTPException(status_code=409, detail={"error": "Request with this Idempotency-Key is still in progress"})
+            idempotency_cache.put(key, *stored)
+            return _replay(scope, *stored)
+
     try:
-        user_data = get_user_data(user_id) # Use the single get_user_data
-        await message.answer(
-            f"Ваш баланс: {user_data['balance']} фантиків.\n"
-            f"Ваш рівень: {user_data['level']} (XP: {user_data['xp']}/{get_next_level_xp(user_data['level'])})"
-        )
-    except Exception as e:
-        logger.error(f"Error in command_balance_handler for user {user_id}: {e}")
-        await message.answer("Вибачте, не вдалося отримати ваш баланс.")
+        enforce_rate_limit(scope, user_id) # Only requests that will actually run spend a token
+    except HTTPException:
+        if IDEMPOTENCY_DB:
+            store_idempotent_response(key, None, None) # Not an answer: the client may retry with the same key
+        raise
+
+    future = asyncio.get_running_loop().create_future()
+    idempotency_in_flight[key] = future
+    status_code, body = None, None
+    try:
+        body = await handler()
+        status_code = 200
+        return body
+    except HTTPException as e:
+        if e.status_code < 500: # Client errors are answers too; server errors may be retried
+            status_code, body = e.status_code, e.detail
+        raise
+    finally:
+        if status_code is not None:
+            idempotency_cache.put(key, status_code, body)
+        if IDEMPOTENCY_DB:
+            try:
+                store_idempotent_response(key, status_code, body)
+            except Exception as e:
+                logger.error(f"Could not store idempotent response for {key}: {e}")
+        del idempotency_in_flight[key]
+        future.set_result(None)
+
+# --- Sessions ---
+# The webapp signs in once with Telegram's initData and then sends "Authorization: Bearer <token>"
+# (WebSockets: ?token=...). Tokens are checked with an HMAC, or from a cache of recent checks.
+SESSION_AUTH_REQUIRED = os.getenv('SESSION_AUTH_REQUIRED', '1').lower() not in ('0', 'false', 'no') # 0: tokenless calls still trusted, for local testing
+SESSION_TTL_SECONDS = int(os.getenv('SESSION_TTL_SECONDS', str(24 * 3600)))
+INIT_DATA_MAX_AGE_SECONDS = int(os.getenv('INIT_DATA_MAX_AGE_SECONDS', str(24 * 3600)))
+SESSION_CACHE_SIZE = int(os.getenv('SESSION_CACHE_SIZE', '10000'))
+# Set SESSION_SECRET when several processes must accept each other's tokens; otherwise it follows the bot token
+SESSION_SECRET = session_auth.session_secret(os.getenv('SESSION_SECRET'), API_TOKEN) or secrets.token_bytes(32)
+
+session_verifier = session_auth.SessionVerifier(SESSION_SECRET, SESSION_CACHE_SIZE)
+
+def session_user_id(token: Optional[str]) -> Optional[int]:
+    user_id, outcome = session_verifier.verify(token) if token else (None, "missing")
+    metrics.inc("session_checks", outcome=outcome)
+    return user_id
+
+def authorize_user(claimed_user_id: int | str, authorization: Optional[str]):
+    """Raises 401 without a valid session token and 403 if the token is for another user."""
+    token = authorization[len("Bearer "):] if authorization and authorization.startswith("Bearer ") else None
+    user_id = session_user_id(token)
+    if user_id is None:
+        if token is None and not SESSION_AUTH_REQUIRED:
+            return
+        raise HTTPException(status_code=401, detail={"error": "Unauthorized", "message": "Сесія недійсна. Відкрийте гру з Telegram ще раз."})
+    if str(user_id) != str(claimed_user_id):
+        raise HTTPException(status_code=403, detail={"error": "Forbidden", "message": "Це не ваш акаунт."})
+
+class SessionRequest(BaseModel):
+    init_data: str # Telegram.WebApp.initData, verbatim
+
+@app.post("/api/auth/session")
+async def create_session(request: SessionRequest):
+    if not API_TOKEN:
+        raise HTTPException(status_code=503, detail={"error": "Sign-in unavailable", "message": "BOT_TOKEN is not set"})
+    try:
+        user = session_auth.validate_init_data(request.init_data, session_auth.init_data_secret(API_TOKEN), INIT_DATA_MAX_AGE_SECONDS)
+    except session_auth.InvalidInitData as e:
+        metrics.inc("session_logins", outcome="rejected")
+        logger.warning(f"Rejected Telegram sign-in: {e}")
+        raise HTTPException(status_code=401, detail={"error": "Invalid initData", "message": "Не вдалося підтвердити вхід через Telegram."})
+    token, expires_at = session_auth.issue_token(SESSION_SECRET, user["id"], SESSION_TTL_SECONDS)
+    metrics.inc("session_logins", outcome="issued")
+    return {"token": token, "user_id": int(user["id"]), "expires_at": expires_at}
 
 # --- API Endpoints for WebApp ---
 class UserRequest(BaseModel):
@@ -323,6 +1986,10 @@ class SpinRequest(UserRequest):
 class CoinFlipRequest(UserRequest):
     choice: str # 'heads' or 'tails'
 
+class LineSpinRequest(UserRequest):
+    lines: int = slot_machine.MAX_LINES
+    bet_per_line: int = 1
+
 class BetRequest(UserRequest):
     amount: int
     room_id: str # For Blackjack
@@ -331,9 +1998,11 @@ class HitStandRequest(UserRequest):
     room_id: str
 
 @app.post("/api/get_balance")
-async def get_balance(request: UserRequest):
+async def get_balance(request: UserRequest, authorization: Optional[str] = Header(None)):
+    authorize_user(request.user_id, authorization)
     try:
-        user_data = get_user_data(request.user_id) # Use the single get_user_data
+        ensure_user(request.user_id, request.username)
+        user_data = get_user_data(request.user_id, read_only=True)
         user_data['next_level_xp'] = get_next_level_xp(user_data['level'])
         return user_data
     except Exception as e:
@@ -341,27 +2010,28 @@ async def get_balance(request: UserRequest):
         raise HTTPException(status_code=500, detail={"error": "Failed to retrieve balance", "message": str(e)})
 
 @app.post("/api/spin")
-async def spin_slot(request: SpinRequest):
+async def spin_slot(request: SpinRequest, idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"), authorization: Optional[str] = Header(None)):
+    authorize_user(request.user_id, authorization)
+    return await run_idempotent("spin", request.user_id, idempotency_key, lambda: _spin_slot(request))
+
+async def _spin_slot(request: SpinRequest):
     user_id = request.user_id
     username = request.username
     SPIN_COST = 100
     
     try:
-        user_data = get_user_data(user_id) # Use the single get_user_data
-        if user_data["balance"] < SPIN_COST:
-            raise HTTPException(status_code=400, detail={"error": "Insufficient funds"})
+        ensure_user(user_id, username)
+        rng = request_rng(user_id)
 
-        # Deduct cost
-        user_data["balance"] -= SPIN_COST
-        
         # Spin logic
         symbols = ['🍒', '🍋', '🍊', '🍇', '🔔', '💎', '🍀']
         wild_symbol = '⭐'
         scatter_symbol = '💰'
         
-        reel1 = random.choice(symbols)
-        reel2 = random.choice(symbols)
-        reel3 = random.choice(symbols)
+        reel1 = rng.choice(symbols)
+        reel2 = rng.choice(symbols)
+        reel3 = rng.choice(symbols)
+        logger.info(f"Spin for user {user_id}: seed={rng.seed_value}, symbols={[reel1, reel2, reel3]}")
 
         # For testing purposes, uncomment to force a win
         # reel1 = '🍒'
@@ -401,18 +2071,18 @@ async def spin_slot(request: SpinRequest):
                 winnings += 20 # Small bonus for scatters
                 xp_gain += 1
 
-        user_data["balance"] += winnings
-        user_data["xp"] += xp_gain
-        
-        new_level, new_xp = calculate_level_and_xp(user_data["xp"], user_data["level"])
-        user_data["level"] = new_level
-        user_data["xp"] = new_xp # XP might not change if level up consumes it, but here it just accumulates
-
-        update_user_data(user_id, balance=user_data["balance"], xp=user_data["xp"], level=user_data["level"]) # Use the single update_user_data
+        # Cost and winnings go to the wallet in one conditional write
+        user_data = apply_wager(user_id, SPIN_COST, winnings, xp_gain)
+        if user_data is None:
+            raise HTTPException(status_code=400, detail={"error": "Insufficient funds"})
+        if user_data["leveled_up"]:
+            enqueue_notification(user_id, "level_up", level_up_text(user_data["level"]))
+        game_stats.record("slots", wagered=SPIN_COST, paid_out=winnings)
 
         return {
             "symbols": [reel1, reel2, reel3],
             "winnings": winnings,
+            "seed": rng.seed_value,
             "balance": user_data["balance"],
             "xp": user_data["xp"],
             "level": user_data["level"],
@@ -425,7 +2095,11 @@ async def spin_slot(request: SpinRequest):
         raise HTTPException(status_code=500, detail={"error": "Spin failed", "message": str(e)})
 
 @app.post("/api/coin_flip")
-async def coin_flip(request: CoinFlipRequest):
+async def coin_flip(request: CoinFlipRequest, idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"), authorization: Optional[str] = Header(None)):
+    authorize_user(request.user_id, authorization)
+    return await run_idempotent("coin_flip", request.user_id, idempotency_key, lambda: _coin_flip(request))
+
+async def _coin_flip(request: CoinFlipRequest):
     user_id = request.user_id
     username = request.username
     choice = request.choice
@@ -435,32 +2109,28 @@ async def coin_flip(request: CoinFlipRequest):
         raise HTTPException(status_code=400, detail={"error": "Invalid choice. Must be 'heads' or 'tails'."})
 
     try:
-        user_data = get_user_data(user_id) # Use the single get_user_data
-        if user_data["balance"] < FLIP_COST:
-            raise HTTPException(status_code=400, detail={"error": "Insufficient funds"})
-
-        user_data["balance"] -= FLIP_COST
-
-        result = random.choice(['heads', 'tails'])
+        ensure_user(user_id, username)
+        rng = request_rng(user_id)
+        result = rng.choice(['heads', 'tails'])
+        logger.info(f"Coin flip for user {user_id}: seed={rng.seed_value}, result={result}")
         winnings = 0
         xp_gain = 0
         message = ""
 
         if result == choice:
             winnings = FLIP_COST * 2 # Double the bet
-            user_data["balance"] += winnings
             xp_gain = 5
             message = f"🎉 Вітаємо! Ви вгадали! Ви виграли {winnings} фантиків!"
         else:
             xp_gain = 1 # Small XP even on loss
             message = "😢 На жаль, ви не вгадали. Спробуйте ще раз!"
 
-        user_data["xp"] += xp_gain
-        new_level, new_xp = calculate_level_and_xp(user_data["xp"], user_data["level"])
-        user_data["level"] = new_level
-        user_data["xp"] = new_xp
-
-        update_user_data(user_id, balance=user_data["balance"], xp=user_data["xp"], level=user_data["level"]) # Use the single update_user_data
+        user_data = apply_wager(user_id, FLIP_COST, winnings, xp_gain)
+        if user_data is None:
+            raise HTTPException(status_code=400, detail={"error": "Insufficient funds"})
+        if user_data["leveled_up"]:
+            enqueue_notification(user_id, "level_up", level_up_text(user_data["level"]))
+        game_stats.record("coin_flip", wagered=FLIP_COST, paid_out=winnings)
 
         return {
             "result": result,
@@ -469,7 +2139,8 @@ async def coin_flip(request: CoinFlipRequest):
             "xp": user_data["xp"],
             "level": user_data["level"],
             "next_level_xp": get_next_level_xp(user_data["level"]),
-            "message": message
+            "message": message,
+            "seed": rng.seed_value
         }
 
     except HTTPException:
@@ -478,41 +2149,81 @@ async def coin_flip(request: CoinFlipRequest):
         logger.error(f"API Error /api/coin_flip for user {user_id}: {e}")
         raise HTTPException(status_code=500, detail={"error": "Coin flip failed", "message": str(e)})
 
-@app.post("/api/claim_daily_bonus")
-async def claim_daily_bonus(request: UserRequest):
+@app.post("/api/spin_lines")
+async def spin_lines(request: LineSpinRequest, idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"), authorization: Optional[str] = Header(None)):
+    authorize_user(request.user_id, authorization)
+    return await run_idempotent("spin_lines", request.user_id, idempotency_key, lambda: _spin_lines(request))
+
+async def _spin_lines(request: LineSpinRequest):
+    """5-reel slot with up to 25 paylines and a variable bet per line."""
     user_id = request.user_id
-    username = request.username
-    BONUS_AMOUNT = 500
-    COOLDOWN_HOURS = 24
+    if not 1 <= request.lines <= slot_machine.MAX_LINES:
+        raise HTTPException(status_code=400, detail={"error": f"lines must be between 1 and {slot_machine.MAX_LINES}"})
+    if not slot_machine.MIN_BET_PER_LINE <= request.bet_per_line <= slot_machine.MAX_BET_PER_LINE:
+        raise HTTPException(status_code=400, detail={"error": f"bet_per_line must be between {slot_machine.MIN_BET_PER_LINE} and {slot_machine.MAX_BET_PER_LINE}"})
+    total_bet = request.lines * request.bet_per_line
 
     try:
-        user_data = get_user_data(user_id) # Use the single get_user_data
-        last_claim = user_data.get("last_daily_bonus_claim")
-        now = datetime.now(timezone.utc)
+        ensure_user(user_id, request.username)
+        rng = request_rng(user_id)
+        result = slot_machine.spin(rng, request.lines, request.bet_per_line)
+        logger.info(f"Line spin for user {user_id}: seed={rng.seed_value}, stops={result.stops}, bet={total_bet}, win={result.total_win}")
+
+        user_data = apply_wager(user_id, total_bet, result.total_win, slot_machine.xp_for(result))
+        if user_data is None:
+            raise HTTPException(status_code=400, detail={"error": "Insufficient funds"})
+        if user_data["leveled_up"]:
+            enqueue_notification(user_id, "level_up", level_up_text(user_data["level"]))
+        game_stats.record("line_slots", wagered=total_bet, paid_out=result.total_win)
+
+        return {
+            "grid": result.grid,
+            "line_wins": [
+                {"line": w.line, "symbol": w.symbol, "count": w.count, "win": w.win,
+                 "rows": slot_machine.PAYLINES[w.line].tolist()}
+                for w in result.line_wins
+            ],
+            "scatter_count": result.scatter_count,
+            "scatter_win": result.scatter_win,
+            "total_bet": total_bet,
+            "winnings": result.total_win,
+            "seed": rng.seed_value,
+            "balance": user_data["balance"],
+            "xp": user_data["xp"],
+            "level": user_data["level"],
+            "next_level_xp": get_next_level_xp(user_data["level"])
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"API Error /api/spin_lines for user {user_id}: {e}")
+        raise HTTPException(status_code=500, detail={"error": "Spin failed", "message": str(e)})
+
+@app.post("/api/claim_daily_bonus")
+async def claim_daily_bonus(request: UserRequest, idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"), authorization: Optional[str] = Header(None)):
+    authorize_user(request.user_id, authorization)
+    return await run_idempotent("claim_daily_bonus", request.user_id, idempotency_key, lambda: _claim_daily_bonus(request))
+
+async def _claim_daily_bonus(request: UserRequest):
+    user_id = request.user_id
 
-        if last_claim and (now - last_claim) < timedelta(hours=COOLDOWN_HOURS):
-            remaining_time = timedelta(hours=COOLDOWN_HOURS) - (now - last_claim)
+    try:
+        result = claim_bonus_for_request(user_id, 'daily')
+        if not result['claimed']:
+            remaining_seconds = int(result['remaining_seconds'])
             raise HTTPException(status_code=429, detail={
                 "error": "Cooldown active",
-                "message": f"Ви вже отримали щоденну винагороду. Спробуйте через {int(remaining_time.total_seconds() // 3600)} год {int((remaining_time.total_seconds() % 3600) // 60)} хв."
+                "message": f"Ви вже отримали щоденну винагороду. Спробуйте через {remaining_seconds // 3600} год {(remaining_seconds % 3600) // 60} хв."
             })
 
-        user_data["balance"] += BONUS_AMOUNT
-        user_data["xp"] += 10 # Small XP for claiming bonus
-        user_data["last_daily_bonus_claim"] = now
-        
-        new_level, new_xp = calculate_level_and_xp(user_data["xp"], user_data["level"])
-        user_data["level"] = new_level
-        user_data["xp"] = new_xp
-
-        update_user_data(
-            user_id,
-            balance=user_data["balance"],
-            xp=user_data["xp"],
-            level=user_data["level"],
-            last_daily_bonus_claim=now
-        ) # Use the single update_user_data
-        return {"message": f"Ви успішно отримали {BONUS_AMOUNT} фантиків!", "amount": BONUS_AMOUNT}
+        return {
+            "message": f"Ви успішно отримали {result['amount']} фантиків!",
+            "amount": result['amount'],
+            "balance": result['balance'],
+            "xp": result['xp'],
+            "level": result['level'],
+            "next_level_xp": get_next_level_xp(result['level'])
+        }
 
     except HTTPException:
         raise
@@ -521,40 +2232,30 @@ async def claim_daily_bonus(request: UserRequest):
         raise HTTPException(status_code=500, detail={"error": "Failed to claim daily bonus", "message": str(e)})
 
 @app.post("/api/claim_quick_bonus")
-async def claim_quick_bonus(request: UserRequest):
+async def claim_quick_bonus(request: UserRequest, idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"), authorization: Optional[str] = Header(None)):
+    authorize_user(request.user_id, authorization)
+    return await run_idempotent("claim_quick_bonus", request.user_id, idempotency_key, lambda: _claim_quick_bonus(request))
+
+async def _claim_quick_bonus(request: UserRequest):
     user_id = request.user_id
-    username = request.username
-    BONUS_AMOUNT = 50
-    COOLDOWN_MINUTES = 15
 
     try:
-        user_data = get_user_data(user_id) # Use the single get_user_data
-        last_claim = user_data.get("last_quick_bonus_claim")
-        now = datetime.now(timezone.utc)
-
-        if last_claim and (now - last_claim) < timedelta(minutes=COOLDOWN_MINUTES):
-            remaining_time = timedelta(minutes=COOLDOWN_MINUTES) - (now - last_claim)
+        result = claim_bonus_for_request(user_id, 'quick')
+        if not result['claimed']:
+            remaining_seconds = int(result['remaining_seconds'])
             raise HTTPException(status_code=429, detail={
                 "error": "Cooldown active",
-                "message": f"Ви вже отримали швидкий бонус. Спробуйте через {int(remaining_time.total_seconds() // 60)} хв {int(remaining_time.total_seconds() % 60)} сек."
+                "message": f"Ви вже отримали швидкий бонус. Спробуйте через {remaining_seconds // 60} хв {remaining_seconds % 60} сек."
             })
 
-        user_data["balance"] += BONUS_AMOUNT
-        user_data["xp"] += 2 # Very small XP for quick bonus
-        user_data["last_quick_bonus_claim"] = now
-        
-        new_level, new_xp = calculate_level_and_xp(user_data["xp"], user_data["level"])
-        user_data["level"] = new_level
-        user_data["xp"] = new_xp
-
-        update_user_data(
-            user_id,
-            balance=user_data["balance"],
-            xp=user_data["xp"],
-            level=user_data["level"],
-            last_quick_bonus_claim=now
-        ) # Use the single update_user_data
-        return {"message": f"Ви успішно отримали {BONUS_AMOUNT} фантиків!", "amount": BONUS_AMOUNT}
+        return {
+            "message": f"Ви успішно отримали {result['amount']} фантиків!",
+            "amount": result['amount'],
+            "balance": result['balance'],
+            "xp": result['xp'],
+            "level": result['level'],
+            "next_level_xp": get_next_level_xp(result['level'])
+        }
 
     except HTTPException:
         raise
@@ -562,532 +2263,949 @@ async def claim_quick_bonus(request: UserRequest):
         logger.error(f"API Error /api/claim_quick_bonus for user {user_id}: {e}")
         raise HTTPException(status_code=500, detail={"error": "Failed to claim quick bonus", "message": str(e)})
 
+class LeaderboardRequest(BaseModel):
+    cursor: Optional[str] = None # next_cursor of the previous page; None for the top
+    limit: int = 100
+
+class AroundMeRequest(UserRequest):
+    radius: int = 5 # Players shown above and below
+
 @app.post("/api/get_leaderboard")
-async def get_leaderboard():
-    conn = None
+async def get_leaderboard(request: Optional[LeaderboardRequest] = None):
+    request = request or LeaderboardRequest()
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        # Order by level descending, then xp descending
-        cur.execute("SELECT username, balance, xp, level FROM users ORDER BY level DESC, xp DESC LIMIT 100")
-        leaderboard_data = cur.fetchall()
-        
-        result = []
-        for row in leaderboard_data:
-            result.append({
-                "username": row[0],
-                "balance": row[1],
-                "xp": row[2],
-                "level": row[3]
-            })
-        return {"leaderboard": result}
+        after = decode_leaderboard_cursor(request.cursor) if request.cursor else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail={"error": "Invalid cursor"})
+    limit = max(1, min(request.limit, LEADERBOARD_PAGE_MAX))
+    try:
+        return cached_leaderboard(("page", request.cursor, limit), lambda: leaderboard_page(after, limit))
     except Exception as e:
         logger.error(f"API Error /api/get_leaderboard: {e}")
         raise HTTPException(status_code=500, detail={"error": "Failed to retrieve leaderboard", "message": str(e)})
-    finally:
-        if conn:
-            conn.close()
+
+@app.post("/api/leaderboard/around_me")
+async def leaderboard_around_me(request: AroundMeRequest, authorization: Optional[str] = Header(None)):
+    authorize_user(request.user_id, authorization)
+    radius = max(0, min(request.radius, LEADERBOARD_PAGE_MAX // 2))
+    try:
+        ensure_user(request.user_id, request.username)
+        return cached_leaderboard(("around", request.user_id, radius), lambda: leaderboard_around(request.user_id, radius))
+    except Exception as e:
+        logger.error(f"API Error /api/leaderboard/around_me for user {request.user_id}: {e}")
+        raise HTTPException(status_code=500, detail={"error": "Failed to retrieve rank", "message": str(e)})
+
+@app.get("/api/metrics")
+async def get_metrics():
+    return metrics.snapshot()
+
+@app.get("/api/stats/games")
+async def get_game_stats(hours: int = 24, game: Optional[str] = None):
+    """Hourly per-game totals from the rollups, oldest hour first."""
+    hours = max(1, min(hours, STATS_MAX_HOURS))
+    try:
+        return {"hours": hours, "stats": query_game_stats(hours, game)}
+    except Exception as e:
+        logger.error(f"API Error /api/stats/games: {e}")
+        raise HTTPException(status_code=500, detail={"error": "Failed to load stats", "message": str(e)})
+
+@app.get("/api/stats/rooms")
+async def get_room_stats(hours: int = 24):
+    """Blackjack rounds per room over the last `hours`, busiest room first."""
+    hours = max(1, min(hours, STATS_MAX_HOURS))
+    try:
+        return {"hours": hours, "rooms": query_room_stats(hours)}
+    except Exception as e:
+        logger.error(f"API Error /api/stats/rooms: {e}")
+        raise HTTPException(status_code=500, detail={"error": "Failed to load stats", "message": str(e)})
+
+@app.get("/api/metrics/stalls")
+async def get_loop_stalls():
+    """Most recent event loop stalls, with the blocking stack, newest last."""
+    return {"threshold_seconds": loop_watchdog.threshold, "stalls": list(loop_watchdog.recent)}
 
 # --- Blackjack Game Logic (Multiplayer with WebSockets) ---
+BROADCAST_TICK_SECONDS = int(os.getenv('BROADCAST_TICK_MS', '50')) / 1000 # Room state frames are coalesced per tick
+START_COUNTDOWN_SECONDS = 20
+BETTING_SECONDS = 20
+TURN_SECONDS = 15
+DEALER_STEP_SECONDS = 1 # Pause between dealer cards, for the client animation
+ROUND_END_PAUSE_SECONDS = 5
+
+
+class ShoePool:
+    """Keeps a few pre-shuffled shoes ready for a room, shuffled in a worker thread.
+
+    Seeds are drawn from the room's RNG strictly in the order shoes are used, so a room
+    seeded with the same value deals the same shoes whether or not the producer kept up.
+    """
+
+    def __init__(self, rng: SeededRng, size: int = 3):
+        self.rng = rng
+        self.size = size
+        self.ready: deque = deque() # (seed, order), oldest first
+        self.pending_seeds: deque = deque() # Drawn seeds whose shuffle is still in flight
+        self.wanted = asyncio.Event()
+        self.task = asyncio.create_task(self._produce(), name="shoe-producer")
+
+    async def _produce(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                while len(self.ready) + len(self.pending_seeds) < self.size:
+                    seed = self.rng.getrandbits(64)
+                    self.pending_seeds.append(seed)
+                    order = await loop.run_in_executor(None, shuffle_shoe, seed)
+                    if self.pending_seeds and self.pending_seeds[0] == seed: # Not already taken synchronously
+                        self.pending_seeds.popleft()
+                        self.ready.append((seed, order))
+                self.wanted.clear()
+                await self.wanted.wait()
+        except asyncio.CancelledError:
+            pass
 
-class Card:
-    def __init__(self, rank, suit):
-        self.rank = rank
-        self.suit = suit
-        self.value = self._get_value()
-
-    def _get_value(self):
-        if self.rank in ['J', 'Q', 'K']:
-            return 10
-        elif self.rank == 'A':
-            return 11 # Ace can be 1 or 11, handle in hand logic
+    def take(self) -> tuple[int, List[int]]:
+        if self.ready:
+            shoe = self.ready.popleft()
         else:
-            return int(self.rank)
+            # Producer fell behind: shuffle the next shoe in sequence on the spot
+            metrics.inc("shoe_pool_misses")
+            seed = self.pending_seeds.popleft() if self.pending_seeds else self.rng.getrandbits(64)
+            shoe = (seed, shuffle_shoe(seed))
+        self.wanted.set()
+        return shoe
+
+    def close(self):
+        self.task.cancel()
+
+# --- WebSocket Connection Writers ---
+WS_SEND_QUEUE_SIZE = int(os.getenv('WS_SEND_QUEUE_SIZE', '32'))
+WS_SLOW_CONSUMER_SECONDS = float(os.getenv('WS_SLOW_CONSUMER_SECONDS', '5')) # Evict if the queue stays full this long
+WS_HEARTBEAT_SECONDS = float(os.getenv('WS_HEARTBEAT_SECONDS', '10')) # Protocol ping interval and reaper sweep period
+WS_HEARTBEAT_MISSES = int(os.getenv('WS_HEARTBEAT_MISSES', '3')) # Missed heartbeats before a connection is dead
+ROOM_IDLE_SECONDS = float(os.getenv('ROOM_IDLE_SECONDS', '60')) # Rooms without live connections are torn down after this
+RECONNECT_GRACE_SECONDS = float(os.getenv('RECONNECT_GRACE_SECONDS', '20')) # A dropped player keeps their seat (and bet) this long
+ROOM_DELTA_BUFFER = 64 # State deltas kept per room for resuming clients
+
+class ConnectionWriter:
+    """Owns the outbound side of one WebSocket.
+
+    Messages go through a bounded queue drained by a dedicated task, so a slow client
+    only ever delays itself. Room state frames are latest-wins: while one is still
+    queued, newer states replace its payload instead of taking another slot. State frames
+    arrive already encoded (see BlackjackRoom._flush_broadcast); other messages are
+    encoded here with the codec negotiated for this connection.
+    """
+    _STATE = object() # Queue marker for the latest-state slot
+    _CLOSE = object() # Queue marker for a graceful close
+
+    def __init__(self, websocket: WebSocket, user_id: int, codec=wire_protocol.DEFAULT_CODEC):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.codec = codec
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=WS_SEND_QUEUE_SIZE)
+        self.latest_state: Optional[str | bytes] = None
+        self.state_queued = False
+        self.full_since: Optional[float] = None
+        self.close_args = (1000, None)
+        self.closed = False
+        self.on_close: Optional[Callable[["ConnectionWriter"], None]] = None # Set by the owning room
+        self.send_started: Optional[float] = None # Set while a frame is being handed to the socket
+        self.task = asyncio.create_task(self._run(), name=f"ws-writer-{user_id}")
+        connection_writers.add(self)
+        metrics.set_gauge("ws_connections", len(connection_writers))
+
+    def send(self, message: dict) -> bool:
+        return self._enqueue(message)
+
+    def send_state(self, frame: str | bytes) -> bool:
+        """Queues an encoded state frame, replacing one that has not been sent yet."""
+        if self.closed:
+            return False
+        self.latest_state = frame
+        if self.state_queued:
+            metrics.inc("ws_state_frames_replaced")
+            return True
+        self.state_queued = self._enqueue(self._STATE)
+        return self.state_queued
+
+    def _enqueue(self, item) -> bool:
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            metrics.inc("ws_messages_dropped")
+            now = time.monotonic()
+            if self.full_since is None:
+                self.full_since = now
+            elif now - self.full_since >= WS_SLOW_CONSUMER_SECONDS:
+                logger.warning(f"Evicting slow WebSocket consumer {self.user_id}: send queue full for {now - self.full_since:.1f}s.")
+                metrics.inc("ws_slow_consumer_evictions")
+                self.abort(code=4008, reason="Slow consumer.")
+            return False
+        depth = self.queue.qsize()
+        if depth <= WS_SEND_QUEUE_SIZE // 2: # Only a real drain clears the slow-consumer clock
+            self.full_since = None
+        metrics.observe("ws_send_queue_depth", depth)
+        return True
 
-    def __str__(self):
-        return f"{self.rank}{self.suit}"
+    def close(self, code: int = 1000, reason: Optional[str] = None):
+        """Sends whatever is already queued, then closes the socket."""
+        if self.closed:
+            return
+        self.close_args = (code, reason)
+        if not self._enqueue(self._CLOSE):
+            self.abort(code, reason)
 
-    def __repr__(self):
-        return self.__str__()
+    def abort(self, code: int = 1011, reason: Optional[str] = None):
+        """Drops queued messages and closes the socket right away."""
+        if self.closed:
+            return
+        self._mark_closed()
+        self.task.cancel()
+        asyncio.create_task(self._close_socket(code, reason))
 
-class Deck:
-    def __init__(self):
-        self.cards = []
-        self.reset()
+    async def _close_socket(self, code: int, reason: Optional[str]):
+        try:
+            await self.websocket.close(code=code, reason=reason)
+        except Exception:
+            pass # Already closed by the peer
+
+    def _mark_closed(self):
+        self.closed = True
+        connection_writers.discard(self)
+        metrics.set_gauge("ws_connections", len(connection_writers))
+        if self.on_close:
+            self.on_close(self)
+
+    async def _run(self):
+        try:
+            while True:
+                item = await self.queue.get()
+                if item is self._CLOSE:
+                    self._mark_closed()
+                    await self._close_socket(*self.close_args)
+                    return
+                if item is self._STATE:
+                    self.state_queued = False
+                    payload = self.latest_state
+                else:
+                    payload = self.codec.encode(item)
+                self.send_started = time.monotonic()
+                if isinstance(payload, bytes):
+                    await self.websocket.send_bytes(payload)
+                    metrics.inc("ws_bytes_sent", len(payload), protocol=self.codec.name)
+                else:
+                    await self.websocket.send_text(payload)
+                    metrics.inc("ws_bytes_sent", len(payload.encode("utf-8")), protocol=self.codec.name)
+                self.send_started = None
+                metrics.inc("ws_frames_sent", protocol=self.codec.name)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"WebSocket writer for {self.user_id} stopped: {e}")
+            if not self.closed:
+                self._mark_closed()
 
-    def reset(self):
-        ranks = ['2', '3', '4', '5', '6', '7', '8', '9', '10', 'J', 'Q', 'K', 'A']
-        suits = ['♠', '♦', '♥', '♣']
-        self.cards = [Card(rank, suit) for rank in ranks for suit in suits]
-        random.shuffle(self.cards)
-
-    def deal_card(self):
-        if not self.cards:
-            self.reset() # Reshuffle if deck is empty
-            logger.info("Deck reshuffled.")
-        return self.cards.pop()
-
-class BlackjackPlayer:
-    def __init__(self, user_id: int, username: str):
-        self.user_id = user_id
-        self.username = username
-        self.hand: List[Card] = []
-        self.score = 0
-        self.bet = 0
-        self.is_playing = True # True if player is active in the current round
-        self.has_bet = False # True if player has placed a bet for the current round
-
-    def add_card(self, card: Card):
-        self.hand.append(card)
-        self._calculate_score()
-
-    def _calculate_score(self):
-        self.score = sum(card.value for card in self.hand)
-        num_aces = sum(1 for card in self.hand if card.rank == 'A')
-        while self.score > 21 and num_aces > 0:
-            self.score -= 10 # Change Ace from 11 to 1
-            num_aces -= 1
-
-    def clear_hand(self):
-        self.hand = []
-        self.score = 0
-        self.bet = 0
-        self.is_playing = True # Reset for next round
-        self.has_bet = False # Reset for next round
-
-    def to_dict(self, hide_dealer_card=False):
-        hand_display = [str(card) for card in self.hand]
-        if hide_dealer_card and self.username == "Dealer" and len(hand_display) > 1:
-            hand_display[0] = "Hidden" # Hide first card for dealer
-        return {
-            "user_id": self.user_id,
-            "username": self.username,
-            "hand": hand_display,
-            "score": self.score,
-            "bet": self.bet,
-            "is_playing": self.is_playing,
-            "has_bet": self.has_bet
-        }
+    def is_zombie(self, now: float) -> bool:
+        """True if a send has been stuck for longer than the heartbeat grace period."""
+        return self.send_started is not None and now - self.send_started > WS_HEARTBEAT_SECONDS * WS_HEARTBEAT_MISSES
+
+connection_writers: set = set() # All live ConnectionWriters in this worker
+
+RoomCommand = Callable[..., Awaitable[Any]]
 
 class BlackjackRoom:
+    """A Blackjack table run as an actor around a BlackjackEngine.
+
+    Every state change goes through `submit`, which puts a command on the room's inbound
+    queue; a single task (`_run_actor`) executes commands one at a time. Timers never touch
+    room state directly, they only submit commands, so ordering is deterministic and no
+    locks are needed. The rules live in the engine; the room adds sockets, timers and wallets.
+    """
+
     def __init__(self, room_id: str, min_players: int = 2, max_players: int = 4):
         self.room_id = room_id
-        self.players: Dict[int, BlackjackPlayer] = {} # user_id -> BlackjackPlayer
-        self.connections: Dict[int, WebSocket] = {} # user_id -> WebSocket
-        self.deck = Deck()
-        self.dealer = BlackjackPlayer(user_id=0, username="Dealer") # Dealer is a special player
-        self.status = "waiting" # waiting, starting_timer, betting, playing, round_end
-        self.min_players = min_players
-        self.max_players = max_players
-        self.current_player_turn: Optional[int] = None
-        self.timer_task: Optional[asyncio.Task] = None
-        self.timer_seconds = 0
-        self.round_in_progress = False
-        self.ping_task: Optional[asyncio.Task] = None
-        logger.info(f"Room {self.room_id} created with min_players={min_players}, max_players={max_players}")
-
-    async def add_player(self, user_id: int, username: str, websocket: WebSocket):
-        if user_id not in self.players:
-            if len(self.players) >= self.max_players:
-                await websocket.send_json({"type": "error", "message": "Кімната повна."})
-                return False
-            self.players[user_id] = BlackjackPlayer(user_id, username)
-            logger.info(f"Player {user_id} ({username}) added to room {self.room_id}. Current players: {len(self.players)}")
-        else:
-            # Player is rejoining, update username and set is_playing to True
-            self.players[user_id].username = username
-            self.players[user_id].is_playing = True
+        self.connections: Dict[int, ConnectionWriter] = {} # user_id -> ConnectionWriter
+        self.rng = SeededRng(derive_seed("room", room_id) if RNG_SEED is not None else None)
+        self.shoes = ShoePool(self.rng)
+        self.engine = BlackjackEngine(min_players, max_players, shoe_source=self.shoes.take)
+        self.round_seeds: deque = deque(maxlen=100) # (round_number, shoe seed) for dispute replays
+        self.deadline_ms: Optional[int] = None # Server wall-clock time (epoch ms) the current phase/turn ends
+        self.timer_handle: Optional[asyncio.TimerHandle] = None # Fires once when the current phase/turn runs out
+        self.timer_generation = 0 # Bumped on every timer (re)start so a stale expiry is ignored
+        self.timed_turn: Optional[int] = None # Player the running turn timer belongs to
+        self.step_handle: Optional[asyncio.TimerHandle] = None # Delayed dealer/round-end steps
+        self.dealer_playing = False
+        self.round_started_at = 0.0 # For the round duration in game_stats
+        self.broadcast_handle: Optional[asyncio.TimerHandle] = None # Pending coalesced state frame
+        self.idle_since: Optional[float] = None # When the room last lost its final live connection
+        self.spectators: set = set() # Read-only ConnectionWriters; unlimited
+        self.last_frames: Dict[str, str | bytes] = {} # codec name -> latest encoded state, shared by every subscriber
+        self.seq = 0 # Bumped on every state frame that actually changed something
+        self.last_state: dict = {}
+        self.deltas: deque = deque(maxlen=ROOM_DELTA_BUFFER) # (seq, changed top-level fields) for resuming clients
+        self.grace_handles: Dict[int, asyncio.TimerHandle] = {} # user_id -> seat release for a dropped connection
+        self.stacks: Dict[int, int] = {} # user_id -> chips at this table (see Table Escrow)
+        self.open_bets: Dict[int, int] = {} # user_id -> bet taken from the stack and not yet settled
+        self.closed = False
+        self.commands: asyncio.Queue = asyncio.Queue()
+        self.actor_task = asyncio.create_task(self._run_actor(), name=f"room-{room_id}")
+        logger.info(f"Room {self.room_id} created with min_players={min_players}, max_players={max_players}, seed={self.rng.seed_value}")
+
+    # Read-only views of the engine state
+    players = property(lambda self: self.engine.players)
+    dealer = property(lambda self: self.engine.dealer)
+    status = property(lambda self: self.engine.status) # waiting, starting_timer, betting, playing, round_end
+    current_player_turn = property(lambda self: self.engine.current_player_turn)
+    dealer_revealed = property(lambda self: self.engine.dealer_revealed)
+    min_players = property(lambda self: self.engine.min_players)
+    max_players = property(lambda self: self.engine.max_players)
+
+    # --- Actor plumbing ---
+    def submit(self, handler: RoomCommand, *args) -> asyncio.Future:
+        """Queues `handler(*args)` for serial execution; the future resolves with its result."""
+        future = asyncio.get_running_loop().create_future()
+        if self.closed:
+            future.set_result(None)
+            return future
+        self.commands.put_nowait((handler, args, time.monotonic(), future))
+        metrics.set_gauge("room_queue_depth", self.commands.qsize(), room=self.room_id)
+        return future
+
+    async def _run_actor(self):
+        while not self.closed:
+            handler, args, enqueued_at, future = await self.commands.get()
+            metrics.set_gauge("room_queue_depth", self.commands.qsize(), room=self.room_id)
+            self.actor_task.set_name(f"room-{self.room_id} {handler.__name__}") # Attribution for the loop watchdog
+            started_at = time.monotonic()
+            try:
+                result = await handler(*args)
+                if not future.done():
+                    future.set_result(result)
+            except Exception as e:
+                logger.error(f"Room {self.room_id}: command {handler.__name__} failed: {e}", exc_info=True)
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                finished_at = time.monotonic()
+                metrics.observe("room_command_wait_seconds", started_at - enqueued_at, room=self.room_id)
+                metrics.observe("room_command_seconds", finished_at - started_at, room=self.room_id, command=handler.__name__)
+        # Room closed: release anyone still waiting on a queued command
+        while not self.commands.empty():
+            _, _, _, future = self.commands.get_nowait()
+            if not future.done():
+                future.set_result(None)
+        metrics.forget(room=self.room_id)
+        logger.info(f"Room {self.room_id}: actor stopped.")
+
+    def _schedule(self, delay: float, handler: RoomCommand, *args):
+        """Runs a follow-up step after `delay` seconds without holding up the command queue."""
+        if self.step_handle:
+            self.step_handle.cancel()
+        self.step_handle = asyncio.get_running_loop().call_later(delay, self.submit, handler, *args)
+
+    def _start_timer(self, seconds: int, on_expire: RoomCommand, *args):
+        """(Re)starts the phase countdown; `on_expire(*args)` is submitted when it runs out.
+
+        Clients get the deadline once, in the next state frame, and count down locally,
+        so a running countdown costs no frames at all.
+        """
+        self._cancel_timer()
+        self.deadline_ms = server_time_ms() + seconds * 1000
+        self.timer_handle = asyncio.get_running_loop().call_later(
+            seconds, self.submit, self._on_timer_expired, self.timer_generation, on_expire, args
+        )
+        self.broadcast_room_state()
+
+    def _cancel_timer(self):
+        self.timer_generation += 1
+        self.deadline_ms = None
+        if self.timer_handle:
+            self.timer_handle.cancel()
+            self.timer_handle = None
+
+    async def _on_timer_expired(self, generation: int, on_expire: RoomCommand, args: tuple):
+        if generation != self.timer_generation:
+            return # Timer was restarted or cancelled after the expiry was queued
+        self.timer_handle = None
+        self.deadline_ms = None
+        await on_expire(*args)
+
+    async def _send_to(self, user_id: int, message: dict):
+        writer = self.connections.get(user_id)
+        if not writer:
+            return
+        await self._flush_broadcast() # Keep direct messages ordered after the state they refer to
+        writer.send(message)
+
+    def _on_writer_closed(self, writer: ConnectionWriter):
+        self.submit(self._drop_connection, writer)
+
+    async def _drop_connection(self, writer: ConnectionWriter):
+        if self.connections.get(writer.user_id) is writer: # Ignore writers already replaced by a reconnect
+            self._start_grace(writer.user_id)
+
+    def _start_grace(self, user_id: int):
+        """Keeps a dropped player's seat for RECONNECT_GRACE_SECONDS; timers keep running meanwhile."""
+        writer = self.connections.pop(user_id, None)
+        if writer:
+            writer.on_close = None
+        if user_id not in self.players or user_id in self.grace_handles:
+            return
+        logger.info(f"Room {self.room_id}: connection of {user_id} lost, holding the seat for {RECONNECT_GRACE_SECONDS:.0f}s.")
+        metrics.inc("ws_grace_started")
+        self.grace_handles[user_id] = asyncio.get_running_loop().call_later(
+            RECONNECT_GRACE_SECONDS, self.submit, self._on_grace_expired, user_id
+        )
+
+    async def _on_grace_expired(self, user_id: int):
+        if self.grace_handles.pop(user_id, None) and user_id not in self.connections:
+            logger.info(f"Room {self.room_id}: {user_id} did not come back, removing player.")
+            metrics.inc("ws_grace_expired")
+            await self.remove_player(user_id)
+
+    # --- Commands ---
+    async def add_player(self, user_id: int, username: str, writer: ConnectionWriter, last_seq: Optional[int] = None, stack: Optional[int] = None):
+        """Seats `user_id` with a bought-in `stack` (or re-attaches a seated player). With
+        `last_seq`, a seated player gets only the deltas they missed instead of a full frame."""
+        rejoining = user_id in self.players
+        if not self.engine.add_player(user_id, username):
+            writer.send({"type": "error", "message": "Кімната повна."})
+            return False
+        if stack is not None and user_id not in self.stacks:
+            self._set_stack(user_id, stack, "buy_in")
+        grace = self.grace_handles.pop(user_id, None)
+        if grace:
+            grace.cancel()
+            metrics.inc("ws_grace_resumed")
+        if rejoining:
             logger.info(f"Player {user_id} ({username}) re-joined room {self.room_id}.")
+        else:
+            logger.info(f"Player {user_id} ({username}) added to room {self.room_id}. Current players: {len(self.players)}")
 
-        self.connections[user_id] = websocket
-        await self.broadcast_room_state()
+        previous = self.connections.get(user_id)
+        if previous and previous is not writer:
+            previous.on_close = None
+            previous.close(code=4001, reason="Replaced by a new connection.")
+        writer.on_close = self._on_writer_closed
+        self.connections[user_id] = writer
+        if rejoining:
+            self._send_catch_up(writer, last_seq)
+        else:
+            self.broadcast_room_state() # Everyone sees the new seat; the newcomer gets the full frame with it
         self._check_and_start_game_if_ready()
         return True
 
+    def _set_stack(self, user_id: int, stack: int, reason: str, bet: int = 0) -> int:
+        """Changes a player's table stack, logging it to the WAL first. Returns the WAL sequence."""
+        wal_seq = escrow_wal.append(user_id, self.room_id, stack, reason, bet)
+        self.stacks[user_id] = stack
+        return wal_seq
+
+    async def _cash_out(self, user_id: int):
+        stack = self.stacks.pop(user_id, None)
+        if stack is None:
+            return
+        try:
+            balance = await asyncio.to_thread(escrow_cash_out, user_id, self.room_id, stack)
+        except Exception as e:
+            logger.error(f"Room {self.room_id}: cash-out of {stack} for {user_id} failed, will retry: {e}")
+            pending_cash_outs[(user_id, self.room_id)] = stack
+            return
+        escrow_wal.append(user_id, self.room_id, stack, "cash_out")
+        logger.info(f"Room {self.room_id}: {user_id} cashed out {stack}; wallet balance {balance}.")
+
+    def refund_open_bets(self):
+        """Shutdown mid-round: bets whose round will never settle go back to the stacks."""
+        for user_id, bet in self.open_bets.items():
+            if user_id in self.stacks:
+                self._set_stack(user_id, self.stacks[user_id] + bet, "refund")
+        self.open_bets.clear()
+
+    def _send_catch_up(self, writer: ConnectionWriter, last_seq: Optional[int]):
+        """Brings one client up to date: the deltas after `last_seq` if the buffer still has
+        them all, else the latest full frame."""
+        if last_seq is not None and last_seq <= self.seq:
+            missed = [{"seq": seq, "changes": changes} for seq, changes in self.deltas if seq > last_seq]
+            oldest = self.deltas[0][0] if self.deltas else self.seq + 1
+            if last_seq == self.seq or oldest <= last_seq + 1:
+                writer.send({"type": "resume", "room_id": self.room_id, "seq": self.seq, "deltas": missed})
+                metrics.inc("ws_resumes", mode="delta")
+                return
+        writer.send_state(self._frame_for(writer.codec))
+        metrics.inc("ws_resumes", mode="full")
+
     async def remove_player(self, user_id: int):
+        grace = self.grace_handles.pop(user_id, None)
+        if grace:
+            grace.cancel()
+        self.open_bets.pop(user_id, None) # Leaving mid-round forfeits the bet, as before
+        await self._cash_out(user_id)
         if user_id in self.players:
-            player_username = self.players[user_id].username
-            del self.players[user_id]
-            if user_id in self.connections:
-                del self.connections[user_id]
+            self.engine.remove_player(user_id) # Passes the turn on if it was theirs
+            writer = self.connections.pop(user_id, None)
+            if writer:
+                writer.on_close = None
             logger.info(f"Player {user_id} removed from room {self.room_id}")
+            if player_room_map.get(user_id) == self.room_id:
+                del player_room_map[user_id]
 
-            # If player left during their turn, advance turn
-            if self.status == "playing" and self.current_player_turn == user_id:
-                await self._advance_turn()
-            
             # If player left during betting and they were the last one to bet, check if round can start
             if self.status == "betting":
                 logger.info(f"Room {self.room_id}: Player {user_id} left during betting. Re-checking round start conditions.")
-                asyncio.create_task(self._check_and_start_round_if_ready()) # Use asyncio.create_task for non-blocking call
+                await self._check_and_start_round_if_ready()
+            await self._on_turn_changed()
             
-            await self.broadcast_room_state()
+            self.broadcast_room_state()
             self._check_and_end_game_if_empty()
         
     def _check_and_start_game_if_ready(self):
-        if len(self.players) >= self.min_players and self.status == "waiting":
-            self.status = "starting_timer"
-            self.timer_seconds = 20 # Start countdown for game start
-            logger.info(f"Room {self.room_id}: Game start timer initiated for {self.timer_seconds} seconds.")
-            self.timer_task = asyncio.create_task(self._countdown_timer("betting"))
+        if self.engine.can_start_countdown():
+            self.engine.start_countdown()
+            logger.info(f"Room {self.room_id}: Game start timer initiated for {START_COUNTDOWN_SECONDS} seconds.")
+            self._start_timer(START_COUNTDOWN_SECONDS, self._on_phase_timer_expired, "betting") # Start countdown for game start
 
     async def _check_and_start_round_if_ready(self):
-        if self.round_in_progress:
-            logger.info(f"Room {self.room_id}: Round already in progress, skipping start check.")
-            return
-
-        active_players = [p for p in self.players.values() if p.is_playing]
-        
-        # Log player has_bet statuses for debugging
-        player_has_bet_status = {p.user_id: p.has_bet for p in self.players.values()}
-        player_is_playing_status = {p.user_id: p.is_playing for p in self.players.values()}
-        logger.info(f"Room {self.room_id}. Player statuses: {player_is_playing_status}. All finished betting: {all(p.has_bet for p in active_players)}. Current players in room: {len(self.players)}. Min players: {self.min_players}. Round in progress: {self.round_in_progress}")
-
-        if len(active_players) >= self.min_players and all(p.has_bet for p in active_players):
+        if self.status == "betting" and self.engine.all_bets_in():
             logger.info(f"Room {self.room_id}: All active players have bet. Starting round.")
-            self.round_in_progress = True
             await self._start_round()
         else:
+            # Players who haven't bet yet are only benched once the betting timer expires
             logger.info(f"Room {self.room_id}: Not all players finished betting or not enough players. Conditions for starting round not met.")
-            # If we are in betting phase and some players haven't bet, reset their is_playing status
-            if self.status == "betting":
-                for player in self.players.values():
-                    if not player.has_bet:
-                        player.is_playing = False # Mark them as not playing this round
-                        logger.info(f"Player {player.user_id} did not bet, marked as not playing this round.")
-                await self.broadcast_room_state() # Update clients with player.is_playing status
 
     def _check_and_end_game_if_empty(self):
         if not self.players:
             logger.info(f"Room {self.room_id} is empty and removed.")
-            if self.timer_task:
-                self.timer_task.cancel()
-            if self.ping_task:
-                self.ping_task.cancel()
-            del rooms[self.room_id] # Remove room from global dict
-
-    async def _countdown_timer(self, next_status: str):
-        try:
-            while self.timer_seconds > 0:
-                await self.broadcast_room_state()
-                await asyncio.sleep(1)
-                self.timer_seconds -= 1
-            
-            self.status = next_status
-            self.timer_seconds = 0
-            logger.info(f"Room {self.room_id}: Timer finished, moving to {next_status} phase.")
-            
-            if next_status == "betting":
-                # Start betting timer
-                self.timer_seconds = 20 # 20 seconds for betting
-                self.timer_task = asyncio.create_task(self._countdown_timer("playing")) # Next phase after betting is playing
-                await self.broadcast_room_state()
-            elif next_status == "playing":
-                # If betting timer finished, and not all players bet, mark them as not playing
-                for player in self.players.values():
-                    if player.is_playing and not player.has_bet:
-                        player.is_playing = False
-                        logger.info(f"Player {player.user_id} did not bet in time, marked as not playing this round.")
-                await self.broadcast_room_state() # Send updated player statuses
-                asyncio.create_task(self._check_and_start_round_if_ready()) # Check if round can start now
-            elif next_status == "round_end":
-                await self._end_round()
-        except asyncio.CancelledError:
-            logger.info(f"Room {self.room_id}: Timer task cancelled.")
-        except Exception as e:
-            logger.error(f"Error in room {self.room_id} timer: {e}")
+            self.close()
+            rooms.pop(self.room_id, None) # Remove room from global dict
+
+    def close(self):
+        self.closed = True
+        self._cancel_timer()
+        if self.step_handle:
+            self.step_handle.cancel()
+        if self.broadcast_handle:
+            self.broadcast_handle.cancel()
+        for handle in self.grace_handles.values():
+            handle.cancel()
+        self.grace_handles.clear()
+        for user_id, stack in self.stacks.items(): # Paid out by the heartbeat's retry sweep
+            pending_cash_outs[(user_id, self.room_id)] = stack
+        self.stacks.clear()
+        self.shoes.close()
+        room_index.pop(self.room_id, None)
+        for writer in self.spectators:
+            writer.on_close = None
+            writer.close(code=1000, reason="Room closed.")
+        self.spectators.clear()
+        # Wake the actor if it is idle so it can notice the room is closed
+        self.commands.put_nowait((self._noop, (), time.monotonic(), asyncio.get_running_loop().create_future()))
+
+    async def _noop(self):
+        return None
+
+    async def _on_phase_timer_expired(self, next_status: str):
+        logger.info(f"Room {self.room_id}: Timer finished, moving to {next_status} phase.")
+        
+        if next_status == "betting":
+            self.engine.open_betting()
+            self._start_timer(BETTING_SECONDS, self._on_phase_timer_expired, "playing") # Betting window, then playing
+            self.broadcast_room_state()
+        elif next_status == "playing":
+            # Betting window closed: whoever didn't bet sits this round out
+            if self.engine.close_betting():
+                await self._start_round()
+            else:
+                logger.info(f"Room {self.room_id}: Fewer than {self.min_players} bets, back to waiting.")
+                self.refund_open_bets() # The round never starts, so bets go back to the stacks
+                self.engine.finish_round()
+                self.broadcast_room_state()
+                self._check_and_start_game_if_ready()
 
     async def _start_round(self):
         logger.info(f"Room {self.room_id}: Starting new round.")
-        self.status = "playing"
-        self.round_in_progress = True
-
-        # Clear hands and reset for all active players
-        for player in self.players.values():
-            player.clear_hand()
-        self.dealer.clear_hand()
-        self.deck.reset()
-
-        # Initial deal
-        for _ in range(2):
-            for player in self.players.values():
-                if player.is_playing: # Only deal to active players
-                    player.add_card(self.deck.deal_card())
-            self.dealer.add_card(self.deck.deal_card())
-        
-        # Determine first player's turn
-        self.current_player_turn = None
-        active_player_ids = [p.user_id for p in self.players.values() if p.is_playing]
-        if active_player_ids:
-            self.current_player_turn = active_player_ids[0]
-            self.timer_seconds = 15 # Timer for player turn
-            self.timer_task = asyncio.create_task(self._countdown_timer_for_turn(self.current_player_turn))
-        else:
-            logger.warning(f"Room {self.room_id}: No active players to start round with after betting phase.")
-            await self._end_round() # End round if no players are active
-
-        await self.broadcast_room_state()
-
-    async def _countdown_timer_for_turn(self, player_id: int):
-        try:
-            while self.timer_seconds > 0 and self.current_player_turn == player_id:
-                await self.broadcast_room_state() # Send state to update timer on client
-                await asyncio.sleep(1)
-                self.timer_seconds -= 1
-            
-            if self.current_player_turn == player_id: # If timer ran out for current player
-                logger.info(f"Player {player_id}'s turn timed out. Automatically standing.")
-                await self.handle_stand(player_id) # Auto-stand
-        except asyncio.CancelledError:
-            logger.info(f"Room {self.room_id}: Player turn timer task cancelled for {player_id}.")
-        except Exception as e:
-            logger.error(f"Error in player turn timer for {player_id} in room {self.room_id}: {e}")
-
-    async def _advance_turn(self):
-        active_player_ids = [p.user_id for p in self.players.values() if p.is_playing]
-        if not active_player_ids:
-            logger.info(f"Room {self.room_id}: No active players left. Ending round.")
-            await self._end_round()
+        self._cancel_timer() # Betting may have closed early
+        self.engine.start_round()
+        self.round_started_at = time.monotonic()
+        self.round_seeds.append((self.engine.round_number, self.engine.deck.seed))
+        logger.info(f"Room {self.room_id}: round {self.engine.round_number} shoe seed {self.engine.deck.seed}.")
+        await self._on_turn_changed()
+        self.broadcast_room_state()
+
+    async def _on_turn_changed(self):
+        """Adapts timers to the engine after an action: a new turn gets a fresh turn timer, the dealer gets scheduled."""
+        if self.status == "playing":
+            if self.current_player_turn != self.timed_turn:
+                self.timed_turn = self.current_player_turn
+                logger.info(f"Room {self.room_id}: Turn of {self.current_player_turn}.")
+                self._start_timer(TURN_SECONDS, self._on_turn_timeout, self.current_player_turn) # Timer for player turn
+        elif self.status == "round_end" and not self.dealer_playing:
+            await self._begin_dealer_play()
+
+    async def _on_turn_timeout(self, player_id: int):
+        if self.current_player_turn == player_id: # If timer ran out for current player
+            logger.info(f"Player {player_id}'s turn timed out. Automatically standing.")
+            await self.handle_stand(player_id) # Auto-stand
+
+    async def handle_bet(self, user_id: int, amount: int, idempotency_key: Optional[str] = None):
+        key = f"ws_bet:{user_id}:{idempotency_key}" if idempotency_key else None
+        if key and idempotency_cache.get(key):
+            # A resent bet (e.g. after a reconnect); the wallet was already charged once
+            metrics.inc("idempotent_replays", scope="ws_bet")
+            writer = self.connections.get(user_id)
+            if writer:
+                writer.send_state(self._frame_for(writer.codec))
             return
-
-        if self.timer_task:
-            self.timer_task.cancel()
-            self.timer_task = None
-
         try:
-            current_player_index = active_player_ids.index(self.current_player_turn)
-            next_player_index = (current_player_index + 1) % len(active_player_ids)
-            self.current_player_turn = active_player_ids[next_player_index]
-            self.timer_seconds = 15 # Reset timer for next player
-            self.timer_task = asyncio.create_task(self._countdown_timer_for_turn(self.current_player_turn))
-            logger.info(f"Room {self.room_id}: Advanced turn to {self.current_player_turn}.")
-        except ValueError: # Current player not found, likely left
-            logger.warning(f"Room {self.room_id}: Current player {self.current_player_turn} not found in active players. Finding next.")
-            self.current_player_turn = active_player_ids[0] # Just pick first active player
-            self.timer_seconds = 15
-            self.timer_task = asyncio.create_task(self._countdown_timer_for_turn(self.current_player_turn))
-        
-        await self.broadcast_room_state()
-
-
-    async def handle_bet(self, user_id: int, amount: int):
-        player = self.players.get(user_id)
-        if not player or self.status != "betting" or player.has_bet:
-            await self.connections[user_id].send_json({"type": "error", "message": "Неправильний стан для ставки або ставка вже зроблена."})
+            self.engine.check_bet(user_id, amount)
+        except InvalidAction as e:
+            await self._send_to(user_id, {"type": "error", "message": str(e)})
             return
 
-        user_data = get_user_data(user_id) # Fetch current balance
-        if user_data["balance"] < amount:
-            await self.connections[user_id].send_json({"type": "error", "message": "Недостатньо фантиків для ставки."})
+        stack = self.stacks.get(user_id, 0)
+        if stack < amount:
+            await self._send_to(user_id, {"type": "game_message", "message": "Недостатньо фантиків у стеку для ставки."})
             return
 
-        player.bet = amount
-        player.has_bet = True
-        user_data["balance"] -= amount # Deduct bet immediately
-        update_user_data(user_id, balance=user_data["balance"], xp=user_data["xp"], level=user_data["level"]) # Update DB
-        logger.info(f"handle_bet: Player {user_id} successfully bet {amount}. New balance: {user_data['balance']}")
-
-        # Log player has_bet statuses for debugging
-        player_has_bet_status = {p.user_id: p.has_bet for p in self.players.values()}
-        logger.info(f"handle_bet: After player {user_id} bet, players' has_bet status: {player_has_bet_status}")
+        self.engine.place_bet(user_id, amount)
+        self._set_stack(user_id, stack - amount, "bet", bet=amount) # In memory and the WAL; no database on the turn path
+        self.open_bets[user_id] = amount
+        if key:
+            idempotency_cache.put(key, 200, amount)
+        logger.info(f"handle_bet: Player {user_id} successfully bet {amount}. Stack left: {stack - amount}")
         
-        await self.broadcast_room_state() # Update all clients with new bet status
-        asyncio.create_task(self._check_and_start_round_if_ready()) # Check if all players have bet and round can start
+        self.broadcast_room_state() # Update all clients with new bet status
+        await self._check_and_start_round_if_ready() # Check if all players have bet and round can start
 
     async def handle_hit(self, user_id: int):
-        player = self.players.get(user_id)
-        if not player or self.status != "playing" or self.current_player_turn != user_id:
-            await self.connections[user_id].send_json({"type": "error", "message": "Зараз не ваш хід або гра не в стані 'playing'."})
+        try:
+            player = self.engine.hit(user_id)
+        except InvalidAction as e:
+            await self._send_to(user_id, {"type": "error", "message": str(e)})
             return
 
-        player.add_card(self.deck.deal_card())
-        
         if player.score > 21:
             logger.info(f"Player {user_id} went bust with score {player.score}.")
-            player.is_playing = False # Player is out for this round
-            await self.connections[user_id].send_json({"type": "game_message", "message": "Перебір! Ваш рахунок більше 21."})
-            await self.broadcast_room_state()
-            await self._advance_turn()
-        else:
-            await self.broadcast_room_state()
+            await self._send_to(user_id, {"type": "game_message", "message": "Перебір! Ваш рахунок більше 21."})
+        self.broadcast_room_state()
+        await self._on_turn_changed()
 
     async def handle_stand(self, user_id: int):
-        player = self.players.get(user_id)
-        if not player or self.status != "playing" or self.current_player_turn != user_id:
-            await self.connections[user_id].send_json({"type": "error", "message": "Зараз не ваш хід або гра не в стані 'playing'."})
+        try:
+            player = self.engine.stand(user_id)
+        except InvalidAction as e:
+            await self._send_to(user_id, {"type": "error", "message": str(e)})
             return
-        
-        player.is_playing = False # Player decided to stand
+
         logger.info(f"Player {user_id} stood with score {player.score}.")
-        await self.connections[user_id].send_json({"type": "game_message", "message": "Ви зупинились."})
-        await self.broadcast_room_state()
-        await self._advance_turn()
-
-    async def _dealer_play(self):
-        logger.info(f"Room {self.room_id}: Dealer's turn. Initial hand: {self.dealer.hand}, score: {self.dealer.score}")
-        while self.dealer.score < 17:
-            self.dealer.add_card(self.deck.deal_card())
+        await self._send_to(user_id, {"type": "game_message", "message": "Ви зупинились."})
+        self.broadcast_room_state()
+        await self._on_turn_changed()
+
+    async def _begin_dealer_play(self):
+        logger.info(f"Room {self.room_id}: Round ending. Dealer's turn. Initial hand: {self.dealer.hand}, score: {self.dealer.score}")
+        self.dealer_playing = True
+        self.timed_turn = None
+        self._cancel_timer()
+        self.broadcast_room_state() # Reveal dealer's hidden card
+        self._schedule(DEALER_STEP_SECONDS, self._dealer_step) # Small delay before dealer plays
+
+    async def _dealer_step(self):
+        if self.engine.dealer_step():
             logger.info(f"Room {self.room_id}: Dealer hits. New hand: {self.dealer.hand}, score: {self.dealer.score}")
-            await self.broadcast_room_state(show_dealer_card=True) # Reveal dealer's hidden card during play
-            await asyncio.sleep(1) # Small delay for animation effect
+            self.broadcast_room_state()
+            self._schedule(DEALER_STEP_SECONDS, self._dealer_step) # Small delay for animation effect
+            return
         logger.info(f"Room {self.room_id}: Dealer stands with score {self.dealer.score}.")
+        self.broadcast_room_state() # Final dealer hand
+        await self._settle_round()
+
+    async def _settle_round(self):
+        # The engine decides every outcome in memory; winnings go to the table stacks, and XP plus
+        # a checkpoint of the stacks are written in one transaction off the event loop
+        outcomes = self.engine.settle()
+        wagered = sum(self.players[o.user_id].bet for o in outcomes if o.participated)
+        results = {o.user_id: {"message": o.message, "winnings": o.winnings, "final_player_score": o.final_score} for o in outcomes}
+        settlements = [(o.user_id, 0, o.xp_gain) for o in outcomes if o.participated]
+        checkpoint = []
+        self.open_bets.clear()
+        for o in outcomes:
+            if o.participated:
+                wal_seq = self._set_stack(o.user_id, self.stacks.get(o.user_id, 0) + o.winnings, "settle")
+                checkpoint.append((o.user_id, self.room_id, self.stacks[o.user_id], wal_seq))
+                results[o.user_id]["stack"] = self.stacks[o.user_id]
+        game_stats.record_round(
+            self.room_id, hands=len(settlements), wagered=wagered,
+            paid_out=sum(o.winnings for o in outcomes if o.participated), seconds=time.monotonic() - self.round_started_at
+        )
 
-
-    async def _end_round(self):
-        logger.info(f"Room {self.room_id}: Round ending. Calculating results.")
-        self.status = "round_end"
-        self.round_in_progress = False
-        self.current_player_turn = None
-        if self.timer_task:
-            self.timer_task.cancel()
-            self.timer_task = None
-
-        # Reveal dealer's hand and play
-        await self.broadcast_room_state(show_dealer_card=True) # Reveal dealer's hidden card
-        await asyncio.sleep(1) # Small delay before dealer plays
-        await self._dealer_play()
-        await self.broadcast_room_state(show_dealer_card=True) # Final dealer hand
-
-        results = {}
-        for user_id, player in list(self.players.items()): # Iterate over a copy in case players leave
-            if not player.is_playing:
-                # If player was not playing (e.g., didn't bet or went bust), they lose their bet
-                results[user_id] = {"message": "Ви не брали участь у раунді або перебрали.", "winnings": 0, "final_player_score": player.score}
-                # No need to deduct balance again, it was deducted on bet
-                continue
-
-            user_data = get_user_data(user_id) # Fetch latest user data
-            winnings = 0
-            xp_gain = 0
-            message = ""
-
-            if player.score > 21: # Already handled by handle_hit, but double check
-                message = "Перебір! Ви програли."
-                # Winnings is 0, bet already deducted
-            elif self.dealer.score > 21:
-                message = "Дилер перебрав! Ви виграли!"
-                winnings = player.bet * 2
-                xp_gain = 10
-            elif player.score > self.dealer.score:
-                message = "Ви виграли у дилера!"
-                winnings = player.bet * 2
-                xp_gain = 10
-            elif player.score < self.dealer.score:
-                message = "Ви програли дилеру."
-                # Winnings is 0, bet already deducted
-                xp_gain = 2 # Small XP for participation
-            else:
-                message = "Нічия! Ваша ставка повернена."
-                winnings = player.bet # Return bet
-                xp_gain = 5
-
-            user_data["balance"] += winnings
-            user_data["xp"] += xp_gain
-            
-            new_level, new_xp = calculate_level_and_xp(user_data["xp"], user_data["level"])
-            
-            # Check for level up notification
-            if new_level > user_data["level"]:
-                await self.connections[user_id].send_json({"type": "level_up", "level": new_level})
-                logger.info(f"Player {user_id} leveled up to {new_level}!")
-
-            user_data["level"] = new_level
-            user_data["xp"] = new_xp
-
-            update_user_data(user_id, balance=user_data["balance"], xp=user_data["xp"], level=user_data["level"])
-            
-            results[user_id] = {
-                "message": message,
-                "winnings": winnings,
-                "balance": user_data["balance"],
-                "xp": user_data["xp"],
-                "level": user_data["level"],
-                "next_level_xp": get_next_level_xp(user_data["level"]),
-                "final_player_score": player.score
-            }
+        try:
+            wallets = await asyncio.to_thread(settle_wallets, settlements, checkpoint)
+        except Exception as e:
+            # Winnings are safe in the stacks and the WAL; only this round's XP is lost
+            logger.error(f"Room {self.room_id}: round XP/checkpoint write failed: {e}", exc_info=True)
+            wallets = {}
+
+        # Only tell players about the outcome once it is committed
+        level_ups = []
+        for user_id, wallet in wallets.items():
+            if wallet['leveled_up']:
+                await self._send_to(user_id, {"type": "level_up", "level": wallet['level']})
+                level_ups.append((user_id, "level_up", level_up_text(wallet['level']), None, 0))
+                logger.info(f"Player {user_id} leveled up to {wallet['level']}!")
+            results[user_id].update({
+                "balance": wallet['balance'],
+                "xp": wallet['xp'],
+                "level": wallet['level'],
+                "next_level_xp": get_next_level_xp(wallet['level'])
+            })
             logger.info(f"Player {user_id} round result: {results[user_id]}")
 
+        if level_ups:
+            try:
+                enqueue_notifications(level_ups) # One INSERT for the whole table
+            except Exception as e:
+                logger.error(f"Room {self.room_id}: could not enqueue level-up notifications: {e}")
+
         # Send individual results to players
         for user_id, result_data in results.items():
-            if user_id in self.connections:
-                await self.connections[user_id].send_json({"type": "round_result", **result_data})
-        
-        # Reset players for next round
-        for player in self.players.values():
-            player.clear_hand()
-        self.dealer.clear_hand()
-
-        await asyncio.sleep(5) # Pause before starting next round
-        self.status = "waiting" # Reset to waiting for next round
-        await self.broadcast_room_state() # Notify clients of reset
+            await self._send_to(user_id, {"type": "round_result", **result_data})
+
+        self._schedule(ROUND_END_PAUSE_SECONDS, self._reset_for_next_round) # Pause before starting next round
+
+    async def _reset_for_next_round(self):
+        self.engine.finish_round() # Clears hands and bets, back to waiting
+        self.dealer_playing = False
+        self.broadcast_room_state() # Notify clients of reset
         self._check_and_start_game_if_ready() # Check if enough players to start next game
 
-    async def broadcast_room_state(self, show_dealer_card: bool = False):
-        state = {
+    def broadcast_room_state(self):
+        """Marks the room state dirty; at most one frame per BROADCAST_TICK_SECONDS is actually sent."""
+        if self.broadcast_handle:
+            metrics.inc("room_frames_suppressed")
+            return
+        self.broadcast_handle = asyncio.get_running_loop().call_later(BROADCAST_TICK_SECONDS, self.submit, self._flush_broadcast)
+
+    def _build_state(self) -> dict:
+        dealer_hand, dealer_score = self.engine.dealer_view() # Hole card hidden until the dealer plays
+        return {
             "room_id": self.room_id,
             "status": self.status,
-            "dealer_hand": [str(card) for card in self.dealer.hand] if show_dealer_card else [str(self.dealer.hand[0]), "Hidden"] if len(self.dealer.hand) > 1 else [str(self.dealer.hand[0])] if self.dealer.hand else [],
-            "dealer_score": self.dealer.score if show_dealer_card or len(self.dealer.hand) == 0 else self.dealer.hand[0].value, # Only show first card value if hidden
-            "players": [p.to_dict() for p in self.players.values()],
+            "dealer_hand": dealer_hand,
+            "dealer_score": dealer_score,
+            "players": [{**p.to_dict(), "stack": self.stacks.get(user_id, 0)} for user_id, p in self.players.items()],
             "current_player_turn": self.current_player_turn,
             "player_count": len(self.players),
             "min_players": self.min_players,
             "max_players": self.max_players,
-            "timer": self.timer_seconds
+            "deadline": self.deadline_ms, # Epoch ms; clients correct for clock skew using the hello/time_sync server_time
+            "timer": max(0, -(-(self.deadline_ms - server_time_ms()) // 1000)) if self.deadline_ms else 0, # Seconds left when sent, for older clients
+            "seq": self.seq # Last frame this state includes; clients send it back to resume
         }
-        for user_id, ws in list(self.connections.items()):
-            try:
-                await ws.send_json(state)
-            except RuntimeError as e:
-                logger.error(f"Error broadcasting to {user_id} in room {self.room_id}: {e}")
-                # This player's websocket is likely closed, remove them
-                asyncio.create_task(self.remove_player(user_id))
-            except Exception as e:
-                logger.error(f"Unexpected error broadcasting to {user_id} in room {self.room_id}: {e}")
-                asyncio.create_task(self.remove_player(user_id))
 
-    async def send_ping(self):
-        try:
-            while True:
-                await asyncio.sleep(10) # Send ping every 10 seconds
-                for user_id, ws in list(self.connections.items()):
-                    try:
-                        await ws.send_json({"type": "ping"})
-                        # logger.debug(f"Sent ping to {user_id} in room {self.room_id}")
-                    except RuntimeError as e:
-                        logger.warning(f"Failed to send ping to {user_id} in room {self.room_id}: {e}")
-                        asyncio.create_task(self.remove_player(user_id))
-        except asyncio.CancelledError:
-            logger.info(f"Room {self.room_id}: Ping task cancelled.")
-        except Exception as e:
-            logger.error(f"Error in room {self.room_id} ping task: {e}")
+    async def _flush_broadcast(self):
+        if not self.broadcast_handle:
+            return # Already flushed, e.g. ahead of a direct message
+        self.broadcast_handle.cancel()
+        self.broadcast_handle = None
+        state = self._build_state()
+        # "timer" is derived from the deadline, so it alone doesn't make a new frame
+        changes = {key: value for key, value in state.items() if key not in ("seq", "timer") and self.last_state.get(key) != value}
+        if not changes:
+            metrics.inc("room_frames_unchanged")
+            return
+        self.seq += 1
+        state["seq"] = self.seq
+        self.deltas.append((self.seq, changes))
+        self.last_state = state
+        metrics.inc("room_frames_sent")
+        # Encode once per wire format, not once per subscriber: players and spectators all
+        # get a reference to the same frame object
+        frames: Dict[str, str | bytes] = {}
+        for writer in (*self.connections.values(), *self.spectators):
+            frame = frames.get(writer.codec.name)
+            if frame is None:
+                frame = frames[writer.codec.name] = writer.codec.encode(state)
+            writer.send_state(frame) # Never blocks; slow consumers are evicted by their writer
+        self.last_frames = frames
+        self._update_index()
+
+    def _frame_for(self, codec) -> str | bytes:
+        """Latest state frame in `codec`, encoding it at most once until the next flush."""
+        frame = self.last_frames.get(codec.name)
+        if frame is None:
+            frame = self.last_frames[codec.name] = codec.encode(self._build_state())
+        return frame
+
+    def _update_index(self):
+        if self.closed:
+            return
+        room_index[self.room_id] = {
+            "room_id": self.room_id,
+            "status": self.status,
+            "player_count": len(self.players),
+            "max_players": self.max_players,
+            "spectators": len(self.spectators),
+            "round_number": self.engine.round_number,
+        }
+
+    # --- Spectators ---
+    async def add_spectator(self, writer: ConnectionWriter):
+        self.spectators.add(writer)
+        writer.on_close = self._on_spectator_closed
+        writer.send_state(self._frame_for(writer.codec))
+        metrics.set_gauge("room_spectators", len(self.spectators), room=self.room_id)
+        self._update_index()
+        logger.info(f"Room {self.room_id}: spectator joined ({len(self.spectators)} watching).")
+
+    async def remove_spectator(self, writer: ConnectionWriter):
+        if writer in self.spectators:
+            self.spectators.discard(writer)
+            writer.on_close = None
+            metrics.set_gauge("room_spectators", len(self.spectators), room=self.room_id)
+            self._update_index()
+
+    def _on_spectator_closed(self, writer: ConnectionWriter):
+        self.submit(self.remove_spectator, writer)
+
+    async def resend_state(self, writer: ConnectionWriter):
+        writer.send_state(self._frame_for(writer.codec))
+
+    async def reap_connections(self) -> int:
+        """Drops connections that are dead or stuck; returns how many were reaped."""
+        now = time.monotonic()
+        reaped = 0
+        for user_id, writer in list(self.connections.items()):
+            if writer.closed or writer.is_zombie(now):
+                logger.warning(f"Room {self.room_id}: reaping dead connection of {user_id}.")
+                writer.on_close = None
+                writer.abort(code=4009, reason="Heartbeat timeout.")
+                self._start_grace(user_id) # The player may still reconnect to their seat
+                reaped += 1
+        for writer in list(self.spectators):
+            if writer.closed or writer.is_zombie(now):
+                writer.abort(code=4009, reason="Heartbeat timeout.")
+                await self.remove_spectator(writer)
+                reaped += 1
+        return reaped
 
 
 rooms: Dict[str, BlackjackRoom] = {} # room_id -> BlackjackRoom
 player_room_map: Dict[int, str] = {} # user_id -> room_id
+room_index: Dict[str, dict] = {} # room_id -> lobby summary, kept current by the rooms themselves
+
+# --- Heartbeats ---
+# Ping/pong itself is done with WebSocket control frames by the server (see ws_ping_interval and
+# ws_ping_timeout in __main__): browsers answer them without involving the page, and a peer that
+# misses WS_HEARTBEAT_MISSES of them is disconnected, which ends its receive loop. ASGI gives the
+# app no access to those frames, so this one task only reaps what that can't catch: writers stuck
+# in a send, connections whose socket is gone but whose room still lists them, and empty rooms.
+heartbeat_task: Optional[asyncio.Task] = None
+
+async def heartbeat_loop():
+    while True:
+        await asyncio.sleep(WS_HEARTBEAT_SECONDS)
+        try:
+            await reap_once()
+        except Exception as e:
+            logger.error(f"Heartbeat sweep failed: {e}", exc_info=True)
+
+async def reap_once():
+    now = time.monotonic()
+    zombies = sum(1 for writer in connection_writers if writer.is_zombie(now))
+    metrics.set_gauge("ws_zombie_connections", zombies)
+
+    for room in list(rooms.values()):
+        if room.closed or room.actor_task.done():
+            logger.warning(f"Room {room.room_id}: actor is gone, reclaiming room.")
+            room.closed = True
+            rooms.pop(room.room_id, None)
+            room_index.pop(room.room_id, None)
+            for user_id, stack in room.stacks.items():
+                pending_cash_outs[(user_id, room.room_id)] = stack
+            room.stacks.clear()
+            metrics.inc("rooms_reclaimed", reason="dead_actor")
+            continue
+        try:
+            reaped = await asyncio.wait_for(room.submit(room.reap_connections), timeout=WS_HEARTBEAT_SECONDS)
+        except asyncio.TimeoutError:
+            logger.warning(f"Room {room.room_id}: actor busy, skipping reap this sweep.")
+            continue
+        if reaped:
+            metrics.inc("ws_zombies_reaped", reaped)
+        if room.connections:
+            room.idle_since = None
+        elif room.idle_since is None:
+            room.idle_since = now
+        elif now - room.idle_since >= ROOM_IDLE_SECONDS:
+            logger.info(f"Room {room.room_id}: no live connections for {now - room.idle_since:.0f}s, reclaiming room.")
+            room.close()
+            rooms.pop(room.room_id, None)
+            metrics.inc("rooms_reclaimed", reason="idle")
+
+    for user_id, room_id in list(player_room_map.items()):
+        if room_id not in rooms:
+            del player_room_map[user_id]
+    metrics.set_gauge("rooms", len(rooms))
+
+    if pending_cash_outs:
+        await retry_pending_cash_outs()
+    metrics.set_gauge("escrow_pending_cash_outs", len(pending_cash_outs))
+    await maintain_escrow_lease()
+
+def server_time_ms() -> int:
+    return int(time.time() * 1000)
+
+def time_sync_reply(message: dict) -> dict:
+    """Answers a client's time_sync: with its own send time echoed back the client can
+    estimate the round trip and its clock offset NTP-style, then render deadlines locally."""
+    return {"type": "time_sync", "client_time": message.get("client_time"), "server_time": server_time_ms()}
 
 @app.websocket("/ws/{user_id}")
 async def websocket_endpoint(websocket: WebSocket, user_id: int):
-    await websocket.accept()
-    logger.info(f"WebSocket connection accepted for user {user_id}.")
-
-    username = f"Гравець {str(user_id)[-4:]}" # Default username
-    try:
-        user_data = get_user_data(user_id) # Fetch to get actual username if exists
-        username = user_data.get('username', username)
-    except Exception as e:
-        logger.warning(f"Could not fetch username for {user_id} during WS connection: {e}")
+    # Browsers can't set headers on a WebSocket, so the session token comes in the query string
+    token = websocket.query_params.get("token")
+    token_user_id = session_user_id(token)
+    if (token_user_id is None and (token or SESSION_AUTH_REQUIRED)) or (token_user_id is not None and token_user_id != user_id):
+        logger.warning(f"WebSocket for user {user_id} refused: no valid session token.")
+        await websocket.close(code=4401) # Before accept: the handshake is answered with 403
+        return
+    # Clients that don't offer one of our subprotocols get the original JSON format
+    codec = wire_protocol.negotiate(websocket.scope.get("subprotocols", []))
+    await websocket.accept(subprotocol=codec.name if codec else None)
+    logger.info(f"WebSocket connection accepted for user {user_id} (protocol: {codec.name if codec else 'legacy json'}).")
+    writer = ConnectionWriter(websocket, user_id, codec or wire_protocol.DEFAULT_CODEC)
+    writer.send({"type": "hello", "server_time": server_time_ms()}) # First clock sample for deadline countdowns
 
     room_id = player_room_map.get(user_id)
     current_room = None
+    seated = rooms[room_id].players.get(user_id) if room_id in rooms else None
+
+    username = f"Гравець {str(user_id)[-4:]}" # Default username
+    if seated:
+        username = seated.username # Reconnecting to a held seat: no DB round trip
+    else:
+        try:
+            ensure_user(user_id) # First contact may well be the WebSocket
+            user_data = get_user_data(user_id, read_only=True) # Fetch to get actual username
+            username = user_data.get('username', username)
+        except Exception as e:
+            logger.warning(f"Could not fetch username for {user_id} during WS connection: {e}")
+
+    # A reconnecting client names the room and the last frame it saw (?room_id=...&last_seq=...)
+    last_seq = None
+    if websocket.query_params.get("room_id") == room_id and websocket.query_params.get("last_seq", "").isdigit():
+        last_seq = int(websocket.query_params["last_seq"])
 
-    if room_id and room_id in rooms:
+    if seated:
         current_room = rooms[room_id]
-        if await current_room.add_player(user_id, username, websocket):
+        if await current_room.submit(current_room.add_player, user_id, username, writer, last_seq):
             logger.info(f"Player {user_id} joined existing room {room_id} (filling {len(current_room.players)}/{current_room.max_players}).")
         else:
             # If add_player returned False (e.g., room full), it means player couldn't join
-            await websocket.close(code=4000, reason="Failed to join room.")
+            writer.close(code=4000, reason="Failed to join room.")
             return
     else:
         # Try to find an existing room that is not full and in 'waiting' status
@@ -1096,77 +3214,145 @@ async def websocket_endpoint(websocket: WebSocket, user_id: int):
             if len(room.players) < room.max_players and room.status == "waiting":
                 found_room = room
                 break
-        
-        if found_room:
+        target_room_id = found_room.room_id if found_room else generate_room_id()
+
+        # Buy in: the table stack leaves the wallet before the player is seated (?buy_in=..., default TABLE_BUY_IN)
+        requested = websocket.query_params.get("buy_in", "")
+        buy_in = min(max(int(requested), TABLE_MIN_BUY_IN), TABLE_MAX_BUY_IN) if requested.isdigit() else TABLE_BUY_IN
+        if any(pending_user == user_id for pending_user, _ in pending_cash_outs):
+            await retry_pending_cash_outs() # Their last table's stack has to be back in the wallet first
+        try:
+            stack = await asyncio.to_thread(escrow_buy_in, user_id, target_room_id, buy_in)
+        except EscrowBusy:
+            writer.send({"type": "error", "message": "Попередня гра ще закривається. Спробуйте за хвилину."})
+            writer.close(code=4000, reason="Previous table still open.")
+            return
+        except Exception as e:
+            logger.error(f"Buy-in failed for {user_id}: {e}")
+            writer.send({"type": "error", "message": "Не вдалося сісти за стіл. Спробуйте пізніше."})
+            writer.close(code=4000, reason="Buy-in failed.")
+            return
+        if stack is None:
+            writer.send({"type": "error", "message": f"Недостатньо фантиків: щоб сісти за стіл, потрібно щонайменше {TABLE_MIN_BUY_IN}."})
+            writer.close(code=4000, reason="Insufficient balance.")
+            return
+
+        if found_room and not found_room.closed:
             current_room = found_room
-            player_room_map[user_id] = current_room.room_id
-            if await current_room.add_player(user_id, username, websocket):
-                logger.info(f"Player {user_id} joined existing room {current_room.room_id} (filling {len(current_room.players)}/{current_room.max_players}).")
-            else:
-                await websocket.close(code=4000, reason="Failed to join room.")
-                return
         else:
             # Create a new room
-            new_room_id = str(uuid.uuid4().hex)[:8]
-            current_room = BlackjackRoom(new_room_id)
-            rooms[new_room_id] = current_room
-            player_room_map[user_id] = new_room_id
-            await current_room.add_player(user_id, username, websocket)
-            logger.info(f"Player {user_id} created and joined new room {new_room_id}")
-            current_room.ping_task = asyncio.create_task(current_room.send_ping()) # Start ping task for new room
-
-    if current_room:
-        # Initial state broadcast
-        await current_room.broadcast_room_state()
+            current_room = BlackjackRoom(target_room_id)
+            rooms[target_room_id] = current_room
+        player_room_map[user_id] = current_room.room_id
+        if await current_room.submit(current_room.add_player, user_id, username, writer, None, stack):
+            logger.info(f"Player {user_id} joined room {current_room.room_id} with a stack of {stack} (filling {len(current_room.players)}/{current_room.max_players}).")
+        else:
+            # The room filled up while we were buying in: the stack goes straight back
+            player_room_map.pop(user_id, None)
+            try:
+                await asyncio.to_thread(escrow_cash_out, user_id, current_room.room_id, stack)
+            except Exception as e:
+                logger.error(f"Could not return the buy-in of {user_id}, will retry: {e}")
+                pending_cash_outs[(user_id, current_room.room_id)] = stack
+            writer.close(code=4000, reason="Failed to join room.")
+            return
 
     try:
         while True:
-            message_text = await websocket.receive_text()
-            message = json.loads(message_text)
+            received = await websocket.receive()
+            if received["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(received.get("code", 1000))
+            if received.get("text") == '{"type":"pong"}':
+                continue # Pongs from clients built before protocol-level heartbeats; nothing to do
+            message = writer.codec.decode(received["text"] if received.get("text") is not None else received["bytes"])
             logger.info(f"WS: Received message from {user_id} in room {current_room.room_id}: {message}")
 
             action = message.get("action")
-            
+            if action in ("bet", "hit", "stand"):
+                retry_after, _ = rate_limiter.check(f"ws_{action}", user_id)
+                if retry_after > 0: # Answered here, without queueing on the room or touching the DB
+                    writer.send({"type": "rate_limited", "message": rate_limit_message(retry_after), "retry_after": round(retry_after, 2)})
+                    continue
+
             if action == "bet":
                 amount = message.get("amount")
+                idempotency_key = message.get("idempotency_key")
+                if idempotency_key is not None and (not isinstance(idempotency_key, str) or len(idempotency_key) > IDEMPOTENCY_KEY_MAX_LENGTH):
+                    idempotency_key = None
                 if amount:
-                    await current_room.handle_bet(user_id, amount)
+                    await current_room.submit(current_room.handle_bet, user_id, amount, idempotency_key)
             elif action == "hit":
-                await current_room.handle_hit(user_id)
+                await current_room.submit(current_room.handle_hit, user_id)
             elif action == "stand":
-                await current_room.handle_stand(user_id)
+                await current_room.submit(current_room.handle_stand, user_id)
             elif action == "leave_room":
                 # Client explicitly requested to leave
-                await current_room.remove_player(user_id)
+                await current_room.submit(current_room.remove_player, user_id)
                 if user_id in player_room_map:
                     del player_room_map[user_id]
-                await websocket.send_json({"type": "game_message", "message": "Ви покинули кімнату."})
-                await websocket.close(code=1000, reason="User left room.")
+                writer.send({"type": "game_message", "message": "Ви покинули кімнату."})
+                writer.close(code=1000, reason="User left room.")
                 break # Exit the loop as connection is closing
             elif action == "request_state":
-                await current_room.broadcast_room_state() # Send current state to requesting client
+                await current_room.submit(current_room.resend_state, writer) # Send current state to requesting client
+            elif action == "time_sync":
+                writer.send(time_sync_reply(message))
             elif message.get("type") == "pong":
-                # Handle pong, no specific action needed other than keeping connection alive
-                pass
+                pass # Same as above, for pongs that weren't sent in the canonical form
             else:
                 logger.warning(f"Unknown action received: {message}")
-                await websocket.send_json({"type": "error", "message": "Невідома дія."})
+                writer.send({"type": "error", "message": "Невідома дія."})
 
     except WebSocketDisconnect as e:
         logger.info(f"Client {user_id} disconnected from room {current_room.room_id}. Code: {e.code}")
-        await current_room.remove_player(user_id)
-        if user_id in player_room_map:
+        await current_room.submit(current_room._drop_connection, writer)
+        writer.abort()
+        if user_id not in current_room.players and player_room_map.get(user_id) == current_room.room_id:
             del player_room_map[user_id]
     except Exception as e:
         logger.critical(f"Unexpected error in WebSocket endpoint for {user_id}: {e}", exc_info=True)
         if current_room:
-            await current_room.remove_player(user_id)
-        if user_id in player_room_map:
+            await current_room.submit(current_room._drop_connection, writer)
+        if user_id in player_room_map and (not current_room or user_id not in current_room.players):
             del player_room_map[user_id]
-        try:
-            await websocket.close(code=1011, reason=f"Server error: {e}")
-        except RuntimeError:
-            logger.warning(f"Could not close websocket for {user_id}, already closed.")
+        writer.abort(code=1011, reason=f"Server error: {e}")
+
+@app.get("/api/rooms")
+async def list_rooms():
+    """Lobby: live rooms with their status, seats and audience."""
+    return {"rooms": list(room_index.values())}
+
+@app.websocket("/ws/spectate/{room_id}")
+async def spectate_endpoint(websocket: WebSocket, room_id: str):
+    codec = wire_protocol.negotiate(websocket.scope.get("subprotocols", []))
+    await websocket.accept(subprotocol=codec.name if codec else None)
+    writer = ConnectionWriter(websocket, 0, codec or wire_protocol.DEFAULT_CODEC) # Spectators are anonymous
+    room = rooms.get(room_id)
+    if not room or room.closed:
+        writer.send({"type": "error", "message": "Кімнату не знайдено."})
+        writer.close(code=4004, reason="Room not found.")
+        return
+
+    writer.send({"type": "hello", "server_time": server_time_ms()})
+    await room.submit(room.add_spectator, writer)
+    try:
+        while True:
+            received = await websocket.receive()
+            if received["type"] == "websocket.disconnect":
+                break
+            if received.get("text") == '{"type":"pong"}':
+                continue
+            message = writer.codec.decode(received["text"] if received.get("text") is not None else received["bytes"])
+            if message.get("action") == "request_state":
+                await room.submit(room.resend_state, writer)
+            elif message.get("action") == "time_sync":
+                writer.send(time_sync_reply(message))
+            # Spectators are read-only; any other action is ignored
+    except Exception as e:
+        logger.warning(f"Spectator connection to room {room_id} ended: {e}")
+    finally:
+        await room.submit(room.remove_spectator, writer)
+        writer.abort(code=1000)
 
 # --- Root endpoint to serve the React app ---
 @app.get("/", response_class=HTMLResponse)
@@ -1200,6 +3386,25 @@ async def on_startup():
     print("Application startup event triggered.")
     init_db() # Call init_db here
     print("Database initialization attempted.")
+    claim_escrow_worker() # Fails startup rather than share a WAL with another process
+    global escrow_last_sweep
+    try:
+        renew_escrow_lease() # Before looking for dead workers, so another one starting now doesn't count this one
+        reconcile_escrow() # Stacks left at tables by a crash go back to the wallets before anyone can sit down
+        escrow_last_sweep = time.monotonic()
+    except Exception as e:
+        logger.error(f"Escrow reconciliation failed; the WAL is kept for the next start: {e}", exc_info=True)
+
+    global heartbeat_task
+    heartbeat_task = asyncio.create_task(heartbeat_loop(), name="ws-heartbeat")
+    loop_watchdog.start()
+    game_stats.start()
+    if traffic_recorder:
+        traffic_recorder.start()
+
+    global notification_sender
+    if bot:
+        notification_sender = NotificationSender(bot)
     
     # Declare globals at the top of the function
     global WEBHOOK_URL
@@ -1232,6 +3437,25 @@ async def on_startup():
 @app.on_event("shutdown")
 async def on_shutdown():
     print("Application shutdown event triggered.")
+    if heartbeat_task:
+        heartbeat_task.cancel()
+    loop_watchdog.stop()
+    for room in list(rooms.values()):
+        room.refund_open_bets()
+        for user_id, stack in room.stacks.items():
+            pending_cash_outs[(user_id, room.room_id)] = stack
+        room.stacks.clear()
+    await retry_pending_cash_outs() # Whatever still fails is paid out by reconciliation on the next start
+    if not pending_cash_outs:
+        try:
+            await asyncio.to_thread(release_escrow_lease)
+        except Exception as e:
+            logger.error(f"Escrow: could not release this worker's lease; it expires in {ESCROW_LEASE_SECONDS:.0f}s: {e}")
+    await game_stats.stop()
+    if traffic_recorder:
+        await traffic_recorder.stop()
+    if notification_sender:
+        notification_sender.close()
     if API_TOKEN and API_TOKEN != "DUMMY_TOKEN":
         try:
             await bot.delete_webhook()
@@ -1241,3 +3465,11 @@ async def on_shutdown():
     logger.info("Closing dispatcher storage and bot session.")
     await bot.session.close() 
     logger.info("Bot session closed.")
+
+if __name__ == "__main__":
+    import uvicorn
+    # Local runs only; deployments start through start.sh, which passes the same WebSocket settings
+    # permessage-deflate is negotiated per connection; the compact subprotocols shrink what is left to compress
+    # Protocol-level heartbeats: a ping every WS_HEARTBEAT_SECONDS, dead after WS_HEARTBEAT_MISSES unanswered
+    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", "8000")), ws="websockets", ws_per_message_deflate=True,
+                ws_ping_interval=WS_HEARTBEAT_SECONDS, ws_ping_timeout=WS_HEARTBEAT_SECONDS * WS_HEARTBEAT_MISSES)
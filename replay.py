@@ -0,0 +1,188 @@
+"""Replays traffic captured with TRAFFIC_RECORD_PATH against a local instance.
+
+REST calls and WebSocket messages are sent with their recorded timing, optionally
+sped up. A user's REST calls are never reordered, even at full speed. Start both the
+recording and the target instance with the same RNG_SEED, and the target on a fresh
+database, and the game outcomes come out identical:
+
+    RNG_SEED=7 TRAFFIC_RECORD_PATH=capture.jsonl.gz python main.py     # record real play
+    RNG_SEED=7 DATABASE_URL=postgres://localhost/casino_replay python main.py
+    python replay.py capture.jsonl.gz --target http://localhost:8000 --speed 1
+
+At the end it prints latency percentiles per endpoint, and an outcome digest: a hash
+of every slot and coin flip response and every Blackjack round_result. Two replays
+that print the same digest played the same games. Timers (betting windows, bonus
+cooldowns) run on the server's clock, so use --speed 1 when comparing Blackjack
+or bonus outcomes.
+
+Captures never contain session tokens. The replayer signs fresh ones for each
+recorded user with the target's key, taken from SESSION_SECRET or BOT_TOKEN in the
+environment exactly as the server does; with neither set it sends no tokens, so
+start the target with SESSION_AUTH_REQUIRED=0.
+"""
+import argparse
+import asyncio
+import base64
+import gzip
+import hashlib
+import json
+import os
+import statistics
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional
+
+import aiohttp
+
+import session_auth
+import wire_protocol
+
+GAME_PATHS = {"/api/spin", "/api/spin_lines", "/api/coin_flip"} # Responses that are game outcomes
+TOKEN_TTL_SECONDS = 24 * 3600
+
+
+def load_events(path: str) -> List[dict]:
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    return sorted((e for e in events if e["k"] != "meta"), key=lambda e: e["t"])
+
+
+class Replayer:
+    def __init__(self, target: str, speed: float, session_secret: Optional[bytes] = None):
+        self.target = target.rstrip("/")
+        self.session_secret = session_secret
+        self.tokens: Dict[str, str] = {} # user_id -> session token signed for the target
+        self.ws_target = "ws" + self.target[len("http"):]
+        self.speed = speed
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.user_chains: Dict[object, asyncio.Task] = {} # user_id -> their latest REST call
+        self.sockets: Dict[int, aiohttp.ClientWebSocketResponse] = {}
+        self.readers: List[asyncio.Task] = []
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.statuses: Counter = Counter()
+        self.outcomes: List[str] = []
+        self.ws_frames = 0
+        self.ws_bytes = 0
+        self.lag: List[float] = [] # How late each event went out versus its scaled schedule
+
+    def token_for(self, user_id) -> Optional[str]:
+        if self.session_secret is None or not str(user_id).isdigit():
+            return None
+        if str(user_id) not in self.tokens:
+            self.tokens[str(user_id)] = session_auth.issue_token(self.session_secret, int(user_id), TOKEN_TTL_SECONDS)[0]
+        return self.tokens[str(user_id)]
+
+    async def run(self, events: List[dict]):
+        async with aiohttp.ClientSession() as self.session:
+            started = time.monotonic()
+            for index, event in enumerate(events):
+                if self.speed > 0:
+                    due = started + event["t"] / self.speed
+                    delay = due - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    self.lag.append(max(0.0, -delay))
+                await self.dispatch(index, event)
+            await asyncio.gather(*self.user_chains.values(), return_exceptions=True)
+            for ws in list(self.sockets.values()):
+                await ws.close()
+            await asyncio.gather(*self.readers, return_exceptions=True)
+
+    async def dispatch(self, index: int, event: dict):
+        kind = event["k"]
+        if kind == "http":
+            try:
+                user = json.loads(event["b"]).get("user_id") if event["b"] else None
+            except (ValueError, AttributeError):
+                user = None
+            previous = self.user_chains.get(user)
+            self.user_chains[user] = asyncio.create_task(self.http(index, event, previous, self.token_for(user)))
+        elif kind == "ws_open":
+            params = [event["q"]] if event.get("q") else []
+            token = self.token_for(event["p"].rstrip("/").rsplit("/", 1)[-1]) # /ws/{user_id}
+            if token:
+                params.append(f"token={token}")
+            url = self.ws_target + event["p"] + (f"?{'&'.join(params)}" if params else "")
+            try:
+                ws = await self.session.ws_connect(url, protocols=event.get("sp") or (), autoping=True)
+            except aiohttp.ClientError as e:
+                self.statuses[f"ws_connect_failed {type(e).__name__}"] += 1
+                return
+            self.sockets[event["c"]] = ws
+            self.readers.append(asyncio.create_task(self.read(event["c"], ws)))
+        elif kind == "ws_in":
+            ws = self.sockets.get(event["c"])
+            if ws is None or ws.closed:
+                return
+            if "d" in event:
+                await ws.send_str(event["d"])
+            else:
+                await ws.send_bytes(base64.b64decode(event["b64"]))
+        elif kind == "ws_close":
+            ws = self.sockets.pop(event["c"], None)
+            if ws is not None:
+                await ws.close()
+
+    async def http(self, index: int, event: dict, previous: Optional[asyncio.Task], token: Optional[str]):
+        if previous is not None:
+            await asyncio.gather(previous, return_exceptions=True) # Keep each user's calls in order
+        url = self.target + event["p"] + (f"?{event['q']}" if event.get("q") else "")
+        headers = dict(event.get("h", {}))
+        if token:
+            headers["authorization"] = f"Bearer {token}"
+        started = time.perf_counter()
+        try:
+            async with self.session.request(event["m"], url, data=event["b"].encode(), headers=headers) as response:
+                body = await response.text()
+                status = response.status
+        except aiohttp.ClientError as e:
+            self.statuses[f"{event['p']} {type(e).__name__}"] += 1
+            return
+        self.latencies[event["p"]].append(time.perf_counter() - started)
+        self.statuses[f"{event['p']} {status}"] += 1
+        if event["p"] in GAME_PATHS:
+            self.outcomes.append(f"http:{index}:{status}:{body}")
+
+    async def read(self, conn: int, ws: aiohttp.ClientWebSocketResponse):
+        codec = wire_protocol.CODECS.get(ws.protocol or "", wire_protocol.DEFAULT_CODEC)
+        seq = 0
+        async for msg in ws:
+            if msg.type not in (aiohttp.WSMsgType.TEXT, aiohttp.WSMsgType.BINARY):
+                continue
+            self.ws_frames += 1
+            self.ws_bytes += len(msg.data)
+            message = codec.decode(msg.data)
+            if message.get("type", message.get("y")) == "round_result":
+                seq += 1
+                self.outcomes.append(f"ws:{conn}:{seq}:{json.dumps(message, sort_keys=True, ensure_ascii=False)}")
+
+    def report(self, elapsed: float, events: int):
+        print(f"Replayed {events} events in {elapsed:.1f}s (speed {self.speed or 'max'})")
+        if self.lag:
+            print(f"  schedule lag p50={statistics.median(self.lag) * 1000:.1f}ms max={max(self.lag) * 1000:.1f}ms")
+        for path, values in sorted(self.latencies.items()):
+            ordered = sorted(values)
+            p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+            print(f"  {path}: {len(ordered)} calls, p50={statistics.median(ordered) * 1000:.1f}ms p99={p99 * 1000:.1f}ms")
+        print(f"  websocket: {self.ws_frames} frames, {self.ws_bytes} bytes received")
+        print("  statuses: " + ", ".join(f"{key}={count}" for key, count in sorted(self.statuses.items())))
+        digest = hashlib.sha256("\n".join(sorted(self.outcomes)).encode()).hexdigest()
+        print(f"  outcome digest: {digest[:16]} ({len(self.outcomes)} outcomes)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("capture", help="File written via TRAFFIC_RECORD_PATH")
+    parser.add_argument("--target", default="http://localhost:8000")
+    parser.add_argument("--speed", type=float, default=1.0, help="2 = twice as fast; 0 = no waiting at all")
+    args = parser.parse_args()
+
+    events = load_events(args.capture)
+    replayer = Replayer(args.target, args.speed, session_auth.session_secret(os.getenv("SESSION_SECRET"), os.getenv("BOT_TOKEN")))
+    started = time.monotonic()
+    asyncio.run(replayer.run(events))
+    replayer.report(time.monotonic() - started, len(events))
+
+
+if __name__ == "__main__":
+    main()
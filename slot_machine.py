@@ -0,0 +1,150 @@
+"""5-reel, 3-row video slot with up to 25 paylines, wilds and scatters.
+
+Reel strips are built once at import time and stored as numpy arrays, together with
+every 3-symbol window a reel can stop on. A spin is then five random stop positions
+and a handful of array operations: gather the window, gather every payline across
+it, find each line's paying symbol and run length, and look the wins up in the
+paytable. There are no per-line Python loops, so 25 lines cost about the same as one.
+
+Randomness comes from the caller (a random.Random, e.g. main.SeededRng), so any
+spin can be replayed from its seed.
+"""
+import random
+from dataclasses import dataclass, field
+from typing import List
+
+import numpy as np
+
+REELS = 5
+ROWS = 3
+
+SYMBOLS = ['🍒', '🍋', '🍊', '🍇', '🔔', '🍀', '💎', '⭐', '💰']
+WILD = SYMBOLS.index('⭐') # Substitutes for any paying symbol
+SCATTER = SYMBOLS.index('💰') # Pays anywhere on the screen, never on a line
+
+# Copies of each symbol on every reel strip (same order as SYMBOLS)
+REEL_WEIGHTS = [10, 10, 9, 8, 6, 5, 3, 2, 2]
+
+# Line pay, as a multiple of the bet per line, for 0..5 matching symbols from the left
+PAYTABLE = np.array([
+    [0, 0, 0, 10, 25, 100],    # 🍒
+    [0, 0, 0, 10, 25, 100],    # 🍋
+    [0, 0, 0, 10, 30, 125],    # 🍊
+    [0, 0, 0, 15, 45, 175],    # 🍇
+    [0, 0, 0, 20, 75, 250],    # 🔔
+    [0, 0, 0, 25, 100, 450],   # 🍀
+    [0, 0, 0, 50, 200, 1000],  # 💎
+    [0, 0, 0, 100, 500, 2500], # ⭐ (a line of wilds only)
+    [0, 0, 0, 0, 0, 0],        # 💰 never pays on a line
+], dtype=np.int64)
+
+# Scatter pay, as a multiple of the total bet, for 0..15 scatters anywhere
+SCATTER_PAY = np.zeros(REELS * ROWS + 1, dtype=np.int64)
+SCATTER_PAY[3], SCATTER_PAY[4], SCATTER_PAY[5:] = 4, 20, 100
+
+# Row index (0 = top) on each reel, for the classic 25 lines
+PAYLINES = np.array([
+    [1, 1, 1, 1, 1], [0, 0, 0, 0, 0], [2, 2, 2, 2, 2], [0, 1, 2, 1, 0], [2, 1, 0, 1, 2],
+    [0, 0, 1, 2, 2], [2, 2, 1, 0, 0], [1, 0, 0, 0, 1], [1, 2, 2, 2, 1], [1, 0, 1, 2, 1],
+    [1, 2, 1, 0, 1], [0, 1, 1, 1, 0], [2, 1, 1, 1, 2], [0, 1, 0, 1, 0], [2, 1, 2, 1, 2],
+    [1, 1, 0, 1, 1], [1, 1, 2, 1, 1], [0, 0, 2, 0, 0], [2, 2, 0, 2, 2], [0, 2, 2, 2, 0],
+    [2, 0, 0, 0, 2], [1, 0, 2, 0, 1], [1, 2, 0, 2, 1], [0, 2, 0, 2, 0], [2, 0, 2, 0, 2],
+], dtype=np.intp)
+MAX_LINES = len(PAYLINES)
+MIN_BET_PER_LINE = 1
+MAX_BET_PER_LINE = 100
+
+STRIP_SEED = 20240601 # Fixed: the strips are part of the machine, not of a spin
+
+
+def build_strips(seed: int = STRIP_SEED) -> np.ndarray:
+    """One shuffled strip per reel, shape (REELS, strip_length)."""
+    base = np.repeat(np.arange(len(SYMBOLS), dtype=np.int8), REEL_WEIGHTS)
+    strip_rng = np.random.default_rng(seed)
+    return np.stack([strip_rng.permutation(base) for _ in range(REELS)])
+
+
+STRIPS = build_strips()
+STRIP_LENGTH = STRIPS.shape[1]
+# WINDOWS[reel, stop] is the column of ROWS symbols shown when `reel` stops at `stop`
+WINDOWS = np.stack([
+    np.stack([np.roll(strip, -offset) for offset in range(ROWS)], axis=1) for strip in STRIPS
+])
+_REEL_INDEX = np.arange(REELS)
+
+
+@dataclass
+class LineWin:
+    line: int # 0-based payline index
+    symbol: str
+    count: int
+    win: int
+
+
+@dataclass
+class SpinResult:
+    stops: List[int]
+    grid: List[List[str]] # ROWS x REELS, top row first
+    line_wins: List[LineWin] = field(default_factory=list)
+    scatter_count: int = 0
+    scatter_win: int = 0
+    total_bet: int = 0
+    total_win: int = 0
+
+
+def evaluate(window: np.ndarray, lines: int, bet_per_line: int) -> tuple[np.ndarray, np.ndarray, np.ndarray, int]:
+    """Scores a (ROWS, REELS) window. Returns (line_symbols, line_counts, line_wins, scatter_count)."""
+    on_lines = window[PAYLINES[:lines], _REEL_INDEX] # (lines, REELS) symbols along each payline
+
+    # Substituted symbol: the first non-wild on the line, with wilds standing in for it
+    not_wild = on_lines != WILD
+    first = not_wild.argmax(axis=1)
+    substituted = on_lines[np.arange(lines), first]
+    substituted[~not_wild.any(axis=1)] = WILD
+
+    # Run lengths from the left; cumprod stops counting at the first miss
+    substituted_counts = np.cumprod((on_lines == substituted[:, None]) | ~not_wild, axis=1).sum(axis=1)
+    wild_counts = np.cumprod(~not_wild, axis=1).sum(axis=1)
+
+    # A line pays the better of its leading wilds on their own and the substituted symbol's run
+    # (e.g. four wilds then a cherry pay as four wilds; wilds before a scatter still pay)
+    substituted_pay = PAYTABLE[substituted, substituted_counts]
+    wild_pay = PAYTABLE[WILD, wild_counts]
+    as_wilds = wild_pay > substituted_pay
+    line_symbols = np.where(as_wilds, WILD, substituted)
+    line_counts = np.where(as_wilds, wild_counts, substituted_counts)
+
+    line_wins = np.maximum(wild_pay, substituted_pay) * bet_per_line
+    scatter_count = int(np.count_nonzero(window == SCATTER))
+    return line_symbols, line_counts, line_wins, scatter_count
+
+
+def spin(rng: random.Random, lines: int = MAX_LINES, bet_per_line: int = 1) -> SpinResult:
+    if not 1 <= lines <= MAX_LINES:
+        raise ValueError(f"lines must be between 1 and {MAX_LINES}")
+    if not MIN_BET_PER_LINE <= bet_per_line <= MAX_BET_PER_LINE:
+        raise ValueError(f"bet_per_line must be between {MIN_BET_PER_LINE} and {MAX_BET_PER_LINE}")
+
+    stops = [rng.randrange(STRIP_LENGTH) for _ in range(REELS)]
+    window = WINDOWS[_REEL_INDEX, stops].T # (ROWS, REELS)
+    line_symbols, line_counts, line_wins, scatter_count = evaluate(window, lines, bet_per_line)
+
+    total_bet = lines * bet_per_line
+    scatter_win = int(SCATTER_PAY[scatter_count]) * total_bet
+    winning = np.flatnonzero(line_wins)
+    return SpinResult(
+        stops=stops,
+        grid=[[SYMBOLS[s] for s in row] for row in window.tolist()],
+        line_wins=[
+            LineWin(int(i), SYMBOLS[line_symbols[i]], int(line_counts[i]), int(line_wins[i])) for i in winning
+        ],
+        scatter_count=scatter_count,
+        scatter_win=scatter_win,
+        total_bet=total_bet,
+        total_win=int(line_wins.sum()) + scatter_win,
+    )
+
+
+def xp_for(result: SpinResult) -> int:
+    """XP for a spin: 1 for playing, plus 2 per winning line and 5 for a scatter bonus."""
+    return 1 + 2 * len(result.line_wins) + (5 if result.scatter_win else 0)
@@ -1 +1,9 @@
-gunicorn -k aiohttp.worker.GunicornWebWorker --bind 0.0.0.0:$PORT main:app_aiohttp
+# WebSocket settings live here, not in main.py's __main__ block, so deployments actually get them:
+# a protocol ping every WS_HEARTBEAT_SECONDS, a connection is dead after WS_HEARTBEAT_MISSES unanswered,
+# and permessage-deflate is negotiated per connection.
+WS_HEARTBEAT_SECONDS=${WS_HEARTBEAT_SECONDS:-10}
+WS_HEARTBEAT_MISSES=${WS_HEARTBEAT_MISSES:-3}
+WS_PING_TIMEOUT=$(awk "BEGIN { print $WS_HEARTBEAT_SECONDS * $WS_HEARTBEAT_MISSES }")
+exec uvicorn main:app --host 0.0.0.0 --port $PORT --workers 1 \
+    --ws websockets --ws-per-message-deflate true \
+    --ws-ping-interval $WS_HEARTBEAT_SECONDS --ws-ping-timeout $WS_PING_TIMEOUT
@@ -0,0 +1,6 @@
+import os
+
+# main.py registers its bot handlers at import time, which needs a Dispatcher and so a
+# well-formed token; the bot never talks to Telegram in these tests.
+if os.environ.get("BOT_TOKEN", "DUMMY_TOKEN") == "DUMMY_TOKEN":
+    os.environ["BOT_TOKEN"] = "123456:test-token"
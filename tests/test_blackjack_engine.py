@@ -0,0 +1,124 @@
+import pytest
+
+from blackjack_engine import FULL_DECK, BlackjackEngine, InvalidAction
+
+CARD_INDEX = {str(card): i for i, card in enumerate(FULL_DECK)}
+
+
+def stacked(*cards: str):
+    """A shoe that deals `cards` in order (the deck deals from the end of its list)."""
+    order = [CARD_INDEX[card] for card in reversed(cards)]
+    return lambda: (0, list(order))
+
+
+def table(*cards: str, players=(1, 2), bets=(100, 100)) -> BlackjackEngine:
+    engine = BlackjackEngine(min_players=2, max_players=4, shoe_source=stacked(*cards))
+    for user_id in players:
+        engine.add_player(user_id, f"p{user_id}")
+    engine.start_countdown()
+    engine.open_betting()
+    for user_id, bet in zip(players, bets):
+        engine.place_bet(user_id, bet)
+    assert engine.close_betting()
+    engine.start_round()
+    return engine
+
+
+def test_initial_deal_goes_round_the_table_twice():
+    # Deal order: p1, p2, dealer up card, p1, p2, dealer hole card
+    engine = table("2♠", "3♠", "K♠", "4♠", "5♠", "7♠")
+    assert [str(c) for c in engine.players[1].hand] == ["2♠", "4♠"]
+    assert [str(c) for c in engine.players[2].hand] == ["3♠", "5♠"]
+    assert str(engine.dealer_up_card()) == "K♠"
+    assert engine.dealer_view() == (["K♠", "Hidden"], 10)
+
+
+def test_turns_follow_seat_order_and_skip_finished_players():
+    engine = table("2♠", "3♠", "K♠", "4♠", "5♠", "7♠", "10♦", "9♦", "8♦")
+    assert engine.current_player_turn == 1
+    with pytest.raises(InvalidAction):
+        engine.hit(2) # Not p2's turn yet
+    engine.stand(1)
+    assert engine.current_player_turn == 2
+    engine.hit(2) # 3 + 5 + 10 = 18
+    assert engine.current_player_turn == 2
+    engine.hit(2) # + 9: bust, turn passes on
+    assert engine.players[2].score > 21
+    assert engine.current_player_turn is None
+    assert engine.status == "round_end"
+    assert engine.dealer_revealed
+
+
+def test_removing_the_player_on_turn_passes_the_turn():
+    engine = table("2♠", "3♠", "K♠", "4♠", "5♠", "7♠")
+    engine.remove_player(1)
+    assert engine.current_player_turn == 2
+
+
+def test_settlement_win_push_loss_and_bust():
+    # p1: 10+10=20 stands; p2: 10+7=17 stands; p3: 10+6=16 hits a K and busts; p4: 9+9=18 stands
+    # Dealer: 10+8=18, stands on 18
+    engine = BlackjackEngine(min_players=2, max_players=4, shoe_source=stacked(
+        "10♠", "10♦", "10♥", "9♠", "10♣", "K♠", "7♦", "6♥", "9♦", "8♠", "K♣"))
+    for user_id in (1, 2, 3, 4):
+        engine.add_player(user_id, f"p{user_id}")
+    engine.start_countdown()
+    engine.open_betting()
+    for user_id in (1, 2, 3, 4):
+        engine.place_bet(user_id, 100)
+    engine.close_betting()
+    engine.start_round()
+    engine.stand(1)
+    engine.stand(2)
+    engine.hit(3)
+    engine.stand(4)
+    engine.play_dealer()
+    assert engine.dealer.score == 18
+    outcomes = {o.user_id: o for o in engine.settle()}
+    assert outcomes[1].winnings == 200 # Win pays the bet back plus even money
+    assert outcomes[2].winnings == 0 # 17 loses to 18
+    assert outcomes[3].winnings == 0 and outcomes[3].final_score > 21
+    assert outcomes[4].winnings == 100 # Push returns the bet
+    assert all(o.participated for o in outcomes.values())
+
+
+def test_dealer_bust_pays_every_standing_player():
+    engine = table("10♠", "10♦", "6♥", "7♠", "8♦", "10♣", "K♥")
+    engine.stand(1)
+    engine.stand(2)
+    engine.play_dealer() # 16 hits a K
+    assert engine.dealer.score > 21
+    assert [o.winnings for o in engine.settle()] == [200, 200]
+
+
+def test_non_bettors_sit_out_and_betting_needs_min_players():
+    engine = BlackjackEngine(min_players=2, max_players=4)
+    for user_id in (1, 2, 3):
+        engine.add_player(user_id, f"p{user_id}")
+    engine.start_countdown()
+    engine.open_betting()
+    engine.place_bet(1, 100)
+    assert not engine.all_bets_in()
+    assert not engine.close_betting() # One bet is not enough for a round
+
+    engine.finish_round()
+    engine.start_countdown()
+    engine.open_betting()
+    engine.place_bet(1, 100)
+    engine.place_bet(2, 100)
+    assert engine.close_betting()
+    assert not engine.players[3].is_playing
+
+
+def test_bets_are_validated():
+    engine = BlackjackEngine(min_players=2, max_players=4)
+    engine.add_player(1, "p1")
+    with pytest.raises(InvalidAction):
+        engine.place_bet(1, 100) # Betting isn't open
+    engine.start_countdown()
+    engine.open_betting()
+    with pytest.raises(InvalidAction):
+        engine.place_bet(1, 0)
+    engine.place_bet(1, 100)
+    with pytest.raises(InvalidAction):
+        engine.place_bet(1, 100) # Only one bet per round
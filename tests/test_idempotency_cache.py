@@ -0,0 +1,52 @@
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("aiogram")
+pytest.importorskip("psycopg2")
+
+import main  # noqa: E402
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_stored_responses_are_returned_until_they_expire(clock):
+    cache = main.IdempotencyCache(ttl_seconds=60, max_entries=10)
+    cache.put("spin:1:a", 200, {"winnings": 50})
+    clock[0] += 59
+    assert cache.get("spin:1:a") == (200, {"winnings": 50})
+    clock[0] += 1
+    assert cache.get("spin:1:a") is None
+    assert "spin:1:a" not in cache.entries
+
+
+def test_client_errors_are_stored_like_successes(clock):
+    cache = main.IdempotencyCache(ttl_seconds=60, max_entries=10)
+    cache.put("spin:1:b", 400, {"error": "Insufficient funds"})
+    assert cache.get("spin:1:b") == (400, {"error": "Insufficient funds"})
+
+
+def test_oldest_entries_are_evicted_first(clock):
+    cache = main.IdempotencyCache(ttl_seconds=60, max_entries=2)
+    cache.put("a", 200, 1)
+    cache.put("b", 200, 2)
+    cache.put("c", 200, 3)
+    assert cache.get("a") is None
+    assert cache.get("b") == (200, 2)
+    assert cache.get("c") == (200, 3)
+
+
+def test_storing_a_key_again_refreshes_its_ttl_and_position(clock):
+    cache = main.IdempotencyCache(ttl_seconds=60, max_entries=2)
+    cache.put("a", 200, 1)
+    clock[0] += 30
+    cache.put("b", 200, 2)
+    cache.put("a", 200, 1) # Now the newest
+    cache.put("c", 200, 3)
+    assert cache.get("b") is None
+    clock[0] += 45 # 75s after the first put of "a", 45s after its refresh
+    assert cache.get("a") == (200, 1)
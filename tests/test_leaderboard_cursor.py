@@ -0,0 +1,35 @@
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("aiogram")
+pytest.importorskip("psycopg2")
+
+import main  # noqa: E402
+
+
+def test_cursor_round_trip():
+    cursor = main.encode_leaderboard_cursor(7, 1234, 500000001, 300)
+    assert main.decode_leaderboard_cursor(cursor) == (7, 1234, 500000001, 300)
+
+
+def test_cursor_is_opaque_text_safe_for_json():
+    cursor = main.encode_leaderboard_cursor(1, 0, 2, 3)
+    assert isinstance(cursor, str) and " " not in cursor
+
+
+@pytest.mark.parametrize("tamper", [
+    lambda c: c.replace(".300.", ".1.", 1), # Claim a better rank
+    lambda c: c.replace("7.", "8.", 1), # Move the keyset position
+    lambda c: c.rsplit(".", 1)[0], # Drop the signature
+    lambda c: c + "0",
+])
+def test_tampered_cursors_are_rejected(tamper):
+    cursor = main.encode_leaderboard_cursor(7, 1234, 500000001, 300)
+    with pytest.raises(ValueError):
+        main.decode_leaderboard_cursor(tamper(cursor))
+
+
+@pytest.mark.parametrize("cursor", ["", "abc", "1.2.3", "1.2.3.4.5.6"])
+def test_malformed_cursors_are_rejected(cursor):
+    with pytest.raises(ValueError):
+        main.decode_leaderboard_cursor(cursor)
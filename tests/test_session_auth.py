@@ -0,0 +1,86 @@
+import hashlib
+import hmac
+import json
+import urllib.parse
+
+import pytest
+
+import session_auth
+
+SECRET = b"s" * 32
+BOT_TOKEN = "123456:test-token"
+NOW = 1_700_000_000
+
+
+def signed_init_data(user_id: int = 42, auth_date: int = NOW, bot_token: str = BOT_TOKEN) -> str:
+    fields = {"query_id": "AAH1", "user": json.dumps({"id": user_id, "first_name": "Гравець"}), "auth_date": str(auth_date)}
+    check_string = "\n".join(f"{key}={fields[key]}" for key in sorted(fields))
+    fields["hash"] = hmac.new(session_auth.init_data_secret(bot_token), check_string.encode(), hashlib.sha256).hexdigest()
+    return urllib.parse.urlencode(fields)
+
+
+def test_valid_init_data_returns_the_user():
+    user = session_auth.validate_init_data(signed_init_data(), session_auth.init_data_secret(BOT_TOKEN), 3600, now=NOW + 10)
+    assert user["id"] == 42
+
+
+@pytest.mark.parametrize("init_data, now", [
+    (signed_init_data(bot_token="999:other"), NOW), # Signed for another bot
+    (signed_init_data().replace("42", "43"), NOW), # Edited after signing
+    (signed_init_data().split("&hash=")[0], NOW), # No hash at all
+    (signed_init_data(), NOW + 7200), # Older than max_age
+])
+def test_bad_init_data_is_rejected(init_data, now):
+    with pytest.raises(session_auth.InvalidInitData):
+        session_auth.validate_init_data(init_data, session_auth.init_data_secret(BOT_TOKEN), 3600, now=now)
+
+
+def test_token_verifies_then_comes_from_the_cache():
+    token, expires = session_auth.issue_token(SECRET, 42, 600, now=NOW)
+    assert expires == NOW + 600
+    verifier = session_auth.SessionVerifier(SECRET)
+    assert verifier.verify(token, now=NOW + 1) == (42, "verified")
+    assert verifier.verify(token, now=NOW + 2) == (42, "cached")
+
+
+def test_expired_tokens_are_refused_cached_or_not():
+    token, _ = session_auth.issue_token(SECRET, 42, 600, now=NOW)
+    assert session_auth.SessionVerifier(SECRET).verify(token, now=NOW + 600) == (None, "expired")
+    verifier = session_auth.SessionVerifier(SECRET)
+    verifier.verify(token, now=NOW)
+    assert verifier.verify(token, now=NOW + 601) == (None, "expired")
+    assert token not in verifier.cache
+
+
+@pytest.mark.parametrize("tamper", [
+    lambda t: t.replace("42.", "43.", 1), # Another user id
+    lambda t: t.replace(f".{NOW + 600}.", f".{NOW + 99999}."), # Longer expiry
+    lambda t: t[:-2] + ("AA" if not t.endswith("AA") else "BB"), # Forged signature
+    lambda t: "garbage",
+    lambda t: "",
+])
+def test_tampered_tokens_are_invalid(tamper):
+    token, _ = session_auth.issue_token(SECRET, 42, 600, now=NOW)
+    assert session_auth.SessionVerifier(SECRET).verify(tamper(token), now=NOW) == (None, "invalid")
+
+
+def test_tokens_from_another_secret_are_invalid():
+    token, _ = session_auth.issue_token(b"x" * 32, 42, 600, now=NOW)
+    assert session_auth.SessionVerifier(SECRET).verify(token, now=NOW) == (None, "invalid")
+
+
+def test_cache_evicts_least_recently_used():
+    verifier = session_auth.SessionVerifier(SECRET, max_entries=2)
+    tokens = [session_auth.issue_token(SECRET, user_id, 600, now=NOW)[0] for user_id in (1, 2, 3)]
+    verifier.verify(tokens[0], now=NOW)
+    verifier.verify(tokens[1], now=NOW)
+    verifier.verify(tokens[0], now=NOW) # Touch 1, so 2 is the oldest
+    verifier.verify(tokens[2], now=NOW)
+    assert list(verifier.cache) == [tokens[0], tokens[2]]
+    assert verifier.verify(tokens[1], now=NOW) == (2, "verified") # Still valid, just not cached
+
+
+def test_session_secret_prefers_the_configured_value():
+    assert session_auth.session_secret("abc", BOT_TOKEN) == b"abc"
+    assert session_auth.session_secret(None, BOT_TOKEN) == session_auth.session_secret("", BOT_TOKEN)
+    assert session_auth.session_secret(None, None) is None
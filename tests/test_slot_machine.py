@@ -0,0 +1,71 @@
+import random
+
+import numpy as np
+import pytest
+
+import slot_machine
+from slot_machine import PAYTABLE, SCATTER, SYMBOLS, WILD
+
+CHERRY, LEMON, BELL = SYMBOLS.index('🍒'), SYMBOLS.index('🍋'), SYMBOLS.index('🔔')
+
+
+def middle_line(*symbols: int) -> np.ndarray:
+    """A window whose middle row (payline 0) is `symbols`; the other rows are lemons and bells in turn,
+    so they never line up into anything."""
+    window = np.empty((slot_machine.ROWS, slot_machine.REELS), dtype=np.int8)
+    window[0] = window[2] = [LEMON, BELL, LEMON, BELL, LEMON]
+    window[1] = symbols
+    return window
+
+
+def first_line(window: np.ndarray):
+    symbols, counts, wins, scatters = slot_machine.evaluate(window, 1, 1)
+    return SYMBOLS[symbols[0]], int(counts[0]), int(wins[0]), scatters
+
+
+def test_plain_run_from_the_left():
+    assert first_line(middle_line(CHERRY, CHERRY, CHERRY, LEMON, CHERRY))[:3] == ('🍒', 3, PAYTABLE[CHERRY, 3])
+
+
+def test_wilds_substitute_for_the_paying_symbol():
+    assert first_line(middle_line(WILD, CHERRY, WILD, CHERRY, LEMON))[:3] == ('🍒', 4, PAYTABLE[CHERRY, 4])
+
+
+def test_leading_wilds_pay_as_wilds_when_that_is_worth_more():
+    # Four wilds then a cherry: five cherries pay 100, four wilds pay 500
+    assert first_line(middle_line(WILD, WILD, WILD, WILD, CHERRY))[:3] == ('⭐', 4, PAYTABLE[WILD, 4])
+
+
+def test_wilds_before_a_scatter_still_pay():
+    assert first_line(middle_line(WILD, WILD, WILD, SCATTER, CHERRY))[:3] == ('⭐', 3, PAYTABLE[WILD, 3])
+
+
+def test_a_line_of_wilds_pays_the_top_prize():
+    assert first_line(middle_line(WILD, WILD, WILD, WILD, WILD))[:3] == ('⭐', 5, PAYTABLE[WILD, 5])
+
+
+def test_scatters_pay_anywhere_but_never_on_a_line():
+    window = middle_line(SCATTER, SCATTER, SCATTER, LEMON, BELL)
+    symbol, count, win, scatters = first_line(window)
+    assert win == 0
+    assert scatters == 3
+
+
+def test_line_wins_scale_with_bet_per_line():
+    window = middle_line(CHERRY, CHERRY, CHERRY, LEMON, BELL)
+    _, _, wins, _ = slot_machine.evaluate(window, 1, 7)
+    assert wins[0] == PAYTABLE[CHERRY, 3] * 7
+
+
+def test_spin_is_reproducible_and_totals_add_up():
+    first = slot_machine.spin(random.Random(42), 25, 2)
+    again = slot_machine.spin(random.Random(42), 25, 2)
+    assert first == again
+    assert first.total_bet == 50
+    assert first.total_win == sum(w.win for w in first.line_wins) + first.scatter_win
+
+
+@pytest.mark.parametrize("lines, bet", [(0, 1), (26, 1), (1, 0), (1, 101)])
+def test_spin_rejects_out_of_range_bets(lines, bet):
+    with pytest.raises(ValueError):
+        slot_machine.spin(random.Random(0), lines, bet)
@@ -0,0 +1,70 @@
+import json
+
+import pytest
+
+import wire_protocol
+from wire_protocol import COMPACT_KEYS, CompactJsonCodec, JsonCodec
+
+ROOM_STATE = {
+    "room_id": "3f9a1c2b", "status": "playing", "dealer_hand": ["K♠", "Hidden"], "dealer_score": 10,
+    "players": [
+        {"user_id": 500000001, "username": "Гравець 1001", "hand": ["10♥", "A♣"], "score": 21,
+         "bet": 200, "stack": 800, "is_playing": True, "has_bet": True},
+        {"user_id": 500000002, "username": "Гравець 1002", "hand": [], "score": 0,
+         "bet": 0, "stack": 1000, "is_playing": False, "has_bet": False},
+    ],
+    "current_player_turn": 500000001, "player_count": 2, "min_players": 2, "max_players": 4,
+    "timer": 12, "deadline": 1718000000000, "seq": 17,
+}
+ROUND_RESULT = {
+    "type": "round_result", "message": "Ви виграли у дилера!", "winnings": 400, "final_player_score": 21,
+    "stack": 1200, "balance": 5000, "xp": 120, "level": 3, "next_level_xp": 300,
+}
+
+
+def test_compact_keys_are_unambiguous():
+    assert len(set(COMPACT_KEYS.values())) == len(COMPACT_KEYS)
+    assert not set(COMPACT_KEYS.values()) & set(COMPACT_KEYS) # A short key never collides with a long one
+
+
+@pytest.mark.parametrize("message", [ROOM_STATE, ROUND_RESULT, {"type": "hello", "server_time": 1718000000000}])
+def test_compact_round_trip(message):
+    assert wire_protocol.expand(wire_protocol.compact(message)) == message
+
+
+def test_compact_encodes_cards_and_statuses_as_integers():
+    compacted = wire_protocol.compact(ROOM_STATE)
+    assert compacted["s"] == wire_protocol.STATUS_CODES["playing"]
+    assert compacted["dh"] == [wire_protocol.CARD_CODES["K♠"], wire_protocol.HIDDEN_CARD_CODE]
+    assert all(isinstance(code, int) for code in compacted["p"][0]["h"])
+
+
+def test_unknown_keys_pass_through():
+    message = {"type": "x", "something_new": {"nested": [1, 2]}}
+    assert wire_protocol.expand(wire_protocol.compact(message)) == message
+
+
+def test_json_codec_is_byte_compatible_with_legacy_frames():
+    codec = JsonCodec()
+    encoded = codec.encode(ROUND_RESULT)
+    assert encoded == json.dumps(ROUND_RESULT, ensure_ascii=False, separators=(",", ":"))
+    assert codec.decode(encoded) == ROUND_RESULT
+
+
+def test_compact_codec_round_trip_is_smaller():
+    codec = CompactJsonCodec()
+    encoded = codec.encode(ROOM_STATE)
+    assert wire_protocol.expand(codec.decode(encoded)) == ROOM_STATE
+    assert len(encoded.encode()) < len(JsonCodec().encode(ROOM_STATE).encode())
+
+
+def test_msgpack_codec_round_trip():
+    pytest.importorskip("msgpack")
+    codec = wire_protocol.MsgpackCodec()
+    assert wire_protocol.expand(codec.decode(codec.encode(ROOM_STATE))) == ROOM_STATE
+
+
+def test_negotiate_picks_the_first_supported_protocol():
+    assert wire_protocol.negotiate(["casino.v9", "casino.compact.v1", "casino.json.v1"]).name == "casino.compact.v1"
+    assert wire_protocol.negotiate(["something.else"]) is None
+    assert wire_protocol.negotiate([]) is None
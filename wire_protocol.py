@@ -0,0 +1,147 @@
+"""WebSocket wire formats for Blackjack rooms.
+
+Clients pick a format through the Sec-WebSocket-Protocol header. Clients that offer
+nothing get the original verbose JSON, byte for byte as before.
+
+* casino.json.v1    - verbose JSON (the default)
+* casino.compact.v1 - JSON with short keys, integer card codes and status codes
+* casino.msgpack.v1 - the compact form packed with MessagePack (needs `msgpack`)
+"""
+import json
+from typing import Any, Dict, List, Optional
+
+try:
+    import msgpack
+except ImportError: # Optional: the msgpack subprotocol is simply not offered without it
+    msgpack = None
+
+from blackjack_engine import CARD_RANKS, CARD_SUITS
+
+HIDDEN_CARD_CODE = -1
+
+# "10♥" -> rank_index * 4 + suit_index
+CARD_CODES: Dict[str, int] = {
+    f"{rank}{suit}": rank_index * 4 + suit_index
+    for rank_index, rank in enumerate(CARD_RANKS)
+    for suit_index, suit in enumerate(CARD_SUITS)
+}
+CARD_CODES["Hidden"] = HIDDEN_CARD_CODE
+CARD_FIELDS = {"hand", "dealer_hand"}
+
+STATUS_CODES: Dict[str, int] = {status: code for code, status in enumerate(
+    ["waiting", "starting_timer", "betting", "playing", "round_end"]
+)}
+
+# Keys missing from this table are passed through unchanged
+COMPACT_KEYS: Dict[str, str] = {
+    "type": "y",
+    "message": "m",
+    "room_id": "r",
+    "status": "s",
+    "dealer_hand": "dh",
+    "dealer_score": "ds",
+    "players": "p",
+    "current_player_turn": "c",
+    "player_count": "pc",
+    "min_players": "mn",
+    "max_players": "mx",
+    "timer": "t",
+    "deadline": "dl",
+    "server_time": "st",
+    "client_time": "ct",
+    "seq": "q",
+    "changes": "ch",
+    "deltas": "dd",
+    "user_id": "u",
+    "username": "n",
+    "hand": "h",
+    "score": "sc",
+    "bet": "b",
+    "stack": "sk",
+    "is_playing": "ip",
+    "has_bet": "hb",
+    "level": "l",
+    "xp": "x",
+    "balance": "bl",
+    "winnings": "w",
+    "next_level_xp": "nx",
+    "final_player_score": "fs",
+}
+
+
+def compact(value: Any, key: Optional[str] = None) -> Any:
+    """Rewrites a verbose message into its compact form."""
+    if isinstance(value, dict):
+        return {COMPACT_KEYS.get(k, k): compact(v, k) for k, v in value.items()}
+    if isinstance(value, list):
+        if key in CARD_FIELDS:
+            return [CARD_CODES.get(card, card) for card in value]
+        return [compact(item) for item in value]
+    if key == "status" and isinstance(value, str):
+        return STATUS_CODES.get(value, value)
+    return value
+
+
+VERBOSE_KEYS = {short: key for key, short in COMPACT_KEYS.items()}
+CARD_NAMES = {code: card for card, code in CARD_CODES.items()}
+STATUS_NAMES = {code: status for status, code in STATUS_CODES.items()}
+
+
+def expand(value: Any, key: Optional[str] = None) -> Any:
+    """Inverse of compact(); what the webapp's expandCompact does, for tools reading compact frames."""
+    if isinstance(value, dict):
+        return {VERBOSE_KEYS.get(k, k): expand(v, VERBOSE_KEYS.get(k, k)) for k, v in value.items()}
+    if isinstance(value, list):
+        if key in CARD_FIELDS:
+            return [CARD_NAMES.get(card, card) for card in value]
+        return [expand(item) for item in value]
+    if key == "status" and isinstance(value, int):
+        return STATUS_NAMES.get(value, value)
+    return value
+
+
+class JsonCodec:
+    name = "casino.json.v1"
+    binary = False
+
+    def encode(self, message: dict) -> str:
+        # Same separators as Starlette's send_json, so legacy clients see identical frames
+        return json.dumps(message, ensure_ascii=False, separators=(",", ":"))
+
+    def decode(self, data) -> dict:
+        return json.loads(data)
+
+
+class CompactJsonCodec(JsonCodec):
+    name = "casino.compact.v1"
+
+    def encode(self, message: dict) -> str:
+        return json.dumps(compact(message), ensure_ascii=False, separators=(",", ":"))
+
+
+class MsgpackCodec:
+    name = "casino.msgpack.v1"
+    binary = True
+
+    def encode(self, message: dict) -> bytes:
+        return msgpack.packb(compact(message), use_bin_type=True)
+
+    def decode(self, data) -> dict:
+        if isinstance(data, str):
+            return json.loads(data)
+        return msgpack.unpackb(data, raw=False)
+
+
+DEFAULT_CODEC = JsonCodec()
+CODECS: Dict[str, Any] = {codec.name: codec for codec in (DEFAULT_CODEC, CompactJsonCodec())}
+if msgpack is not None:
+    CODECS[MsgpackCodec.name] = MsgpackCodec()
+
+
+def negotiate(offered: List[str]):
+    """Returns the first offered codec we support, or None if the client offered none of ours."""
+    for name in offered:
+        codec = CODECS.get(name)
+        if codec is not None:
+            return codec
+    return None